@@ -5,17 +5,16 @@ from tqdm import tqdm
 import pickle
 import glob
 import os
-import tarfile
-import tempfile
-import open3d as o3d
-import json
 from multiprocessing import Pool
 import time
 import argparse
 import yaml
 
-from .instances_to_sheets import select_points, get_vector_mean, alpha_angles, adjust_angles_zero, adjust_angles_offset, add_overlapp_entries_to_patches_list, assign_points_to_tiles, compute_overlap_for_pair, overlapp_score, fit_sheet, winding_switch_sheet_score_raw_precomputed_surface, find_starting_patch, save_main_sheet, update_main_sheet
-from .sheet_to_mesh import load_xyz_from_file, scale_points, umbilicus_xz_at_y
+from .instances_to_sheets import build_patch as build_tar_patch
+from .instances_to_sheets import add_overlapp_entries_to_patches_list, assign_points_to_tiles, compute_overlap_for_pair, patches_may_overlap, overlapp_score, fit_sheet, winding_switch_sheet_score_raw_precomputed_surface, find_starting_patch, save_main_sheet, update_main_sheet
+from .sheet_to_mesh import load_xyz_from_file, scale_points
+from .umbilicus_interpolation import Umbilicus
+from .tar_index import get_tar_index
 import sys
 ### C++ speed up. not yet fully implemented
 # sys.path.append('sheet_generation/build')
@@ -50,79 +49,6 @@ def volumes_of_point(point, volume_size=50):
     return volumes
 
 
-def load_ply(ply_file_path):
-    """
-    Load point cloud data from a .ply file.
-    """
-    # Check if the .ply file exists
-    assert os.path.isfile(ply_file_path), f"File {ply_file_path} not found."
-
-    # Load the .ply file
-    pcd = o3d.io.read_point_cloud(ply_file_path)
-    points = np.asarray(pcd.points)
-    normals = np.asarray(pcd.normals)
-    colors = np.asarray(pcd.colors)
-
-    # Derive metadata file path from .ply file path
-    base_filename_without_extension = os.path.splitext(os.path.basename(ply_file_path))[0]
-    metadata_file_path = os.path.join(os.path.dirname(ply_file_path), f"metadata_{base_filename_without_extension}.json")
-
-    # Initialize metadata-related variables
-    coeff, n, score, distance = None, None, None, None
-
-    if os.path.isfile(metadata_file_path):
-        with open(metadata_file_path, 'r') as metafile:
-            metadata = json.load(metafile)
-            coeff = np.array(metadata['coeff']) if 'coeff' in metadata and metadata['coeff'] is not None else None
-            n = int(metadata['n']) if 'n' in metadata and metadata['n'] is not None else None
-            score = metadata.get('score')
-            distance = metadata.get('distance')
-
-    return points, normals, colors, score, distance, coeff, n
-
-def build_patch(main_sheet_patch, subvolume_size, path, sample_ratio=1.0, align_and_flip_normals=False):
-    subvolume_size = np.array(subvolume_size)
-    ((x, y, z), main_sheet_surface_nr, offset_angle) = main_sheet_patch
-    file = path + f"/{x:06}_{y:06}_{z:06}/surface_{main_sheet_surface_nr}.ply"
-    res = load_ply(path)
-    patch_points = res[0]
-    patch_normals = res[1]
-    patch_color = res[2]
-    patch_score = res[3]
-    patch_distance = res[4]
-    patch_coeff = res[5]
-    n = res[6]
-
-    # Sample points from picked patch
-    patch_points, patch_normals, patch_color, _ = select_points(
-        patch_points, patch_normals, patch_color, patch_color, sample_ratio
-    )
-
-    patch_id = tuple([*map(int, file.split("/")[-2].split("_"))]+[int(file.split("/")[-1].split(".")[-2].split("_")[-1])])
-
-    x, y, z, id_ = patch_id
-    anchor_normal = get_vector_mean(patch_normals)
-    anchor_angle = alpha_angles(np.array([anchor_normal]))[0]
-
-    additional_main_patch = {"ids": [patch_id],
-                    "points": patch_points,
-                    "normals": patch_normals,
-                    "colors": patch_color,
-                    "anchor_points": [patch_points[0]], 
-                    "anchor_normals": [anchor_normal],
-                    "anchor_angles": [anchor_angle],
-                    "angles": adjust_angles_offset(adjust_angles_zero(alpha_angles(patch_normals), - anchor_angle), offset_angle),
-                    "subvolume": [(x, y, z)],
-                    "subvolume_size": [subvolume_size],
-                    "iteration": 0,
-                    "patch_prediction_scores": [patch_score],
-                    "patch_prediction_distances": [patch_distance],
-                    "patch_prediction_coeff": [patch_coeff],
-                    "n": [n],
-                    }
-    
-    return additional_main_patch, offset_angle
-
 def subvolume_surface_patches_folder(file, subvolume_size=50, sample_ratio=1.0):
     """
     Load surface patches from overlapping subvolumes instances predictions.
@@ -137,22 +63,17 @@ def subvolume_surface_patches_folder(file, subvolume_size=50, sample_ratio=1.0):
     tar_filename = f"{file}.tar"
 
     if os.path.isfile(tar_filename):
-        with tarfile.open(tar_filename, 'r') as archive, tempfile.TemporaryDirectory() as temp_dir:
-            # Extract all .ply files at once
-            ply_files = [m for m in archive.getmembers() if m.name.endswith(".ply")]
-            archive.extractall(path=temp_dir, members=archive.getmembers())
-
-            # Process each .ply file
-            for ply_member in ply_files:
-                ply_file_path = os.path.join(temp_dir, ply_member.name)
-                ply_file = ply_member.name
-                # print(ply_file_path)
-                # ids = tuple([*map(int, ply_member.name.split("_"))])
-                ids = tuple([*map(int, tar_filename.split(".")[-2].split("/")[-1].split("_"))]+[int(ply_file.split(".")[-2].split("_")[-1])])
-                ids = (int(ids[0]), int(ids[1]), int(ids[2]), int(ids[3]))
-                main_sheet_patch = (ids[:3], ids[3], float(0.0))
-                surface_dict, _ = build_patch(main_sheet_patch, tuple(subvolume_size), ply_file_path, sample_ratio=float(sample_ratio))
-                patches_list.append(surface_dict)
+        # Members are read straight from the tar through its index
+        ply_files = [name for name in get_tar_index(tar_filename).names() if name.endswith(".ply")]
+        path = os.path.dirname(tar_filename)
+
+        # Process each .ply file
+        for ply_file in ply_files:
+            ids = tuple([*map(int, tar_filename.split(".")[-2].split("/")[-1].split("_"))]+[int(ply_file.split(".")[-2].split("_")[-1])])
+            ids = (int(ids[0]), int(ids[1]), int(ids[2]), int(ids[3]))
+            main_sheet_patch = (ids[:3], ids[3], float(0.0))
+            surface_dict, _ = build_tar_patch(main_sheet_patch, tuple(subvolume_size), path, sample_ratio=float(sample_ratio))
+            patches_list.append(surface_dict)
 
     return patches_list
 
@@ -171,16 +92,29 @@ def build_patch_tar(main_sheet_patch, subvolume_size, path, sample_ratio=1.0):
     tar_filename = f"{file}.tar"
 
     if os.path.isfile(tar_filename):
-        with tarfile.open(tar_filename, 'r') as archive, tempfile.TemporaryDirectory() as temp_dir:
-            # Extract all .ply files at once
-            archive.extractall(path=temp_dir, members=archive.getmembers())
+        # Read the patch straight from the tar through its index
+        main_sheet_patch = ((int(xyz[0]), int(xyz[1]), int(xyz[2])), int(patch_nr), main_sheet_patch[2])
+        return build_tar_patch(main_sheet_patch, tuple(subvolume_size), path, sample_ratio=float(sample_ratio))
 
-            ply_file = f"surface_{patch_nr}.ply"
-            ply_file_path = os.path.join(temp_dir, ply_file)
-            ids = tuple([*map(int, tar_filename.split(".")[-2].split("/")[-1].split("_"))]+[int(ply_file.split(".")[-2].split("_")[-1])])
-            ids = (int(ids[0]), int(ids[1]), int(ids[2]), int(ids[3]))
-            res = build_patch(main_sheet_patch, tuple(subvolume_size), ply_file_path, sample_ratio=float(sample_ratio))
-            return res
+def build_patches_tar_group(args):
+    """
+    Worker function to load all requested surface patches of a single block tar.
+    The tar index is loaded only once for the whole group of patches.
+    """
+    xyz, patch_entries, path, subvolume_size, sample_ratio = args
+    tar_filename = path + f"/{xyz[0]:06}_{xyz[1]:06}_{xyz[2]:06}.tar"
+
+    results = []
+    if not os.path.isfile(tar_filename):
+        return results
+
+    # Warm up the index of the tar, all patches of the group are read through it
+    get_tar_index(tar_filename)
+    for index, patch_nr in patch_entries:
+        main_sheet_patch = (xyz, int(patch_nr), float(0.0))
+        patch, _ = build_tar_patch(main_sheet_patch, tuple(subvolume_size), path, sample_ratio=float(sample_ratio))
+        results.append((index, patch["anchor_angles"][0], patch["points"].shape[0]))
+    return results
 
 def load_graph(filename):
     with open(filename, 'rb') as file:
@@ -418,8 +352,12 @@ def process_block(args):
 
     # calculate scores between each main block patch and surrounding blocks patches
     score_sheets = []
+    # Pairs that can not share any points score -1, they can only be pruned if such a score is rejected anyway
+    prune_disjoint_pairs = overlapp_threshold["final_score_min"] >= -1
     for i, main_block_patch in enumerate(main_block_patches_list):
         for j, surrounding_block_patch in enumerate(surrounding_blocks_patches_list):
+            if prune_disjoint_pairs and not patches_may_overlap(main_block_patch, surrounding_block_patch):
+                continue
             patches_list_ = [main_block_patch, surrounding_block_patch]
             score_ = score_other_block_patches(patches_list_, 0, 1, overlapp_threshold) # score, anchor_angle1, anchor_angle2
             if score_[0] > overlapp_threshold["final_score_min"]:
@@ -635,8 +573,8 @@ class RandomWalkSolver:
         umbilicus_data = load_xyz_from_file(umbilicus_path)
         # scale and swap axis
         umbilicus_data = scale_points(umbilicus_data, 50.0/200.0, axis_offset=0)
-        # Define a wrapper function for umbilicus_xz_at_y
-        self.umbilicus_func = lambda z: umbilicus_xz_at_y(umbilicus_data, z)
+        # Umbilicus lookup table, positions at y
+        self.umbilicus_func = Umbilicus(umbilicus_data, axis=1).position
 
     def translate_data_to_cpp(self, recompute_translation=True):
         """
@@ -1290,7 +1228,7 @@ class WalkToSheet():
         self.ks  = ks
         self.overlapp_threshold = overlapp_threshold
 
-    def create_sheet(self):
+    def create_sheet(self, num_processes=None):
         print(f"Min and max k: {np.min(self.ks)}, {np.max(self.ks)}")
         start_block, patch_id = self.graph.start_block, self.graph.patch_id
         # get start node
@@ -1299,15 +1237,45 @@ class WalkToSheet():
         anchor_angle = main_sheet_patch["anchor_angles"][0]
         main_sheet = {}
         main_sheet[tuple(start_block)] = {patch_id: {"offset_angle": anchor_angle, "displaying_points": []}}
+
+        # Group nodes by block tar, every tar is only decoded once per group
+        block_groups = {}
+        for i, node in enumerate(self.nodes):
+            block_id = tuple(int(c) for c in node[:3])
+            if block_id not in block_groups:
+                block_groups[block_id] = []
+            block_groups[block_id].append((i, int(node[3])))
+
+        if num_processes is None:
+            num_processes = self.overlapp_threshold.get("max_threads", 4)
+        sample_ratio = self.overlapp_threshold["sample_ratio_score"]
+        zipped_args = [(block_id, patch_entries, self.path, (50, 50, 50), sample_ratio) for block_id, patch_entries in block_groups.items()]
+
+        # Preallocated output buffers, filled in by node index as the worker results arrive
+        anchor_angles = np.zeros(len(self.nodes), dtype=float)
+        loaded_mask = np.zeros(len(self.nodes), dtype=bool)
+
         # visit all connected nodes
-        print(F"Creating sheet with {len(self.nodes)} patches.")
+        print(F"Creating sheet with {len(self.nodes)} patches from {len(block_groups)} blocks.")
+        nr_points = 0
+        time_start = time.time()
+        with Pool(num_processes) as pool, tqdm(total=len(self.nodes)) as progress:
+            for results in pool.imap_unordered(build_patches_tar_group, zipped_args):
+                for index, anchor_angle_patch, nr_points_patch in results:
+                    anchor_angles[index] = anchor_angle_patch
+                    loaded_mask[index] = True
+                    nr_points += nr_points_patch
+                progress.update(len(results))
+                progress.set_postfix(patches_per_sec=f"{progress.n / max(time.time() - time_start, 1e-6):.1f}")
+        time_total = max(time.time() - time_start, 1e-6)
+        print(f"Loaded {int(np.sum(loaded_mask))} patches ({nr_points} points) in {time_total:.2f}s: {np.sum(loaded_mask) / time_total:.1f} patches/sec, {nr_points / time_total:.1f} points/sec.")
+        assert np.all(loaded_mask), f"Could not load {np.sum(~loaded_mask)} patches of the sheet."
+
         for i in range(len(self.nodes)):
             node = self.nodes[i]
             k = self.ks[i]
-            # build patch and add to sheet
-            sheet_patch = (node[:3], int(node[3]), float(0.0))
-            patch, _ = build_patch_tar(sheet_patch, (50, 50, 50), self.path, sample_ratio=self.overlapp_threshold["sample_ratio_score"])
-            angle_offset = patch["anchor_angles"][0] - k * 360.0
+            # add patch to sheet
+            angle_offset = anchor_angles[i] - k * 360.0
             patches = [(node[:3], int(node[3]), angle_offset, None)]
             offset_angles = [angle_offset]
             update_main_sheet(main_sheet, patches, offset_angles, [[]])
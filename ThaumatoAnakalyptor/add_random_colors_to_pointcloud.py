@@ -1,12 +1,16 @@
 ### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
 
 import os
-import random
+import re
+import tempfile
+import argparse
 import open3d as o3d
 import numpy as np
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
-from threading import current_thread
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from .tar_index import parse_ply_header
+
+COLOR_PROPERTIES = ("red", "green", "blue")
 
 def load_ply(filename):
     """
@@ -22,17 +26,26 @@ def load_ply(filename):
 
     return points, normals
 
-def save_surface_ply(surface_points, normals, filename):
-    # Ensure random colors aren't repeated due to thread-local random state.
-    # Seed with the thread's identifier, process id and number of points.
-    np.random.seed((len(surface_points) * int((os.getpid() << 16) | (id(current_thread()) & 0xFFFF)))% (2**31))
+def color_generator(filename, seed=0):
+    """
+    Counter based random generator keyed on the ids in the filename (block id, patch id) and the seed.
+    The colors of a file do not depend on the process, thread or order it is colored in.
+    """
+    ids = tuple(int(i) for i in re.findall(r"\d+", os.path.splitext(os.path.basename(filename))[0]))
+    return np.random.Generator(np.random.Philox(np.random.SeedSequence(entropy=seed, spawn_key=ids)))
 
+def random_colors(rng, nr_points, dtype):
+    if np.dtype(dtype).kind == 'f':
+        return rng.uniform(0, 1, size=(nr_points, 3)).astype(dtype)
+    return rng.integers(0, np.iinfo(dtype).max, size=(nr_points, 3), endpoint=True, dtype=dtype)
+
+def save_surface_ply(surface_points, normals, filename, seed=0):
     # Create an Open3D point cloud object and populate it
     pcd = o3d.geometry.PointCloud()
     pcd.points = o3d.utility.Vector3dVector(surface_points)
     pcd.normals = o3d.utility.Vector3dVector(normals)
     # random colors
-    pcd.colors = o3d.utility.Vector3dVector(np.random.uniform(0, 1, size=(surface_points.shape[0], 3)))
+    pcd.colors = o3d.utility.Vector3dVector(random_colors(color_generator(filename, seed), surface_points.shape[0], np.float64))
 
     # Create folder if it doesn't exist
     os.makedirs(os.path.dirname(filename), exist_ok=True)
@@ -40,32 +53,142 @@ def save_surface_ply(surface_points, normals, filename):
     # Save as a PLY file
     o3d.io.write_point_cloud(filename, pcd)
 
-def process_file(file, src_folder, dest_folder):
-    # Load volume
-    points, normals = load_ply(os.path.join(src_folder, file))
-    # Save volume
-    save_surface_ply(points, normals, os.path.join(dest_folder, file))
+def color_ply_bytes(data, filename, seed=0):
+    """
+    Random colors for a binary .ply held in memory. Existing color properties are overwritten in place,
+    otherwise uchar red, green, blue properties are appended to the vertices. Everything else is copied unchanged.
+    Returns None for ascii ply files.
+    """
+    ply_format, elements, body_offset = parse_ply_header(data)
+    if ply_format == "ascii":
+        return None
+    assert elements[0][0] == "vertex", f"Only ply files starting with a vertex element are supported, found {elements[0][0]}."
+    _, nr_vertices, properties = elements[0]
+    byte_order = "<" if ply_format == "binary_little_endian" else ">"
+    dtype = np.dtype([(name, byte_order + dtype) for name, dtype in properties])
+    vertices = np.frombuffer(data, dtype=dtype, count=nr_vertices, offset=body_offset)
+    rest = data[body_offset + vertices.nbytes:]
+    rng = color_generator(filename, seed)
+    names = [name for name, _ in properties]
+
+    if all(name in names for name in COLOR_PROPERTIES):
+        # Rewrite only the color properties
+        vertices = vertices.copy()
+        colors = random_colors(rng, nr_vertices, vertices.dtype["red"].newbyteorder("="))
+        for i, name in enumerate(COLOR_PROPERTIES):
+            vertices[name] = colors[:, i]
+        return data[:body_offset] + vertices.tobytes() + rest
+
+    # Append uchar color properties after the last vertex property
+    colored_dtype = np.dtype(dtype.descr + [(name, "u1") for name in COLOR_PROPERTIES])
+    colored_vertices = np.empty(nr_vertices, dtype=colored_dtype)
+    for name in names:
+        colored_vertices[name] = vertices[name]
+    colors = random_colors(rng, nr_vertices, np.uint8)
+    for i, name in enumerate(COLOR_PROPERTIES):
+        colored_vertices[name] = colors[:, i]
+
+    header_lines = data[:body_offset].decode("ascii").splitlines()
+    vertex_line = next(i for i, line in enumerate(header_lines) if line.split()[:2] == ["element", "vertex"])
+    end_vertex = next(i for i, line in enumerate(header_lines) if i > vertex_line and line.split()[:1] in (["element"], ["end_header"]))
+    header_lines[end_vertex:end_vertex] = [f"property uchar {name}" for name in COLOR_PROPERTIES]
+    return ("\n".join(header_lines) + "\n").encode("ascii") + colored_vertices.tobytes() + rest
 
+def process_file(file, src_folder, dest_folder, seed=0):
+    src_path = os.path.join(src_folder, file)
+    dest_path = os.path.join(dest_folder, file)
+    with open(src_path, 'rb') as f:
+        data = f.read()
+    colored_data = color_ply_bytes(data, dest_path, seed=seed)
+    if colored_data is None:
+        # Ascii ply, full Open3D round trip
+        points, normals = load_ply(src_path)
+        save_surface_ply(points, normals, dest_path, seed=seed)
+        return
+    # Save to a temporary file first to ensure data integrity
+    temp_path = dest_path.replace(".ply", "_temp.ply")
+    with open(temp_path, 'wb') as f:
+        f.write(colored_data)
+    os.replace(temp_path, dest_path)
 
-def add_random_colors(src_folder, dest_folder):
+def add_random_colors(src_folder, dest_folder, seed=0, num_workers=1, max_in_flight=None):
+    """
+    Color all .ply files of src_folder with reproducible random colors into dest_folder.
+    The colors only depend on the file names and the seed, not on the number of workers.
+    At most max_in_flight files are read or written at the same time.
+    """
     # List all files in the source folder
     all_files = os.listdir(src_folder)
-    
+
     # Filter out all files that are not .ply files
-    ply_files = [file for file in all_files if file.endswith('.ply')]
-    
+    ply_files = sorted(file for file in all_files if file.endswith('.ply') and not file.endswith('_temp.ply'))
+
     # Make destination folder if it does not exist
     if not os.path.exists(dest_folder):
         os.makedirs(dest_folder)
-    
-    # Use ThreadPoolExecutor to process files in parallel
-    with ProcessPoolExecutor(1) as executor:
-        list(tqdm(executor.map(process_file, ply_files, [src_folder]*len(ply_files), [dest_folder]*len(ply_files)), total=len(ply_files)))
 
+    max_in_flight = max_in_flight if max_in_flight is not None else 2 * num_workers
+    with ProcessPoolExecutor(num_workers) as executor, tqdm(total=len(ply_files)) as progress:
+        in_flight = set()
+        for file in ply_files:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                progress.update(len(done))
+            in_flight.add(executor.submit(process_file, file, src_folder, dest_folder, seed))
+        for future in in_flight:
+            future.result()
+        progress.update(len(in_flight))
+
+def check_determinism(nr_files=16, nr_points=10000, worker_counts=(1, 4), seed=0):
+    """
+    Color synthetic .ply files with different numbers of workers and check that the outputs are byte identical.
+    """
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        src_folder = os.path.join(temp_dir, "point_cloud")
+        os.makedirs(src_folder)
+        dtype = np.dtype([(name, "<f8") for name in ("x", "y", "z", "nx", "ny", "nz")])
+        header = f"ply\nformat binary_little_endian 1.0\nelement vertex {nr_points}\n" + "".join(f"property double {name}\n" for name in dtype.names) + "end_header\n"
+        for i in range(nr_files):
+            vertices = np.empty(nr_points, dtype=dtype)
+            for name in dtype.names:
+                vertices[name] = rng.normal(size=nr_points)
+            with open(os.path.join(src_folder, f"cell_yxz_{i:03}_{i+1:03}_{i+2:03}.ply"), 'wb') as f:
+                f.write(header.encode("ascii") + vertices.tobytes())
+
+        outputs = []
+        for num_workers in worker_counts:
+            dest_folder = os.path.join(temp_dir, f"colored_{num_workers}")
+            add_random_colors(src_folder, dest_folder, seed=seed, num_workers=num_workers)
+            outputs.append({file: open(os.path.join(dest_folder, file), 'rb').read() for file in sorted(os.listdir(dest_folder))})
+        for num_workers, output in zip(worker_counts[1:], outputs[1:]):
+            assert output == outputs[0], f"Colors with {num_workers} workers differ from {worker_counts[0]} worker(s)"
+        # Recoloring a colored file only rewrites the colors and is deterministic as well
+        colored = os.path.join(temp_dir, f"colored_{worker_counts[0]}")
+        recolored = os.path.join(temp_dir, "recolored")
+        add_random_colors(colored, recolored, seed=seed)
+        for file in outputs[0]:
+            assert open(os.path.join(recolored, file), 'rb').read() == outputs[0][file], f"Recolored {file} differs"
+        # Different files get different colors
+        assert len(set(outputs[0].values())) == len(outputs[0]), "Files got identical colors"
+    print(f"Colors of {nr_files} files are identical for {', '.join(str(num_workers) for num_workers in worker_counts)} workers")
 
 if __name__ == '__main__':
     # Sample usage:
     src_folder = '/media/julian/SSD2/scroll3_surface_points/point_cloud_recto'  # Replace with your source folder path
     dest_folder = '/media/julian/SSD2/scroll3_surface_points/point_cloud_colorized_recto'  # Replace with your destination folder path
 
-    add_random_colors(src_folder, dest_folder)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Add reproducible random colors to the surface point clouds")
+    parser.add_argument("--src_folder", type=str, help="Folder with the .ply files", default=src_folder)
+    parser.add_argument("--dest_folder", type=str, help="Folder for the colored .ply files", default=dest_folder)
+    parser.add_argument("--seed", type=int, help="Seed of the colors", default=0)
+    parser.add_argument("--num_workers", type=int, help="Number of worker processes", default=1)
+    parser.add_argument("--check_determinism", action="store_true", help="Check that colors do not depend on the number of workers on synthetic files instead")
+    args = parser.parse_args()
+
+    if args.check_determinism:
+        check_determinism()
+    else:
+        add_random_colors(args.src_folder, args.dest_folder, seed=args.seed, num_workers=args.num_workers)
@@ -1,98 +1,119 @@
 ### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
 
 import numpy as np
-from .pointcloud_to_instances import save_block_ply
-from .instances_to_sheets import load_ply
-from .sheet_to_mesh import load_xyz_from_file, umbilicus, umbilicus_xz_at_y, scale_points
+from .sheet_to_mesh import load_xyz_from_file, umbilicus, scale_points
+from .umbilicus_interpolation import Umbilicus
+from .tar_index import parse_ply_header
 
 from multiprocessing import Pool, cpu_count
 import os
+import io
 from glob import glob
 import tarfile
 
 from tqdm import tqdm
-from copy import deepcopy
 
-def load_tar_block(file):
+def read_tar_members(tar_filename):
     """
-    Load  patches and metadata from tar in volume
-    input file: tar name + path (without .tar)
+    Read all members of a tar in one pass over the tar stream, no extraction to disk.
+    Returns the list of (TarInfo, data) in archive order, data is None for non file members.
     """
-    # Deduce folder filename from given path
-    tar_filename = f"{file}.tar"
-    # Check that the tar file exists
-    assert os.path.isfile(tar_filename), f"File {tar_filename} not found."
-
-    # base path of tar file
-    path = os.path.dirname(tar_filename)
-
-    files_content = []
-    # Check that the tar file exists
-    if os.path.isfile(tar_filename):
-        # Retrieve a list of all .ply files within the tarball
-        with tarfile.open(tar_filename, 'r') as archive:
-            ply_files = [m.name for m in archive.getmembers() if m.name.endswith(".ply")]
-            # Iterate and load all instances prediction .ply files
-            for ply_file_ in ply_files:
-                ply_file = os.path.join(file, ply_file_)
-
-                ids = tuple([*map(int, ply_file.split("/")[-2].split("_"))]+[int(ply_file.split("/")[-1].split(".")[-2].split("_")[-1])])
-                ids = (int(ids[0]), int(ids[1]), int(ids[2]), int(ids[3]))
-                main_sheet_patch = (ids[:3], ids[3], float(0.0))
-                # Load ply
-                ((x, y, z), main_sheet_surface_nr, offset_angle) = main_sheet_patch
-                file_ = path + f"/{x:06}_{y:06}_{z:06}/surface_{main_sheet_surface_nr}.ply"
-                res = load_ply(file_)
-
-                files_content.append(res)
-
-    assert len(files_content) > 0, f"No .ply files found in {tar_filename}. Something is fishy."
-    return files_content
-
-def realign_normals_to_umbilicus(block_points, block_normals, umbilicus_points, axis_indices):
-    main_sheet_points_scaled = scale_points(deepcopy(block_points), 200.0 / 50.0, axis_offset=0.0)
-    main_sheet_points_scaled = main_sheet_points_scaled[:, axis_indices]
-    block_normals_umbilicus = deepcopy(block_normals)[:, axis_indices]
-    umbilicus_points_main = umbilicus_xz_at_y(umbilicus_points, main_sheet_points_scaled[:, 1])
+    members = []
+    with tarfile.open(tar_filename, 'r') as archive:
+        for member in archive:
+            data = archive.extractfile(member).read() if member.isfile() else None
+            members.append((member, data))
+    return members
+
+def write_tar_members(tar_filename, members):
+    """
+    Write the members to tar_filename atomically: to a temporary tar first, then renamed over the old one.
+    """
+    temp_filename = tar_filename[:-4] + "_temp.tar"
+    with tarfile.open(temp_filename, 'w') as archive:
+        for member, data in members:
+            if data is None:
+                archive.addfile(member)
+            else:
+                member.size = len(data)
+                archive.addfile(member, io.BytesIO(data))
+    os.replace(temp_filename, tar_filename)
+
+def ply_vertices(data):
+    """
+    Vertex records of a binary .ply held in memory as a writable structured array, and the byte offset of the body.
+    Raises ValueError for ply data that can not be realigned in place.
+    """
+    try:
+        ply_format, elements, body_offset = parse_ply_header(data)
+    except (AssertionError, KeyError, IndexError, ValueError) as e:
+        raise ValueError(f"Invalid ply header: {e}") from e
+    if ply_format == "ascii":
+        raise ValueError("Only binary ply files can be realigned in place.")
+    if len(elements) == 0 or elements[0][0] != "vertex":
+        raise ValueError("Only ply files starting with a vertex element are supported.")
+    _, nr_vertices, properties = elements[0]
+    if any(dtype is None for _, dtype in properties):
+        raise ValueError("List properties are not supported for vertices.")
+    byte_order = "<" if ply_format == "binary_little_endian" else ">"
+    dtype = np.dtype([(name, byte_order + dtype) for name, dtype in properties])
+    vertices = np.frombuffer(data, dtype=dtype, count=nr_vertices, offset=body_offset).copy()
+    return vertices, body_offset
+
+def umbilicus_flip_mask(points, normals, umbilicus_lut, axis_indices):
+    """
+    Mask of the normals pointing towards the umbilicus, for all points of a block at once.
+    """
+    main_sheet_points_scaled = scale_points(points, 200.0 / 50.0, axis_offset=0.0)[:, axis_indices]
+    umbilicus_points_main = umbilicus_lut.position(main_sheet_points_scaled[:, 1])
 
     # points-umbilicus vectors
     block_points_umbilicus = main_sheet_points_scaled - umbilicus_points_main
 
     # check alignment between block_normals and block_points_umbilicus
-    # dot product between block_normals_umbilicus and block_points_umbilicus
-    dot = np.sum(block_normals_umbilicus * block_points_umbilicus, axis=1)
-    # switch sign of block_normals if dot product is negative
-    block_normals[dot < 0] = -block_normals[dot < 0]
-
-    return block_points, block_normals, np.sum(dot < 0)
+    dot = np.sum(normals[:, axis_indices] * block_points_umbilicus, axis=1)
+    return dot < 0
 
 def process_block(args):
-    block_tar, umbilicus_points, axis_indices = args
+    """
+    Flip the normals of all patches of a block tar to point away from the umbilicus.
+    Returns the number of flipped normals, whether the tar was rewritten and whether the block was skipped as unreadable.
+    Blocks without flips and unreadable blocks are left untouched.
+    """
+    block_tar, umbilicus_lut, axis_indices = args
 
-    block_path = block_tar[:-4]
     try:
-        block = load_tar_block(block_path)
-    except:
-        return 0
-    
-    # Realign normals towards umbilicus
-    new_block = []
-    aligned_count = 0
-    for patch in block:
-        patch_points, patch_normals = patch[0], patch[1]
-        patch_points, patch_normals, nr_aligned = realign_normals_to_umbilicus(patch_points, patch_normals, umbilicus_points, axis_indices)
-        aligned_count += nr_aligned
-        patch = (patch_points, patch_normals, *patch[2:])
-        new_block.append(patch)
-
-    # block format is [(points, normals, color, score, distance, coeff, n), ...], get all the data separated
-    block_points, block_normals, block_color, block_score, block_distance, block_coeff, block_n = zip(*new_block)
-
-    # Save again
-    n = block_n[0] # All the same
-    save_block_ply(block_points, block_normals, block_color, block_score, block_distances_precomputed=block_distance, block_coeffs_precomputed=block_coeff, n=n, post_process=False, block_name=block_path, check_exist=False, score_threshold=None, distance_threshold=None, alpha=None, slope_alpha=None)
-
-    return aligned_count
+        members = read_tar_members(block_tar)
+        ply_members = [i for i, (member, data) in enumerate(members) if data is not None and member.name.endswith(".ply")]
+        if len(ply_members) == 0:
+            return 0, False, False
+        vertices_list = [ply_vertices(members[i][1]) for i in ply_members]
+
+        # All patches of the block in one umbilicus evaluation
+        points = np.concatenate([np.stack([vertices["x"], vertices["y"], vertices["z"]], axis=1).astype(np.float64) for vertices, _ in vertices_list])
+        normals = np.concatenate([np.stack([vertices["nx"], vertices["ny"], vertices["nz"]], axis=1).astype(np.float64) for vertices, _ in vertices_list])
+    except (tarfile.TarError, OSError, ValueError) as e:
+        print(f"Skipping unreadable block {block_tar}: {e}")
+        return 0, False, True
+
+    flip = umbilicus_flip_mask(points, normals, umbilicus_lut, axis_indices)
+    aligned_count = int(np.sum(flip))
+    if aligned_count == 0:
+        return 0, False, False
+
+    # Flip the normals in the ply bodies, everything else in the tar stays byte identical
+    offsets = np.cumsum([0] + [len(vertices) for vertices, _ in vertices_list])
+    for i, (vertices, body_offset), start, end in zip(ply_members, vertices_list, offsets[:-1], offsets[1:]):
+        patch_flip = flip[start:end]
+        if not np.any(patch_flip):
+            continue
+        for name in ("nx", "ny", "nz"):
+            vertices[name][patch_flip] = -vertices[name][patch_flip]
+        member, data = members[i]
+        members[i] = (member, data[:body_offset] + vertices.tobytes() + data[body_offset + vertices.nbytes:])
+
+    write_tar_members(block_tar, members)
+    return aligned_count, True, False
 
 def main():
     # Axis swap mesh PC
@@ -102,17 +123,21 @@ def main():
     umbilicus_path = '../scroll3_grids/umbilicus.txt'
     umbilicus_data = load_xyz_from_file(umbilicus_path)
     umbilicus_points = umbilicus(umbilicus_data)
+    # Lookup table of the umbilicus, built once and shared with the workers
+    umbilicus_lut = Umbilicus(umbilicus_points, axis=1)
 
     # Find all block tars in the scroll
-    block_tars = glob(os.path.join(path, "*.tar"))
+    block_tars = [block_tar for block_tar in glob(os.path.join(path, "*.tar")) if not block_tar.endswith("_temp.tar")]
 
     # Multi Threaded
-    args = [(block_tar, umbilicus_points, axis_indices) for block_tar in block_tars]
+    args = [(block_tar, umbilicus_lut, axis_indices) for block_tar in block_tars]
     with Pool(processes=cpu_count()) as pool:
         res = list(tqdm(pool.imap(process_block, args), total=len(block_tars)))
-    print(f"Aligned {np.sum(res)} normals towards umbilicus")
+    nr_rewritten = sum(rewritten for _, rewritten, _ in res)
+    nr_skipped = sum(skipped for _, _, skipped in res)
+    print(f"Aligned {sum(count for count, _, _ in res)} normals towards umbilicus, rewrote {nr_rewritten} blocks, {len(res) - nr_rewritten - nr_skipped} blocks needed no change, skipped {nr_skipped} unreadable blocks")
 
 
 if __name__ == '__main__':
     main()
-    print("Done!")
\ No newline at end of file
+    print("Done!")
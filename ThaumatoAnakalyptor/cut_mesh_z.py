@@ -4,69 +4,107 @@ import open3d as o3d
 import numpy as np
 import os
 import argparse
+from multiprocessing import Pool
+from .mesh_cleaning import connected_triangle_components
+from .obj_io import write_obj
 
-def largest_cluster(mesh):
-    # cluster triangles and find largest surface are cluster
-    index_c, count_c, area_c = mesh.cluster_connected_triangles()
-    area_c = np.asarray(area_c)
-    index_c = np.asarray(index_c)
-    area_scale_factor = 0.008 ** 2 / 100.0
-    print(f"Found {len(area_c)} clusters, selecting the largest cluster of size {area_c.max()*area_scale_factor:.1f} cmsq. Total initial mesh area is {area_c.sum()*area_scale_factor:.1f} cmsq.")
-    # get ind of largest area cluster
-    ind_largest_cluster = np.argmax(area_c)
-    mask_triangles = index_c == ind_largest_cluster
-    mesh.remove_triangles_by_mask(~mask_triangles)
+AREA_SCALE_FACTOR = 0.008 ** 2 / 100.0
 
-    return mesh
+def triangle_z_bands(vertices, triangles, z_heights):
+    """
+    Band of each triangle between the sorted z_heights: band i lies between z_heights[i-1] and z_heights[i].
+    Like cropping at the heights, triangles crossing a height are in no band (-1). Triangles ending exactly on a height go to the lower band.
+    """
+    triangle_z = vertices[:, 2][triangles]
+    min_z, max_z = triangle_z.min(axis=1), triangle_z.max(axis=1)
+    # Band of the highest vertex, the lowest vertex has to be above the lower height of that band
+    bands = np.digitize(max_z, z_heights, right=True)
+    lower_heights = np.concatenate([[-np.inf], z_heights])[bands]
+    bands[min_z < lower_heights] = -1
+    return bands
 
-def cut_mesh_at_height(mesh, z_height):
-    lower_mesh = mesh.crop(o3d.geometry.AxisAlignedBoundingBox([-np.inf, -np.inf, -np.inf], [np.inf, np.inf, z_height]))
-    upper_mesh = mesh.crop(o3d.geometry.AxisAlignedBoundingBox([-np.inf, -np.inf, z_height], [np.inf, np.inf, np.inf]))
-    
-    return upper_mesh, lower_mesh
+def largest_component_mask(vertices, triangles, triangle_groups):
+    """
+    Mask of the triangles in the largest area connected component of each group.
+    """
+    labels = connected_triangle_components(triangles, triangle_groups=triangle_groups)
+    corners = vertices[triangles]
+    areas = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+    component_areas = np.bincount(labels, weights=areas, minlength=len(triangles))
+    # Largest component per group, first one on ties
+    components = np.unique(labels)
+    component_groups = triangle_groups[components]
+    order = np.lexsort((-component_areas[components], component_groups))
+    first_of_group = np.concatenate([[True], component_groups[order][1:] != component_groups[order][:-1]])
+    largest = np.zeros(len(triangles), dtype=bool)
+    largest[components[order][first_of_group]] = True
+    for group in np.unique(triangle_groups):
+        group_components = components[component_groups == group]
+        group_areas = component_areas[group_components]
+        print(f"Band {group}: found {len(group_components)} clusters, selecting the largest cluster of size {group_areas.max()*AREA_SCALE_FACTOR:.1f} cmsq. Total initial mesh area is {group_areas.sum()*AREA_SCALE_FACTOR:.1f} cmsq.")
+    return largest[labels]
+
+def submesh_arrays(mesh_arrays, triangle_indices):
+    """
+    Arrays of the submesh made of triangle_indices, vertices are remapped to the referenced ones.
+    """
+    vertices, triangles, vertex_normals, vertex_colors, triangle_uvs = mesh_arrays
+    used_vertices, new_triangles = np.unique(triangles[triangle_indices], return_inverse=True)
+    new_triangles = new_triangles.reshape(-1, 3)
+    uv_indices = (3 * triangle_indices[:, None] + np.arange(3)).reshape(-1)
+    return (vertices[used_vertices], new_triangles,
+            vertex_normals[used_vertices] if len(vertex_normals) > 0 else vertex_normals,
+            vertex_colors[used_vertices] if len(vertex_colors) > 0 else vertex_colors,
+            triangle_uvs[uv_indices] if len(triangle_uvs) > 0 else triangle_uvs)
 
-def cut_and_save_mesh(file_path, output_directory, z_heights):
+def write_submesh(args):
+    mesh_arrays, path = args
+    write_obj(path, *mesh_arrays)
+    return path
+
+def cut_and_save_mesh(file_path, output_directory, z_heights, num_processes=4):
+    """
+    Cut the mesh at all z_heights in one pass, keep the largest connected piece of every band and write the bands in parallel.
+    """
     # sort z height ascending
-    z_heights.sort()
+    z_heights = np.sort(np.asarray(z_heights, dtype=np.float64))
     # binary file
     mesh = o3d.io.read_triangle_mesh(file_path, print_progress=True)
     original_name = os.path.splitext(os.path.basename(file_path))[0]
+    mesh_arrays = (np.asarray(mesh.vertices), np.asarray(mesh.triangles).astype(np.int64), np.asarray(mesh.vertex_normals), np.asarray(mesh.vertex_colors), np.asarray(mesh.triangle_uvs))
+    vertices, triangles = mesh_arrays[0], mesh_arrays[1]
 
-    previous_mesh = mesh
-    cut_counter = 0
-    
-    for z in z_heights:
-        upper_mesh, lower_mesh = cut_mesh_at_height(previous_mesh, z)
-        
-        upper_file_name = f"cuts/working_thaumato_cut{cut_counter+1}/{original_name}.obj"
-        lower_file_name = f"cuts/working_thaumato_cut{cut_counter}/{original_name}.obj"
+    bands = triangle_z_bands(vertices, triangles, z_heights)
+    in_band = np.flatnonzero(bands >= 0)
+    keep = in_band[largest_component_mask(vertices, triangles[in_band], bands[in_band])]
 
-        os.makedirs(os.path.join(output_directory, "cuts"), exist_ok=True)
-        os.makedirs(os.path.join(output_directory, f"cuts/working_thaumato_cut{cut_counter}"), exist_ok=True)
+    # All band submeshes from one sort of the kept triangles by band
+    keep = keep[np.argsort(bands[keep], kind='stable')]
+    band_starts = np.searchsorted(bands[keep], np.arange(len(z_heights) + 2))
+    tasks = []
+    for cut_counter in range(len(z_heights) + 1):
         os.makedirs(os.path.join(output_directory, f"cuts/working_thaumato_cut{cut_counter}/layers"), exist_ok=True)
-        lower_mesh = largest_cluster(lower_mesh)
-        o3d.io.write_triangle_mesh(os.path.join(output_directory, lower_file_name), lower_mesh)
-        if cut_counter >= len(z_heights) - 1:
-            os.makedirs(os.path.join(output_directory, f"cuts/working_thaumato_cut{cut_counter+1}"), exist_ok=True)
-            os.makedirs(os.path.join(output_directory, f"cuts/working_thaumato_cut{cut_counter+1}/layers"), exist_ok=True)
-            upper_mesh = largest_cluster(upper_mesh)
-            o3d.io.write_triangle_mesh(os.path.join(output_directory, upper_file_name), upper_mesh)
+        band_triangles = keep[band_starts[cut_counter]:band_starts[cut_counter+1]]
+        file_name = os.path.join(output_directory, f"cuts/working_thaumato_cut{cut_counter}/{original_name}.obj")
+        tasks.append((submesh_arrays(mesh_arrays, band_triangles), file_name))
 
-        previous_mesh = upper_mesh
-        cut_counter += 1
+    with Pool(processes=max(1, min(num_processes, len(tasks)))) as pool:
+        for path in pool.imap_unordered(write_submesh, tasks):
+            print(f"Saved {path}")
 
 def main():
     parser = argparse.ArgumentParser(description="Cut a 3D mesh at specified z-heights and save the parts.")
     parser.add_argument("input_path", type=str, help="Path to the .obj file.")
     parser.add_argument("--output_directory", type=str, default=None, help="Directory where the cut meshes will be saved. Default is the same directory as the input.")
     parser.add_argument("z_heights", type=float, nargs='+', help="List of z-heights to cut the mesh at. For example: 0.2 0.4 0.6")
+    parser.add_argument("--num_processes", type=int, default=4, help="Number of processes writing the cut meshes.")
     
     args = parser.parse_args()
 
     if args.output_directory is None:
         args.output_directory = os.path.dirname(args.input_path)
 
-    cut_and_save_mesh(args.input_path, args.output_directory, args.z_heights)
+    cut_and_save_mesh(args.input_path, args.output_directory, args.z_heights, num_processes=args.num_processes)
 
 if __name__ == "__main__":
     main()
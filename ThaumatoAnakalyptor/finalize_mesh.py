@@ -4,7 +4,9 @@ import open3d as o3d
 import numpy as np
 import argparse
 import os
+from multiprocessing import Pool
 from PIL import Image
+from .obj_io import read_obj_mesh, write_obj_mesh, write_mtl
 # max image size None
 Image.MAX_IMAGE_PIXELS = None
 
@@ -12,7 +14,7 @@ def load_obj(path: str, delauny=False) -> o3d.geometry.TriangleMesh:
     """
     Load an .obj file and return the TriangleMesh object.
     """
-    mesh = o3d.io.read_triangle_mesh(path)
+    mesh = read_obj_mesh(path)
 
     # png 
     path_png = path[:-4] + "_0.png"
@@ -26,18 +28,7 @@ def load_obj(path: str, delauny=False) -> o3d.geometry.TriangleMesh:
 
 def create_mtl_file(mtl_path, texture_image_name):
     texture_image_name = texture_image_name.split(".")[0] + "_0." + texture_image_name.split(".")[-1]
-    content = f"""# Material file generated by ThaumatoAnakalyptor
-    newmtl default
-    Ka 1.0 1.0 1.0
-    Kd 1.0 1.0 1.0
-    Ks 0.0 0.0 0.0
-    illum 2
-    d 1.0
-    map_Kd {texture_image_name}
-    """
-
-    with open(mtl_path, 'w') as file:
-        file.write(content)
+    write_mtl(mtl_path, texture_image_name)
 
 def save_obj_(path: str, mesh: o3d.geometry.TriangleMesh):
     """
@@ -50,8 +41,9 @@ def save_obj_(path: str, mesh: o3d.geometry.TriangleMesh):
     # make folder if not exists
     os.makedirs(os.path.dirname(path), exist_ok=True)
     # Save the mesh to an .obj file
-    o3d.io.write_triangle_mesh(path, mesh)
-    create_mtl_file(path.replace("obj", "mtl"), path.split("/")[-1].split(".")[0] + ".png")
+    mtl_path = path.replace("obj", "mtl")
+    write_obj_mesh(path, mesh, mtl_name=os.path.basename(mtl_path))
+    create_mtl_file(mtl_path, path.split("/")[-1].split(".")[0] + ".png")
 
 def save_mesh(path, mesh, size_texture):
     save_obj_(path, mesh)
@@ -82,86 +74,85 @@ def normalize_uv_coordinates(uvs):
         uvs /= max_uv
     return uvs
 
-def cut_mesh_size(mesh, texture_size, min_x, cut_size):
+def uv_chunks(triangle_uvs, texture_size, cut_size):
     """
-    Cut a mesh into pieces along the x-axis
-    cut size in frame of texture
+    Chunk index along the texture x-axis of every triangle, in one pass over the uvs.
+    A triangle belongs to the chunk [i * cut_size, (i + 1) * cut_size] containing all three of its uvs, triangles crossing a chunk border get -1.
     """
-    max_x = min_x + cut_size
-
     texture_size = np.array(texture_size)
+    nr_chunks = max(1, int(np.ceil(texture_size[0] / cut_size)))
     # Uv of the texture
-    uvs = np.asarray(mesh.triangle_uvs)
-    uv_scaled = uvs * texture_size
+    uv_x = (np.asarray(triangle_uvs)[:, 0] * texture_size[0]).reshape(-1, 3)
+    min_x = np.min(uv_x, axis=1)
+    max_x = np.max(uv_x, axis=1)
+
+    chunks = np.minimum(np.floor(min_x / cut_size).astype(np.int64), nr_chunks - 1)
+    inside = (min_x >= 0.0) & (max_x <= (chunks + 1) * cut_size)
+    chunks[~inside] = -1
+    return chunks, nr_chunks
+
+def cut_mesh_chunk(mesh_arrays, texture_size, triangle_indices):
+    """
+    Arrays (vertices, normals, triangles, normalized uvs) of the sub mesh made of triangle_indices and its texture size.
+    Only the vertices referenced by the chunk are kept, in their original order.
+    """
+    vertices, normals, triangles, triangle_uvs = mesh_arrays
+    chunk_triangles = triangles[triangle_indices]
+    vertex_indices, remapped = np.unique(chunk_triangles, return_inverse=True)
+    chunk_triangles = remapped.reshape(-1, 3).astype(np.int32)
+
+    uv_indices = (3 * triangle_indices[:, None] + np.arange(3)).reshape(-1)
+    uv_scaled = triangle_uvs[uv_indices] * np.array(texture_size)
+    cut_mesh_texture_size = np.max(uv_scaled, axis=0) - np.min(uv_scaled, axis=0)
 
-    print(f"Number uvs: {len(uv_scaled)}")
+    chunk_normals = normals[vertex_indices] if len(normals) > 0 else normals
+    return (vertices[vertex_indices], chunk_normals, chunk_triangles, normalize_uv_coordinates(uv_scaled)), cut_mesh_texture_size
 
-    # Function to cut the mesh into pieces along the x-axis
+def cut_meshes(mesh, texture_size, cut_size):
+    """
+    Cut a mesh into pieces along the texture x-axis.
+    cut size in frame of texture
+    Triangles are binned into their chunk once and every chunk is remapped to its own vertices, without copying the full mesh per chunk.
+    """
     vertices = np.asarray(mesh.vertices)
     normals = np.asarray(mesh.vertex_normals)
     triangles = np.asarray(mesh.triangles)
-    
-    # Create a mask for vertices within the specified x range
-    uvs_mask_ = (uv_scaled[:, 0] >= min_x) & (uv_scaled[:, 0] <= max_x)
-    triangles_mask = uvs_mask_.reshape(-1, 3)
-    print(f"Sum of triangles mask: {np.sum(triangles_mask)}, with shape {triangles_mask.shape}")
-    # Select vertices and triangles within the x range
-    triangles_mask = np.all(triangles_mask, axis=1)
-    uvs_mask = triangles_mask.repeat(3).reshape(-1)
-
-    selected_uvs = uv_scaled[uvs_mask]
-    selected_triangles = triangles[triangles_mask]
-
-    # Create a new mesh with the selected vertices and triangles
-    cut_mesh = o3d.geometry.TriangleMesh()
-    cut_mesh.vertices = o3d.utility.Vector3dVector(vertices)
-    cut_mesh.vertex_normals = o3d.utility.Vector3dVector(normals)
-    cut_mesh.triangles = o3d.utility.Vector3iVector(selected_triangles)
-    cut_mesh.triangle_uvs = o3d.utility.Vector2dVector(selected_uvs)
-    cut_mesh = cut_mesh.remove_unreferenced_vertices()
-
-    # white tif of size 1x1
-    tif = np.ones((int(np.ceil(1)), int(np.ceil(1)), 3), dtype=np.uint8)
-    
-    # Convert the numpy array to an Open3D Image and assign it as the mesh texture
-    texture = o3d.geometry.Image(tif)
-    cut_mesh.textures = [texture]
+    triangle_uvs = np.asarray(mesh.triangle_uvs)
+    mesh_arrays = (vertices, normals, triangles, triangle_uvs)
 
-    cut_mesh_texture_size = np.array([np.max(selected_uvs[:,0]) - np.min(selected_uvs[:,0]), np.max(selected_uvs[:,1]) - np.min(selected_uvs[:,1])])
-
-    print(f"Cut mesh from {min_x} to {max_x} with texture size {cut_mesh_texture_size[0]} to {cut_mesh_texture_size[1]} along the x-axis with {len(np.asarray(cut_mesh.vertices))} vertices and {len(np.asarray(cut_mesh.triangles))} triangles")
-    return cut_mesh, cut_mesh_texture_size
+    total_vertices = len(vertices)
+    print(f"Total vertices in mesh: {total_vertices}")
+    print(f"Number uvs: {len(triangle_uvs)}")
 
-def cut_meshes(mesh, texture_size, cut_size):
-    # Calculate min and max x from the mesh
-    min_x = 0.0
-    max_x = texture_size[0]
+    chunks, nr_chunks = uv_chunks(triangle_uvs, texture_size, cut_size)
+    # Triangles grouped by chunk, in their original order within a chunk
+    order = np.argsort(chunks, kind='stable')
+    chunk_starts = np.searchsorted(chunks[order], np.arange(nr_chunks + 1))
 
     cut_meshes = []
-    current_min_x = min_x
-
-    total_vertices = len(np.asarray(mesh.vertices))
-    print(f"Total vertices in mesh: {total_vertices}")
     total_cut_vertices = 0
+    for i in range(nr_chunks):
+        triangle_indices = order[chunk_starts[i]:chunk_starts[i + 1]]
+        if len(triangle_indices) == 0:
+            continue
+        cut_mesh_arrays, cut_mesh_texture_size = cut_mesh_chunk(mesh_arrays, texture_size, triangle_indices)
+        nr_cut_vertices = len(cut_mesh_arrays[0])
+        total_cut_vertices += nr_cut_vertices
+        print(f"Cut mesh from {i * cut_size} to {(i + 1) * cut_size} with texture size {cut_mesh_texture_size[0]} to {cut_mesh_texture_size[1]} along the x-axis with {nr_cut_vertices} vertices and {len(triangle_indices)} triangles")
+        cut_meshes.append([cut_mesh_arrays, cut_mesh_texture_size])
 
-    while current_min_x < max_x:
-        # Cut the mesh
-        cut_mesh, cut_mesh_texture_size = cut_mesh_size(mesh, texture_size, current_min_x, cut_size)
-        if not cut_mesh.is_empty():
-            # Normalize UV coordinates of the cut mesh
-            if cut_mesh.has_triangle_uvs():
-                uvs = np.asarray(cut_mesh.triangle_uvs)
-                uvs = normalize_uv_coordinates(uvs)
-                cut_mesh.triangle_uvs = o3d.utility.Vector2dVector(uvs)
-            cut_meshes.append([cut_mesh, cut_mesh_texture_size])
-
-        current_min_x += cut_size
-        total_cut_vertices += len(np.asarray(cut_mesh.vertices))
-    
     print(f"Cut mesh into {len(cut_meshes)} pieces with {total_cut_vertices} vertices out of {total_vertices} vertices in the original mesh")
 
     return cut_meshes
 
+def build_cut_mesh(cut_mesh_arrays):
+    vertices, normals, triangles, triangle_uvs = cut_mesh_arrays
+    cut_mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(vertices), o3d.utility.Vector3iVector(triangles))
+    if len(normals) > 0:
+        cut_mesh.vertex_normals = o3d.utility.Vector3dVector(normals)
+    cut_mesh.triangle_uvs = o3d.utility.Vector2dVector(triangle_uvs)
+    return cut_mesh
+
 def save_cut(i, output_filename, cut_mesh, cut_mesh_texture_size):
     if not os.path.exists(os.path.dirname(output_filename)):
         os.makedirs(os.path.dirname(output_filename), exist_ok=True)
@@ -173,6 +164,11 @@ def save_cut(i, output_filename, cut_mesh, cut_mesh_texture_size):
 
     print(f"Saved cut mesh piece {i} to {output_filename}")
 
+def save_cut_worker(args):
+    i, output_filename, cut_mesh_arrays, cut_mesh_texture_size = args
+    save_cut(i, output_filename, build_cut_mesh(cut_mesh_arrays), cut_mesh_texture_size)
+    return len(cut_mesh_arrays[0])
+
 def main(args):
     output_folder = args.output_folder if args.output_folder is not None else "/".join(os.path.dirname(args.input_mesh).split("/")[:-1]) + "/working"
     # Ensure output directory exists
@@ -190,13 +186,16 @@ def main(args):
     # Cut mesh into pieces and normalize UVs
     cut_mesh_list = cut_meshes(mesh, texture_size, args.cut_size)
 
-    # Save each cut piece and adjust the texture if necessary
-    for i, (cut_mesh, cut_mesh_texture_size) in enumerate(cut_mesh_list):
-        start_point = args.input_mesh.split("/")[-2]
+    # Save the cut pieces in parallel
+    start_point = args.input_mesh.split("/")[-2]
+    tasks = []
+    for i, (cut_mesh_arrays, cut_mesh_texture_size) in enumerate(cut_mesh_list):
         working_folder = f"working_{start_point}" + (f"_{i}" if i > 0 else "")
         output_filename = os.path.join(output_folder, working_folder, f"{mesh_filename.split('.')[0]}.obj")
-        save_cut(i, output_filename, cut_mesh, cut_mesh_texture_size)
-        
+        tasks.append((i, output_filename, cut_mesh_arrays, cut_mesh_texture_size))
+    with Pool(processes=max(1, min(args.num_processes, len(tasks)))) as pool:
+        nr_vertices = pool.map(save_cut_worker, tasks)
+    print(f"Saved {len(nr_vertices)} cut mesh pieces with {sum(nr_vertices)} vertices")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Scale and cut a mesh into pieces, normalize UVs, and handle textures")
@@ -205,6 +204,7 @@ if __name__ == "__main__":
     parser.add_argument("--cut_size", type=float, help="Size of each cut piece along the X axis", default=20000.0)
     parser.add_argument("--delauny", action="store_true", help="Use Delauny triangulation")
     parser.add_argument("--output_folder", type=str, help="Folder to save the cut meshes", default=None)
+    parser.add_argument("--num_processes", type=int, help="Number of processes writing the cut meshes", default=4)
 
     args = parser.parse_args()
     main(args)
@@ -2,6 +2,7 @@
 
 import open3d as o3d
 import numpy as np
+from .mesh_cleaning import short_edge_triangles_mask
 
 def load_mesh(path):
     mesh = o3d.io.read_triangle_mesh(path)
@@ -30,30 +31,17 @@ def find_degenerated_triangles_and_delete(mesh, threshold=0.001):
     print(count_org.shape, vertices.shape)
     print(f"Found {len(unique_vertices)} unique vertices, max count is {np.max(count)}")
     triangles = np.asarray(mesh.triangles)
-    indices_to_remove = []
-    for indx, triangle in enumerate(triangles):
-        idx1_pos = vertices[triangle[0]]
-        idx2_pos = vertices[triangle[1]]
-        idx3_pos = vertices[triangle[2]]
-
-        idx1_bad = abs(np.linalg.norm(idx1_pos - idx2_pos)) < threshold
-        idx2_bad = abs(np.linalg.norm(idx2_pos - idx3_pos)) < threshold
-        idx3_bad = abs(np.linalg.norm(idx3_pos - idx1_pos)) < threshold
-        if idx1_bad or idx2_bad or idx3_bad:
-            print(f"Found degenerated triangle {indx} with vertices {triangle}")
-            indices_to_remove.append(indx)
+    # Triangles with an edge shorter than threshold
+    mask_degenerated = short_edge_triangles_mask(vertices, triangles, threshold)
+    print(f"Found {np.sum(mask_degenerated)} degenerated triangles")
 
     # find all triangles containing vertices with count > 1
     mask_count_greater_one = count_org[triangles]
     print(mask_count_greater_one.shape)
     mask_bad_triangles_vertices = np.any(mask_count_greater_one > 1, axis=1)
     print(mask_bad_triangles_vertices.shape)
-    trinagles_bad_indices = np.where(mask_bad_triangles_vertices)[0]
-    triangles_bad = triangles[mask_bad_triangles_vertices]
-    print(triangles_bad.shape)
 
-    indices_to_remove += list(trinagles_bad_indices)
-    indices_to_remove = list(set(indices_to_remove))
+    indices_to_remove = np.flatnonzero(np.logical_or(mask_degenerated, mask_bad_triangles_vertices))
     print(f"Removing {len(indices_to_remove)} triangles")
     mesh.remove_triangles_by_index(indices_to_remove)
     mesh = mesh.remove_duplicated_triangles()
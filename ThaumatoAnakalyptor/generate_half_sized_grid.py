@@ -1,12 +1,20 @@
 ### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
 
 import os
+import json
+import time
 import shutil
+import tempfile
+from collections import deque
 from tqdm import tqdm
 import tifffile
 import numpy as np
 from skimage.transform import resize
 from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+# Version of the grid manifest format, bump when the layout changes
+GRID_MANIFEST_VERSION = 1
 
 
 def downsample_folder_tifs_singlethreaded(input_directory, output_directory, downsample_factor=2):
@@ -155,18 +163,21 @@ def downsample_folder_tifs(input_directory, output_directory, downsample_factor=
 
 #     print('Grid blocks have been generated.')
 
+def block_filename(bz, by, bx):
+    # The filename indicates the block indices, which are 1-indexed for Julia
+    return f"cell_yxz_{by+1:03}_{bx+1:03}_{bz+1:03}.tif"
+
 def process_block(args):
     bz, by, bx, directory_path, block_size, nz, ny, nx, tif_files, standard_size = args
     block_directory = directory_path + '_grids'
     block = np.zeros((block_size, block_size, block_size), dtype=np.uint16)
-    block_filename = f"cell_yxz_{by+1:03}_{bx+1:03}_{bz+1:03}.tif"
-    block_path = os.path.join(block_directory, block_filename)
+    block_path = os.path.join(block_directory, block_filename(bz, by, bx))
 
     if os.path.exists(block_path) and os.path.getsize(block_path) == standard_size:
-        print(f"'{block_filename}' already exists in the output directory. Skipping.")
+        print(f"'{os.path.basename(block_path)}' already exists in the output directory. Skipping.")
         return  # Skip if file exists and size matches
     elif os.path.exists(block_path):
-        print(f"Warning: '{block_filename}' exists but has the wrong size. Overwriting. {os.path.getsize(block_path)} != {block_size**3 * np.uint16().itemsize}")
+        print(f"Warning: '{os.path.basename(block_path)}' exists but has the wrong size. Overwriting. {os.path.getsize(block_path)} != {block_size**3 * np.uint16().itemsize}")
 
     for z in range(block_size):
         z_index = bz * block_size + z
@@ -179,44 +190,265 @@ def process_block(args):
 
     tifffile.imwrite(block_path, block)
 
-def generate_grid_blocks(directory_path, block_size):
-    block_directory = directory_path + '_grids'
-    os.makedirs(block_directory, exist_ok=True)
+class GridManifest():
+    """
+    Record of the grid blocks that were completely written, for resuming an interrupted grid generation.
+    Only valid for the same slice files, volume shape and block size.
+    """
+    def __init__(self, block_directory, source):
+        self.path = os.path.join(block_directory, "grid_manifest.json")
+        self.source = source
+        self.blocks = set()
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    manifest = json.load(f)
+                if manifest["version"] == GRID_MANIFEST_VERSION and manifest["source"] == source:
+                    self.blocks = set(manifest["blocks"])
+                else:
+                    print(f"Grid manifest {self.path} is for other slices or block size, regenerating all blocks.")
+            except (ValueError, KeyError, OSError):
+                print(f"Could not read grid manifest {self.path}, regenerating all blocks.")
+
+    def is_done(self, block_path):
+        return os.path.basename(block_path) in self.blocks and os.path.exists(block_path)
+
+    def add(self, block_paths):
+        self.blocks.update(os.path.basename(block_path) for block_path in block_paths)
+
+    def save(self):
+        # Write to a temporary file first, then rename to not leave a corrupted manifest behind
+        with open(self.path + "_temp", 'w') as f:
+            json.dump({"version": GRID_MANIFEST_VERSION, "source": self.source, "blocks": sorted(self.blocks)}, f)
+        os.replace(self.path + "_temp", self.path)
+
+def read_slice(image_path):
+    return tifffile.imread(image_path)
+
+def imap_bounded(pool, func, items, window):
+    """
+    Ordered pool.imap with at most window items in flight, results do not pile up faster than they are consumed.
+    """
+    pending = deque()
+    for item in items:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def write_block(args):
+    block_path, block = args
+    # Write to a temporary file first, a block in the output directory is always complete.
+    # The temporary name does not end in .tif, so the cell scanners never pick up a partial block
+    tifffile.imwrite(block_path + "_temp", block)
+    os.replace(block_path + "_temp", block_path)
+
+def generate_grid_blocks(directory_path, block_size, memory_budget_gb=32.0, num_threads=None):
+    """
+    Generate the grid blocks of a folder of z slices. Streams z slabs of block_size slices, every slice is decoded once
+    and scattered into all blocks of its slab. If a slab does not fit into memory_budget_gb, it is processed in bands of block rows,
+    decoding the slices once per band. Returns the number of decoded slices and written blocks.
+    """
     tif_files = sorted([f for f in os.listdir(directory_path) if f.endswith('.tif')])
-
     sample_image = tifffile.imread(os.path.join(directory_path, tif_files[0]))
-    nz, ny, nx = len(tif_files), *sample_image.shape
+    source = {"tif_files": [tif_files[0], tif_files[-1], len(tif_files)]}
+    return write_grid_blocks(directory_path + '_grids', [os.path.join(directory_path, f) for f in tif_files], sample_image.shape, block_size, source, read_slice=read_slice, memory_budget_gb=memory_budget_gb, num_threads=num_threads)
+
+def write_grid_blocks(block_directory, slice_items, slice_shape, block_size, source, read_slice=read_slice, memory_budget_gb=32.0, num_threads=None):
+    """
+    Stream the slices read_slice(slice_items[z]) into grid blocks, see generate_grid_blocks.
+    source identifies the input in the manifest.
+    """
+    os.makedirs(block_directory, exist_ok=True)
+    nz, ny, nx = len(slice_items), *slice_shape
     blocks_in_x, blocks_in_y, blocks_in_z = (int(np.ceil(d / block_size)) for d in (nx, ny, nz))
 
-    # Get standard_size. is -1 if not at least two cells exist and first two not having the same size
-    standard_size = -1
-    # get grid cells
-    grid_cells = [f for f in os.listdir(directory_path + '_grids') if f.endswith('.tif') and f.startswith('cell_yxz_')]
-    if len(grid_cells) >= 2:
-        # get first two grid cells
-        grid_cell_1 = tifffile.imread(os.path.join(directory_path + '_grids', grid_cells[0]))
-        grid_cell_1_size = os.path.getsize(os.path.join(directory_path + '_grids', grid_cells[0]))
-        grid_cell_2 = tifffile.imread(os.path.join(directory_path + '_grids', grid_cells[1]))
-        grid_cell_2_size = os.path.getsize(os.path.join(directory_path + '_grids', grid_cells[1]))
-        if grid_cell_1.shape == grid_cell_2.shape and grid_cell_1_size == grid_cell_2_size:
-            standard_size = grid_cell_1_size
-            print(f"Found standard size: {standard_size}")
-
-    tasks = [(bz, by, bx, directory_path, block_size, nz, ny, nx, tif_files, standard_size) 
-             for bz in range(blocks_in_z) for by in range(blocks_in_y) for bx in range(blocks_in_x)]
-
-    # multiprocessing
-    num_pools = max(1, cpu_count() // 3)
-    with Pool(processes=num_pools) as pool:
-        for _ in tqdm(pool.imap_unordered(process_block, tasks), total=len(tasks)):
-            pass
-
-    # # singlethreaded
-    # print("going singlethreaded")
-    # for task in tqdm(tasks):
-    #     process_block(task)
-
-    print('Grid blocks have been generated.')
+    num_threads = num_threads if num_threads is not None else max(1, cpu_count() // 3)
+    # Number of block rows per band that fit into the memory budget, the slab band is padded to full blocks.
+    # The budget also holds the decoded slices read ahead: num_threads in flight and the one copied into the band
+    band_bytes = block_size * block_size * blocks_in_x * block_size * np.dtype(np.uint16).itemsize
+    read_ahead_bytes = (num_threads + 1) * ny * nx * np.dtype(np.uint16).itemsize
+    band_rows = int(np.clip((memory_budget_gb * 1e9 - read_ahead_bytes) // band_bytes, 1, blocks_in_y))
+    print(f"Streaming {blocks_in_z} slabs in bands of {band_rows} block rows ({band_rows * band_bytes / 1e9:.2f} GB per band, {read_ahead_bytes / 1e9:.2f} GB read ahead)")
+
+    manifest = GridManifest(block_directory, {**source, "shape": [nz, ny, nx], "block_size": block_size})
+    band = None
+    nr_decoded_slices = 0
+    nr_written_blocks = 0
+    time_read = 0.0
+    time_write = 0.0
+    with ThreadPool(num_threads) as pool:
+        for bz in tqdm(range(blocks_in_z)):
+            z_items = slice_items[bz * block_size:min((bz + 1) * block_size, nz)]
+            for by_start in range(0, blocks_in_y, band_rows):
+                by_end = min(by_start + band_rows, blocks_in_y)
+                block_indices = [(by, bx) for by in range(by_start, by_end) for bx in range(blocks_in_x)]
+                block_paths = [os.path.join(block_directory, block_filename(bz, by, bx)) for by, bx in block_indices]
+                if all(manifest.is_done(block_path) for block_path in block_paths):
+                    continue
+                
+                time_start = time.time()
+                if band is None:
+                    band = np.zeros((block_size, band_rows * block_size, blocks_in_x * block_size), dtype=np.uint16)
+                # Zero padding of the last slab and of the volume border
+                band.fill(0)
+                y_start, y_end = by_start * block_size, min(by_end * block_size, ny)
+                for z, image_slice in enumerate(imap_bounded(pool, read_slice, z_items, num_threads)):
+                    band[z, :y_end - y_start, :nx] = image_slice[y_start:y_end]
+                nr_decoded_slices += len(z_items)
+                time_read += time.time() - time_start
+
+                time_start = time.time()
+                blocks = []
+                for (by, bx), block_path in zip(block_indices, block_paths):
+                    if manifest.is_done(block_path):
+                        continue
+                    y0, x0 = (by - by_start) * block_size, bx * block_size
+                    blocks.append((block_path, band[:, y0:y0 + block_size, x0:x0 + block_size]))
+                for _ in pool.imap_unordered(write_block, blocks):
+                    pass
+                nr_written_blocks += len(blocks)
+                manifest.add([block_path for block_path, _ in blocks])
+                manifest.save()
+                time_write += time.time() - time_start
+
+    print(f'Grid blocks have been generated. Decoded {nr_decoded_slices} slices for {nr_written_blocks} blocks ({nr_decoded_slices / max(nr_written_blocks, 1):.2f} slices per block).')
+    print(f"Reading slices: {time_read:.2f}s, {nr_decoded_slices / max(time_read, 1e-6):.1f} slices/s. Writing blocks: {time_write:.2f}s, {nr_written_blocks * block_size**3 * 2 / 1e6 / max(time_write, 1e-6):.1f} MB/s")
+    return nr_decoded_slices, nr_written_blocks
+
+def downsample_slice_sum(image, downsample_factor, dtype=np.uint32):
+    """
+    Sums of the downsample_factor x downsample_factor pixel blocks of a slice. Pixels beyond a multiple of the factor are dropped.
+    """
+    ny, nx = (d // downsample_factor for d in image.shape)
+    image = image[:ny * downsample_factor, :nx * downsample_factor]
+    # Strided adds are faster than a mean over a (ny, f, nx, f) reshape
+    downsampled = image[0::downsample_factor, 0::downsample_factor].astype(dtype)
+    for dy in range(downsample_factor):
+        for dx in range(downsample_factor):
+            if dy > 0 or dx > 0:
+                downsampled += image[dy::downsample_factor, dx::downsample_factor]
+    return downsampled
+
+def read_downsampled_slice(args):
+    """
+    Read the slices in image_paths, block mean downsample them and average them along z. Integer sums, rounded to the nearest value.
+    """
+    image_paths, downsample_factor = args
+    nr_values = downsample_factor * downsample_factor * len(image_paths)
+    dtype = np.uint32 if nr_values * 65535 < 2**32 else np.uint64
+    downsampled = None
+    for image_path in image_paths:
+        image = downsample_slice_sum(tifffile.imread(image_path), downsample_factor, dtype=dtype)
+        downsampled = image if downsampled is None else downsampled + image
+    return ((downsampled + nr_values // 2) // nr_values).astype(np.uint16)
+
+def generate_downsampled_grid_blocks(input_directory, output_directory, downsample_factor, block_size=500, z_average=False, memory_budget_gb=32.0, num_threads=None):
+    """
+    Fused downsampling and grid block generation, no downsampled slices are written to disk.
+    Slices are downsampled by the block mean. Every downsample_factor-th slice is kept, with z_average the skipped slices are averaged in instead of dropped.
+    Writes the same grid blocks directory (output_directory + '_grids') as downsample_folder_tifs followed by generate_grid_blocks.
+    """
+    files = {int(f.split('.')[0]): f for f in os.listdir(input_directory) if f.endswith('.tif')}
+    indices = sorted(i for i in files if i % downsample_factor == 0)
+    print(f"Found {len(indices)} tif files to downsample into the grid.")
+    # Check that all downsample_factor-th tif from min to max are present
+    for i in range(indices[0], indices[-1] + 1, downsample_factor):
+        if i not in files:
+            raise Exception(f"Missing tif number {i}")
+
+    slice_items = []
+    for i in indices:
+        slice_indices = range(i, i + downsample_factor) if z_average else [i]
+        slice_items.append(([os.path.join(input_directory, files[j]) for j in slice_indices if j in files], downsample_factor))
+
+    sample_image = tifffile.imread(slice_items[0][0][0])
+    slice_shape = tuple(d // downsample_factor for d in sample_image.shape)
+    source = {"tif_files": [files[indices[0]], files[indices[-1]], len(indices)], "downsample_factor": downsample_factor, "z_average": z_average}
+    return write_grid_blocks(output_directory + '_grids', slice_items, slice_shape, block_size, source, read_slice=read_downsampled_slice, memory_budget_gb=memory_budget_gb, num_threads=num_threads)
+
+def benchmark_grid_blocks(nz=96, ny=300, nx=260, block_size=32, memory_budget_gb=32.0):
+    """
+    Compare the slab streaming grid generation against the per block generation (process_block) on a synthetic volume.
+    Reports the slices decoded per block written and checks that both produce the same blocks.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory_path = os.path.join(temp_dir, "volume")
+        os.makedirs(directory_path)
+        for z in range(nz):
+            tifffile.imwrite(os.path.join(directory_path, f"{z:05}.tif"), rng.integers(0, 65535, (ny, nx), dtype=np.uint16))
+        tif_files = sorted([f for f in os.listdir(directory_path) if f.endswith('.tif')])
+        blocks_in_x, blocks_in_y, blocks_in_z = (int(np.ceil(d / block_size)) for d in (nx, ny, nz))
+        nr_blocks = blocks_in_x * blocks_in_y * blocks_in_z
+
+        # Per block: every block decodes its block_size slices
+        block_directory = directory_path + '_grids'
+        os.makedirs(block_directory, exist_ok=True)
+        time_start = time.time()
+        for bz in range(blocks_in_z):
+            for by in range(blocks_in_y):
+                for bx in range(blocks_in_x):
+                    process_block((bz, by, bx, directory_path, block_size, nz, ny, nx, tif_files, -1))
+        time_per_block = time.time() - time_start
+        nr_decoded_per_block = sum(min(block_size, nz - bz * block_size) for bz in range(blocks_in_z)) * blocks_in_y * blocks_in_x
+        per_block_blocks = {f: tifffile.imread(os.path.join(block_directory, f)) for f in os.listdir(block_directory) if f.startswith('cell_yxz_')}
+        shutil.rmtree(block_directory)
+
+        time_start = time.time()
+        nr_decoded_slab, nr_written_slab = generate_grid_blocks(directory_path, block_size, memory_budget_gb=memory_budget_gb)
+        time_slab = time.time() - time_start
+        for f, block in per_block_blocks.items():
+            assert np.array_equal(block, tifffile.imread(os.path.join(block_directory, f))), f"Block {f} differs between per block and slab streaming generation"
+
+        # Resume: everything is in the manifest, nothing is decoded
+        nr_decoded_resume, _ = generate_grid_blocks(directory_path, block_size, memory_budget_gb=memory_budget_gb)
+        assert nr_decoded_resume == 0, "Resuming a complete grid decoded slices"
+
+    print(f"{nr_blocks} blocks of size {block_size} from {nz} slices of {ny}x{nx}")
+    print(f"per block:      {nr_decoded_per_block / nr_blocks:8.2f} slices decoded per block written, {time_per_block:.2f}s")
+    print(f"slab streaming: {nr_decoded_slab / max(nr_written_slab, 1):8.2f} slices decoded per block written, {time_slab:.2f}s")
+
+def benchmark_downsampled_grid_blocks(nz=128, ny=600, nx=520, downsample_factor=2, block_size=32):
+    """
+    Throughput per stage of downsampling to tifs and then generating the grid blocks against the fused downsampling and grid block generation on a synthetic slice stack.
+    """
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_directory = os.path.join(temp_dir, "volume")
+        os.makedirs(input_directory)
+        for z in range(nz):
+            tifffile.imwrite(os.path.join(input_directory, f"{z:04}.tif"), rng.integers(0, 65535, (ny, nx), dtype=np.uint16))
+        input_mb = nz * ny * nx * 2 / 1e6
+
+        output_directory = os.path.join(temp_dir, "downsampled")
+        time_start = time.time()
+        downsample_folder_tifs(input_directory, output_directory, downsample_factor)
+        time_downsample = time.time() - time_start
+        time_start = time.time()
+        generate_grid_blocks(output_directory, block_size)
+        time_grid = time.time() - time_start
+        nr_blocks = len([f for f in os.listdir(output_directory + '_grids') if f.startswith('cell_yxz_')])
+        shutil.rmtree(output_directory + '_grids')
+
+        results = []
+        for z_average in (False, True):
+            time_start = time.time()
+            generate_downsampled_grid_blocks(input_directory, output_directory, downsample_factor, block_size=block_size, z_average=z_average)
+            results.append(time.time() - time_start)
+            assert nr_blocks == len([f for f in os.listdir(output_directory + '_grids') if f.startswith('cell_yxz_')]), "Fused grid has a different number of blocks"
+            # Check the first block against the block mean of the input slices
+            block = tifffile.imread(os.path.join(output_directory + '_grids', block_filename(0, 0, 0)))
+            image_paths = [os.path.join(input_directory, f"{z:04}.tif") for z in range(downsample_factor if z_average else 1)]
+            assert np.array_equal(block[0], read_downsampled_slice((image_paths, downsample_factor))[:block_size, :block_size]), "Fused grid block differs from the block mean"
+            shutil.rmtree(output_directory + '_grids')
+
+    print(f"{nz} slices of {ny}x{nx}, downsample factor {downsample_factor}, {nr_blocks} blocks of size {block_size}")
+    print(f"{'downsample to tifs':>28}: {time_downsample:8.2f}s, {input_mb / max(time_downsample, 1e-6):8.1f} MB/s input")
+    print(f"{'grid from tifs':>28}: {time_grid:8.2f}s, {input_mb / max(time_grid, 1e-6):8.1f} MB/s input")
+    print(f"{'fused':>28}: {results[0]:8.2f}s, {input_mb / max(results[0], 1e-6):8.1f} MB/s input")
+    print(f"{'fused with z averaging':>28}: {results[1]:8.2f}s, {input_mb / max(results[1], 1e-6):8.1f} MB/s input")
 
 def fix_zyx(original_directory, new_directory):
     # Create new directory if it does not exist
@@ -305,7 +537,10 @@ def fix_xy_transpose(original_directory, new_directory):
             tifffile.imwrite(new_filepath, image)
     print('XY transposition has been completed.')
 
-def compute(input_directory, output_directory, downsample_factor):
+def compute(input_directory, output_directory, downsample_factor, fused=False, z_average=False):
+    if fused and downsample_factor > 1:
+        generate_downsampled_grid_blocks(input_directory, output_directory, downsample_factor, block_size=500, z_average=z_average)
+        return
     downsample_folder_tifs(input_directory, output_directory, downsample_factor)
     generate_grid_blocks(output_directory, 500)
 
@@ -320,10 +555,20 @@ def main():
     parser.add_argument("--input_directory", type=str, help="Path to the input directory containing the tif files", default=input_directory)
     parser.add_argument("--output_directory", type=str, help="Path to the output directory", default=output_directory)
     parser.add_argument("--downsample_factor", type=int, help="Downsample factor (int)", default=downsample_factor)
+    parser.add_argument("--fused", action="store_true", help="Downsample by block mean directly into the grid blocks, without writing downsampled tifs")
+    parser.add_argument("--z_average", action="store_true", help="With --fused, average the skipped slices in z instead of dropping them")
+    parser.add_argument("--benchmark", type=str, choices=["grid", "fused"], help="Benchmark the slab streaming grid generation or the fused downsampling on a synthetic volume instead", default=None)
 
     # Take arguments back over
     args = parser.parse_args()
 
+    if args.benchmark == "grid":
+        benchmark_grid_blocks()
+        return
+    if args.benchmark == "fused":
+        benchmark_downsampled_grid_blocks()
+        return
+
     # Print the arguments
     print(f"Arguments for generating downsampled grid cells: \n{args}")
 
@@ -332,7 +577,7 @@ def main():
     downsample_factor = args.downsample_factor
 
     # Compute the downsampled tifs and grid blocks
-    compute(input_directory, output_directory, downsample_factor)
+    compute(input_directory, output_directory, downsample_factor, fused=args.fused, z_average=args.z_average)
 
 if __name__ == '__main__':
     main()
@@ -15,6 +15,8 @@ import torch
 torch.set_float32_matmul_precision('medium')
 from scipy.interpolate import interp1d
 from .add_random_colors_to_pointcloud import add_random_colors
+from .umbilicus_interpolation import umbilicus_lookup
+from .sort_out_empty_tifs import load_empty_cells
 # import torch.multiprocessing as multiprocessing
 import multiprocessing
 import glob
@@ -43,12 +45,13 @@ def cleanup_temp_files(directory):
     else:
         print("No leftover .temp files found.")
 
-def load_grid(path_template, cords, grid_block_size=500, cell_block_size=500, uint8=True):
+def load_grid(path_template, cords, grid_block_size=500, cell_block_size=500, uint8=True, empty_cells=None):
         """
         path_template: Template for the path to load individual grid files
         cords: Tuple (x, y, z) representing the corner coordinates of the grid block
         grid_block_size: Size of the grid block
         cell_block_size: Size of the individual grid files
+        empty_cells: Filenames of empty grid files (from the cell stats index), treated like missing files
         """
         # make grid_block_size an array with 3 elements
         if isinstance(grid_block_size, int):
@@ -76,6 +79,8 @@ def load_grid(path_template, cords, grid_block_size=500, cell_block_size=500, ui
                     if not os.path.exists(path):
                         # print(f"File {path} does not exist.")
                         continue
+                    if empty_cells is not None and os.path.basename(path) in empty_cells:
+                        continue
 
                     # Read the image
                     with tifffile.TiffFile(path) as tif:
@@ -186,20 +191,8 @@ def umbilicus_xz_at_y(points_array, y_new):
     :return: A 2D numpy array with interpolated points for each 0.1 step in the y direction.
     """
 
-    # Separate the coordinates
-    x, y, z = points_array.T
-
-    # Create interpolation functions for x and z based on y
-    fx = interp1d(y, x, kind='linear', fill_value="extrapolate")
-    fz = interp1d(y, z, kind='linear', fill_value="extrapolate")
-
-    # Calculate interpolated x and z values
-    x_new = fx(y_new)
-    z_new = fz(y_new)
-
-    # Return the combined x, y, and z values as a 2D array
-    res = np.array([x_new, y_new, z_new])
-    return res
+    # Cached lookup table of the umbilicus points, coordinates first
+    return umbilicus_lookup(points_array, axis=1).position(y_new).T
 
 # Picks block closest to the edge of the complete volume to more accurately calculate global reference vectors (less curvature outside the scroll)
 def pick_block(blocks, xy_min=2000, xy_max=6000, z_min=500, z_max=5000):
@@ -296,7 +289,9 @@ def process_block(args):
 
     if (not skip_computation_flag) and (recompute or not (os.path.exists(surface_ply_filename_r) and os.path.exists(surface_ply_filename_v))): # Recompute if file doesn't exist or recompute flag is set
         # Load padded grid block
-        block = load_grid(path_template, corner_coords_padded, grid_block_size=grid_block_size_padded)
+        # Cells below the empty threshold chosen with sort_out_empty_tifs are not read
+        empty_cells = load_empty_cells(os.path.dirname(path_template))
+        block = load_grid(path_template, corner_coords_padded, grid_block_size=grid_block_size_padded, empty_cells=empty_cells)
         # Check if the block is empty
         if np.all(block == 0):
             return False
@@ -409,6 +404,9 @@ def compute_surface_for_block_multiprocessing(corner_coords, path_template, save
     # Blocks processed: 41 Blocks to process: 52 Time per block: 2.366847770970042
     # for 4 threads: SLOWER
 
+    # Empty cells of the cell stats index, entries of cells changed since their scan are reported and those cells are read normally
+    load_empty_cells(os.path.dirname(path_template), verbose=True)
+
     pool = multiprocessing.Pool(processes=CFG['num_threads'])
 
     # Timing
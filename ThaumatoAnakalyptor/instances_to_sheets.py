@@ -1,10 +1,11 @@
 ### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
 
 import numpy as np
-import pickle
 import os
 import open3d as o3d
 import json
+import time
+import argparse
 
 # plotting
 import matplotlib
@@ -14,9 +15,9 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 import glob
-import tarfile
-import tempfile
 from .surface_fitting_utilities import get_vector_mean, rotation_matrix_to_align_z_with_v, fit_surface_to_points_n_regularized, distance_from_surface, distance_from_surface_clipped
+from .tar_index import get_tar_index, load_ply_from_tar
+from .main_sheet_store import MainSheetStore, is_main_sheet_store, load_legacy_main_sheet
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -34,46 +35,8 @@ def load_ply(filename):
     # Check that the tar file exists
     assert os.path.isfile(tar_filename), f"File {tar_filename} not found."
 
-    # Extract the desired ply and metadata files from the tarball to a temporary location
-    with tarfile.open(tar_filename, 'r') as tar:
-        # Create a temporary directory
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Construct paths to the temporary extracted files
-            temp_ply_path = os.path.join(temp_dir, ply_filename_inside_tar)
-            base_filename_without_extension = os.path.splitext(ply_filename_inside_tar)[0]
-            metadata_filename_inside_tar = f"metadata_{base_filename_without_extension}.json"
-            temp_metadata_path = os.path.join(temp_dir, metadata_filename_inside_tar)
-            
-            tar.extract(ply_filename_inside_tar, path=temp_dir)
-            tar.extract(metadata_filename_inside_tar, path=temp_dir)
-            
-            # Load the ply file
-            pcd = o3d.io.read_point_cloud(temp_ply_path)
-            
-            # Load metadata
-            with open(temp_metadata_path, 'r') as metafile:
-                metadata = json.load(metafile)
-
-            points = np.asarray(pcd.points)
-            normals = np.asarray(pcd.normals)
-            # Extract additional features
-            colors = np.asarray(pcd.colors)
-
-    # Convert lists back to numpy arrays where needed
-    if 'coeff' in metadata and metadata['coeff'] is not None:
-        coeff = np.array(metadata['coeff'])
-    else:
-        coeff = None
-    
-    if 'n' in metadata and metadata['n'] is not None:
-        n = int(metadata['n'])
-    else:
-        n = None
-
-    score = metadata.get('score')
-    distance = metadata.get('distance')
-
-    return points, normals, colors, score, distance, coeff, n
+    # Read the desired ply and metadata files directly from the tarball
+    return load_ply_from_tar(tar_filename, ply_filename_inside_tar)
 
 def load_instance(path, sample_ratio=1.0):
     """
@@ -93,29 +56,28 @@ def load_instance(path, sample_ratio=1.0):
     assert os.path.isfile(tar_filename), f"File {tar_filename} not found."
 
     # Retrieve a list of all .ply files within the tarball
-    with tarfile.open(tar_filename, 'r') as archive:
-        ply_files = [m.name for m in archive.getmembers() if m.name.endswith(".ply")]
-        # Iterate and load all instances prediction .ply files
-        for ply_file in ply_files:
-            file = os.path.join(path, ply_file)
-            res = load_ply(file)
-            points = res[0]
-            normals = res[1]
-            colors = res[2]
-            pred_score = res[3]
-            distance = res[4]
-            # Sample points from picked patch
-            points, normals, colors, _ = select_points(
-                points, normals, colors, colors, sample_ratio
-            )
-            if points.shape[0] < 10:
-                continue
-            points_list.append(points)
-            normals_list.append(normals)
-            colors_list.append(colors)
-            pred_score_list.append(pred_score)
-            distance_list.append(distance)
-            id_list.append(tuple([*map(int, file.split("/")[-2].split("_"))]+[int(file.split("/")[-1].split(".")[-2].split("_")[-1])]))
+    ply_files = [name for name in get_tar_index(tar_filename).names() if name.endswith(".ply")]
+    # Iterate and load all instances prediction .ply files
+    for ply_file in ply_files:
+        file = os.path.join(path, ply_file)
+        res = load_ply(file)
+        points = res[0]
+        normals = res[1]
+        colors = res[2]
+        pred_score = res[3]
+        distance = res[4]
+        # Sample points from picked patch
+        points, normals, colors, _ = select_points(
+            points, normals, colors, colors, sample_ratio
+        )
+        if points.shape[0] < 10:
+            continue
+        points_list.append(points)
+        normals_list.append(normals)
+        colors_list.append(colors)
+        pred_score_list.append(pred_score)
+        distance_list.append(distance)
+        id_list.append(tuple([*map(int, file.split("/")[-2].split("_"))]+[int(file.split("/")[-1].split(".")[-2].split("_")[-1])]))
     return points_list, normals_list, colors_list, pred_score_list, distance_list, id_list
 
 def angle_to_180(angle):
@@ -423,20 +385,17 @@ def subvolume_surface_patches_folder(file, subvolume_size=50, sample_ratio=1.0):
     tar_filename = f"{file}.tar"
 
     if os.path.isfile(tar_filename):
-        with tarfile.open(tar_filename, 'r') as archive, tempfile.TemporaryDirectory() as temp_dir:
-            # Extract all .ply files at once
-            ply_files = [m for m in archive.getmembers() if m.name.endswith(".ply")]
-            archive.extractall(path=temp_dir, members=archive.getmembers())
-
-            # Process each .ply file
-            for ply_member in ply_files:
-                ply_file_path = os.path.join(temp_dir, ply_member.name)
-                ply_file = ply_member.name
-                ids = tuple([*map(int, tar_filename.split(".")[-2].split("/")[-1].split("_"))]+[int(ply_file.split(".")[-2].split("_")[-1])])
-                ids = (int(ids[0]), int(ids[1]), int(ids[2]), int(ids[3]))
-                main_sheet_patch = (ids[:3], ids[3], float(0.0))
-                surface_dict, _ = build_patch_folder(main_sheet_patch, tuple(subvolume_size), ply_file_path, sample_ratio=float(sample_ratio))
-                patches_list.append(surface_dict)
+        # Members are read straight from the tar through its index
+        ply_files = [name for name in get_tar_index(tar_filename).names() if name.endswith(".ply")]
+        path = os.path.dirname(tar_filename)
+
+        # Process each .ply file
+        for ply_file in ply_files:
+            ids = tuple([*map(int, tar_filename.split(".")[-2].split("/")[-1].split("_"))]+[int(ply_file.split(".")[-2].split("_")[-1])])
+            ids = (int(ids[0]), int(ids[1]), int(ids[2]), int(ids[3]))
+            main_sheet_patch = (ids[:3], ids[3], float(0.0))
+            surface_dict, _ = build_patch(main_sheet_patch, tuple(subvolume_size), path, sample_ratio=float(sample_ratio))
+            patches_list.append(surface_dict)
 
     return patches_list
 
@@ -473,33 +432,29 @@ def subvolume_surface_patches(path, subvolume_size=50):
 
 def save_main_sheet(main_sheet, volume_blocks_scores, path="main_sheet.ta"):
     """
-    Save the main sheet to a file.
+    Save the main sheet to a chunked main sheet store. Only blocks that changed since the last save are written.
     """
-    save_sheet = {}
-    # remove points for display
-    for volume_id in main_sheet:
-        save_sheet[volume_id] = {}
-        for patch_id in main_sheet[volume_id]:
-            save_sheet[volume_id][patch_id] = {}
-            save_sheet[volume_id][patch_id]["offset_angle"] = main_sheet[volume_id][patch_id]["offset_angle"]
-
-    sheet_segmentation = {'main_sheet': save_sheet, 'volume_blocks_scores': volume_blocks_scores}
-
     # Create folder if it doesn't exist
     os.makedirs(os.path.dirname(path), exist_ok=True)
-    
-    with open(path, 'wb') as f:
-        pickle.dump(sheet_segmentation, f)
 
-def load_main_sheet(subvolume_size=50, path="", path_ta="main_sheet.ta", sample_ratio_score=0.1, sample_ratio=0.1, add_display_points=True):
+    # Only the offset angles are stored, points for display are not saved
+    store = MainSheetStore(path)
+    bytes_written, full_size = store.save(main_sheet, volume_blocks_scores)
+    print(f"Saved main sheet to {path}: {bytes_written} bytes written, full sheet {full_size} bytes.")
+
+def load_main_sheet(subvolume_size=50, path="", path_ta="main_sheet.ta", sample_ratio_score=0.1, sample_ratio=0.1, add_display_points=True, bbox=None):
     """
-    Load the main sheet from a file.
+    Load the main sheet from a file. Optionally only the blocks with ids inside the bounding box bbox = (min_xyz, max_xyz).
     """
-    with open(path_ta, 'rb') as f:
-        sheet_segmentation = pickle.load(f)
-
-    main_sheet = sheet_segmentation['main_sheet']
-    volume_blocks_scores = sheet_segmentation['volume_blocks_scores']
+    if is_main_sheet_store(path_ta):
+        store = MainSheetStore(path_ta)
+        main_sheet = store.load(bbox=bbox)
+        volume_blocks_scores = store.load_volume_blocks_scores()
+    else:
+        # Pickled main sheet (.ta) of older versions
+        main_sheet, volume_blocks_scores = load_legacy_main_sheet(path_ta)
+        if bbox is not None:
+            main_sheet = {volume_id: main_sheet[volume_id] for volume_id in main_sheet if np.all(np.array(volume_id) >= np.array(bbox[0])) and np.all(np.array(volume_id) <= np.array(bbox[1]))}
 
     # Add points and angles of main patches to main sheet
     if add_display_points:
@@ -548,19 +503,73 @@ def overlapping_tiles(patch1, patch2):
 
     return overlapping_indices
 
-def overlap_mask(patch1, patch2, index):
-    # Concatenate points from both point clouds
-    if index in patch1["tiles_points"] and index in patch2["tiles_points"]: # both tiles have points
-        mask_shape = patch1["tiles_points"][index].shape[0]
-        all_points = np.vstack([patch1["tiles_points"][index], patch2["tiles_points"][index]])
-    elif index in patch1["tiles_points"]: # only patch1 has points
-        mask_shape = patch1["tiles_points"][index].shape[0]
-        all_points = patch1["tiles_points"][index]
-    elif index in patch2["tiles_points"]: # only patch2 has points
-        mask_shape = 0
-        all_points = patch2["tiles_points"][index]
-    else: # neither patch has points
-        return np.zeros(0), np.zeros(0)
+# Voxel size of the integer keys used to find identical points of two patches
+OVERLAP_VOXEL_SIZE = 0.01
+
+def voxel_keys(points, voxel_size=OVERLAP_VOXEL_SIZE):
+    """
+    Quantize points to integer voxel keys packed into uint64 (21 bits per axis).
+    Identical points always get identical keys, different points can share a key.
+    """
+    voxels = (np.floor(points / voxel_size).astype(np.int64) & 0x1FFFFF).astype(np.uint64)
+    return (voxels[:, 0] << np.uint64(42)) | (voxels[:, 1] << np.uint64(21)) | voxels[:, 2]
+
+def patch_voxel_keys(patch):
+    """
+    Sorted voxel keys of all patch points and whether any key repeats inside the patch. Computed once per patch.
+    """
+    if "voxel_keys" not in patch:
+        sorted_keys = np.sort(voxel_keys(patch["points"]))
+        has_repeated_keys = bool(np.any(sorted_keys[1:] == sorted_keys[:-1]))
+        patch["voxel_keys"] = (sorted_keys, has_repeated_keys)
+    return patch["voxel_keys"]
+
+def tile_voxel_keys(patch, index):
+    """
+    Voxel keys of the points of a tile (in tile point order) and their sorted copy. Computed once per patch and tile.
+    """
+    if "tiles_voxel_keys" not in patch:
+        patch["tiles_voxel_keys"] = {}
+    if index not in patch["tiles_voxel_keys"]:
+        keys = voxel_keys(patch["tiles_points"][index])
+        patch["tiles_voxel_keys"][index] = (keys, np.sort(keys))
+    return patch["tiles_voxel_keys"][index]
+
+def patch_bounding_box(patch):
+    if "bounding_box" not in patch:
+        patch["bounding_box"] = (np.min(patch["points"], axis=0), np.max(patch["points"], axis=0))
+    return patch["bounding_box"]
+
+def patches_may_overlap(patch1, patch2):
+    """
+    Cheap test if two patches can share points. False only if their bounding boxes are disjoint and no patch contains repeated points.
+    """
+    if patch1["points"].shape[0] == 0 or patch2["points"].shape[0] == 0:
+        return False
+    if patch_voxel_keys(patch1)[1] or patch_voxel_keys(patch2)[1]:
+        return True
+    min1, max1 = patch_bounding_box(patch1)
+    min2, max2 = patch_bounding_box(patch2)
+    return bool(np.all(min1 <= max2) and np.all(min2 <= max1))
+
+def sorted_keys_contain(keys, sorted_keys):
+    # Membership of keys in a sorted key array by binary search
+    if sorted_keys.shape[0] == 0:
+        return np.zeros(keys.shape[0], dtype=bool)
+    positions = np.searchsorted(sorted_keys, keys)
+    positions[positions == sorted_keys.shape[0]] = 0
+    return sorted_keys[positions] == keys
+
+def sorted_keys_repeated(keys, sorted_keys):
+    # Keys that occur more than once in the sorted key array
+    return np.searchsorted(sorted_keys, keys, side='right') - np.searchsorted(sorted_keys, keys, side='left') > 1
+
+def overlap_mask_exact(points1, points2):
+    """
+    Mask of the points that occur more than once in the concatenation of both point sets.
+    """
+    mask_shape = points1.shape[0]
+    all_points = np.vstack([points1, points2])
     # Find the unique points and their counts
     unique_points, indices, counts = np.unique(all_points, axis=0, return_counts=True, return_index=True)
     # Extract overlapping points from both point clouds
@@ -574,6 +583,40 @@ def overlap_mask(patch1, patch2, index):
 
     return mask1, mask2
 
+def overlap_mask(patch1, patch2, index):
+    # Concatenate points from both point clouds
+    if index in patch1["tiles_points"] and index in patch2["tiles_points"]: # both tiles have points
+        points1 = patch1["tiles_points"][index]
+        points2 = patch2["tiles_points"][index]
+    elif index in patch1["tiles_points"]: # only patch1 has points
+        return overlap_mask_exact(patch1["tiles_points"][index], np.zeros((0, 3)))
+    elif index in patch2["tiles_points"]: # only patch2 has points
+        return overlap_mask_exact(np.zeros((0, 3)), patch2["tiles_points"][index])
+    else: # neither patch has points
+        return np.zeros(0), np.zeros(0)
+
+    # Candidate points share their voxel key with the other patch (or repeat it inside their own patch)
+    keys1, sorted_keys1 = tile_voxel_keys(patch1, index)
+    keys2, sorted_keys2 = tile_voxel_keys(patch2, index)
+    candidates1 = sorted_keys_contain(keys1, sorted_keys2)
+    candidates2 = sorted_keys_contain(keys2, sorted_keys1)
+    if patch_voxel_keys(patch1)[1]:
+        candidates1 |= sorted_keys_repeated(keys1, sorted_keys1)
+    if patch_voxel_keys(patch2)[1]:
+        candidates2 |= sorted_keys_repeated(keys2, sorted_keys2)
+
+    mask1 = np.zeros(points1.shape[0], dtype=bool)
+    mask2 = np.zeros(points2.shape[0], dtype=bool)
+    candidates1 = np.nonzero(candidates1)[0]
+    candidates2 = np.nonzero(candidates2)[0]
+    if candidates1.shape[0] == 0 and candidates2.shape[0] == 0:
+        return mask1, mask2
+
+    # Identical points always share a voxel key, exact comparison is only needed on the candidates
+    mask1[candidates1], mask2[candidates2] = overlap_mask_exact(points1[candidates1], points2[candidates2])
+
+    return mask1, mask2
+
 def compute_overlap_for_pair(args):
     i, patches_list, epsilon, angle_tolerance = args
     result_overlapps = []
@@ -581,6 +624,14 @@ def compute_overlap_for_pair(args):
         # Extract indexes of overlapping tiles
         overlap_tiles = overlapping_tiles(patches_list[i], patches_list[j])
 
+        # Patches with disjoint bounding boxes share no points, skip the overlap computation
+        if len(overlap_tiles) > 0 and not patches_may_overlap(patches_list[i], patches_list[j]):
+            for tile in overlap_tiles:
+                patches_list[i]["tiles_overlap_mask"][tile][j] = False
+                patches_list[j]["tiles_overlap_mask"][tile][i] = False
+            result_overlapps.append((i, j, 0.0, 0, 0, None, None))
+            continue
+
         # Calculate overlap mask for each tile both for i and j perspective
         for tile in overlap_tiles:
             overlap_mask_i, overlap_mask_j = overlap_mask(patches_list[i], patches_list[j], tile)
@@ -602,20 +653,42 @@ def compute_overlap_for_pair(args):
         result_overlapps.append((i, j, overlapp_percentage, overlap, non_overlap, points_overlap, angles_offset))
     return result_overlapps
 
+def count_angles_per_tile(angles, tiles_angles):
+    """
+    Count per tile how many of the angles occur in the tile's angle values.
+    Same as summing np.isin(angles, tile_angles) for each tile, but vectorized over all tiles.
+    """
+    nr_tiles = len(tiles_angles)
+    if nr_tiles == 0 or len(angles) == 0:
+        return np.zeros(nr_tiles, dtype=int)
+    # Unique (angle value, tile) pairs, sorted by angle value
+    tile_ids = np.repeat(np.arange(nr_tiles), [len(tile_angles) for tile_angles in tiles_angles])
+    values = np.concatenate(tiles_angles)
+    order = np.lexsort((tile_ids, values))
+    values, tile_ids = values[order], tile_ids[order]
+    unique_pairs = np.ones(values.shape[0], dtype=bool)
+    unique_pairs[1:] = (values[1:] != values[:-1]) | (tile_ids[1:] != tile_ids[:-1])
+    values, tile_ids = values[unique_pairs], tile_ids[unique_pairs]
+
+    # Range of matching pairs for each angle, NaN never matches like in np.isin
+    angles = angles[~np.isnan(angles)]
+    lower = np.searchsorted(values, angles, side='left')
+    upper = np.searchsorted(values, angles, side='right')
+    lengths = upper - lower
+    if np.sum(lengths) == 0:
+        return np.zeros(nr_tiles, dtype=int)
+    pair_indices = np.repeat(lower - np.cumsum(lengths) + lengths, lengths) + np.arange(np.sum(lengths))
+    return np.bincount(tile_ids[pair_indices], minlength=nr_tiles)
+
 def filter_tiles(overlap_angles, non_overlap_agles, tiles, patch):
-    overlapp_count = 0
-    non_overlapp_count = 0
-    for tile in tiles:
-        if tile in patch["tiles_points"]: 
-            # Angles of tile points
-            angles_tile1 = patch["tiles_angles"][tile]
-            # Check how many angles of the tile are in the overlap_angles
-            angles_overlap1 = np.isin(overlap_angles, angles_tile1)
-            # Check how many angles of the tile are in the non_overlap_agles
-            angles_non_overlap1 = np.isin(non_overlap_agles, angles_tile1)
-            if np.sum(angles_overlap1) > 0:
-                overlapp_count += np.sum(angles_overlap1)
-                non_overlapp_count += np.sum(angles_non_overlap1)
+    tiles_angles = [patch["tiles_angles"][tile] for tile in tiles if tile in patch["tiles_points"]]
+    # Count per tile how many of the (non) overlap angles are in the tile
+    overlapp_counts = count_angles_per_tile(overlap_angles, tiles_angles)
+    non_overlapp_counts = count_angles_per_tile(non_overlap_agles, tiles_angles)
+    # Only tiles containing overlapping angles count
+    tiles_mask = overlapp_counts > 0
+    overlapp_count = np.sum(overlapp_counts[tiles_mask])
+    non_overlapp_count = np.sum(non_overlapp_counts[tiles_mask])
     
     return overlapp_count, non_overlapp_count
 
@@ -724,8 +797,22 @@ def assign_points_to_tiles(patches_list, subvolume, tiling=2):
         tile_indices = np.floor((patch["points"] - start) // tile_size).astype(int)
         # assert all positive indices
         assert np.all(tile_indices >= 0), f"Tile indices should be positive, but is {tile_indices}"
-        # for each unique index, add the points to the corresponding tile
-        unique_indices = np.unique(tile_indices, axis=0)
+        # Integer tile keys in lexicographical (x, y, z) order of the tile indices
+        tile_dims = np.maximum(np.max(tile_indices, axis=0) + 1, tiles_per_axis) if tile_indices.shape[0] > 0 else np.array([tiles_per_axis] * 3)
+        tile_keys = np.ravel_multi_index(tile_indices.T, tile_dims)
+        # One sort: by tile key, inside each tile by the lexicographical order of the points (z, y, x)
+        sort_indices = np.lexsort((patch["points"][:, 0], patch["points"][:, 1], patch["points"][:, 2], tile_keys))
+        sorted_tile_keys = tile_keys[sort_indices]
+        unique_keys, tile_starts = np.unique(sorted_tile_keys, return_index=True)
+        tile_ends = np.append(tile_starts[1:], sorted_tile_keys.shape[0])
+
+        points = patch["points"][sort_indices]
+        colors = patch["colors"][sort_indices]
+        normals = patch["normals"][sort_indices]
+        angles = patch["angles"][sort_indices]
+        if unique_keys.shape[0] > 0:
+            normals_mean = np.add.reduceat(normals, tile_starts, axis=0) / (tile_ends - tile_starts)[:, None]
+
         patch["tiles"] = {}
         patch["tiles_overlap_mask"] = {}
         for tile_x in range(tiles_per_axis):
@@ -738,26 +825,18 @@ def assign_points_to_tiles(patches_list, subvolume, tiling=2):
         patch["tiles_normals"] = {}
         patch["tiles_normals_mean"] = {}
         patch["tiles_angles"] = {}
-        indices_full = []
-        for index in unique_indices:
-            index = tuple(index)
-            indices_full.append(index)
-            indices = np.all(tile_indices == index, axis=1)
+        # Every tile is a slice view into the sorted arrays
+        for i, index in enumerate(zip(*np.unravel_index(unique_keys, tile_dims))):
+            index = tuple(int(c) for c in index)
+            tile_slice = slice(tile_starts[i], tile_ends[i])
             patch["tiles"][index] = True
-            patch["tiles_overlap_mask"][index] = np.zeros((len(patches_list), patch["points"][indices].shape[0]), dtype=bool)
+            patch["tiles_overlap_mask"][index] = np.zeros((len(patches_list), tile_ends[i] - tile_starts[i]), dtype=bool)
 
-            patch["tiles_points"][index] = patch["points"][indices]
-            patch["tiles_colors"][index] = patch["colors"][indices]
-            patch["tiles_normals"][index] = patch["normals"][indices]
-            patch["tiles_angles"][index] = patch["angles"][indices]
-
-            # sort the points in the tile by their lexicographical order
-            sort_indices1 = np.lexsort(patch["tiles_points"][index].T)
-            patch["tiles_points"][index] = patch["tiles_points"][index][sort_indices1]
-            patch["tiles_colors"][index] = patch["tiles_colors"][index][sort_indices1]
-            patch["tiles_normals"][index] = patch["tiles_normals"][index][sort_indices1]
-            patch["tiles_angles"][index] = patch["tiles_angles"][index][sort_indices1]
-            patch["tiles_normals_mean"][index] = np.mean(patch["tiles_normals"][index], axis=0)
+            patch["tiles_points"][index] = points[tile_slice]
+            patch["tiles_colors"][index] = colors[tile_slice]
+            patch["tiles_normals"][index] = normals[tile_slice]
+            patch["tiles_angles"][index] = angles[tile_slice]
+            patch["tiles_normals_mean"][index] = normals_mean[i]
 
 def surrounding_volumes_main_sheet(volume_id, volume_size=50, window_size=4):
     """
@@ -1175,4 +1254,107 @@ def find_starting_patch(sheet_points, path, subvolume_size=50, min_points=1000):
     # return volume id and patch id
     volume_id = np.array(patches_list[min_dist_arg]["ids"][0][:3]).astype(int)
     patch_id = int(patches_list[min_dist_arg]["ids"][0][3])
-    return volume_id, patch_id
\ No newline at end of file
+    return volume_id, patch_id
+
+def assign_points_to_tiles_reference(patches_list, subvolume, tiling=2):
+    """
+    Previous assign_points_to_tiles with one boolean mask and sort per tile. Reference for benchmark_tiling.
+    """
+    start = subvolume['start']
+    end = subvolume['end']
+    tiles_per_axis = 1 + tiling
+    tile_size = (end - start) / tiles_per_axis
+
+    for patch in patches_list:
+        tile_indices = np.floor((patch["points"] - start) // tile_size).astype(int)
+        unique_indices = np.unique(tile_indices, axis=0)
+        patch["tiles"] = {}
+        patch["tiles_overlap_mask"] = {}
+        for tile_x in range(tiles_per_axis):
+            for tile_y in range(tiles_per_axis):
+                for tile_z in range(tiles_per_axis):
+                    index = (tile_x, tile_y, tile_z)
+                    patch["tiles_overlap_mask"][index] = np.zeros((len(patches_list), 0), dtype=bool)
+        patch["tiles_points"] = {}
+        patch["tiles_colors"] = {}
+        patch["tiles_normals"] = {}
+        patch["tiles_normals_mean"] = {}
+        patch["tiles_angles"] = {}
+        for index in unique_indices:
+            index = tuple(int(c) for c in index)
+            indices = np.all(tile_indices == index, axis=1)
+            patch["tiles"][index] = True
+            patch["tiles_overlap_mask"][index] = np.zeros((len(patches_list), patch["points"][indices].shape[0]), dtype=bool)
+
+            sort_indices = np.lexsort(patch["points"][indices].T)
+            patch["tiles_points"][index] = patch["points"][indices][sort_indices]
+            patch["tiles_colors"][index] = patch["colors"][indices][sort_indices]
+            patch["tiles_normals"][index] = patch["normals"][indices][sort_indices]
+            patch["tiles_angles"][index] = patch["angles"][indices][sort_indices]
+            patch["tiles_normals_mean"][index] = np.mean(patch["tiles_normals"][index], axis=0)
+
+def benchmark_tiling(nr_patches=30, nr_points=100000, tiling=3, seed=0):
+    """
+    Benchmark assign_points_to_tiles and filter_tiles on synthetic patches of a block neighbourhood and report points/sec.
+    Checks that the tiles partition every patch and match the previous per tile masking, and that filter_tiles matches the per tile np.isin counting.
+    """
+    rng = np.random.default_rng(seed)
+    block_id = np.array([100, 100, 100])
+    subvolume = {"start": block_id - 50, "end": block_id + 50}
+    patches_list = []
+    for _ in range(nr_patches):
+        points = np.round(rng.uniform(block_id - 50, block_id + 50, (nr_points, 3)), 1)
+        normals = rng.normal(size=(nr_points, 3))
+        patches_list.append({"points": points, "normals": normals, "colors": rng.uniform(size=(nr_points, 3)), "angles": alpha_angles(normals)})
+    add_overlapp_entries_to_patches_list(patches_list)
+
+    time_start = time.time()
+    assign_points_to_tiles(patches_list, subvolume, tiling=tiling)
+    time_assign = time.time() - time_start
+    for patch in patches_list:
+        assert sum(tile_points.shape[0] for tile_points in patch["tiles_points"].values()) == patch["points"].shape[0], "Tiles do not partition the patch."
+
+    # Reference: previous per tile masking, compared tile by tile
+    patches_list_reference = [{key: patch[key] for key in ("points", "normals", "colors", "angles")} for patch in patches_list]
+    time_start = time.time()
+    assign_points_to_tiles_reference(patches_list_reference, subvolume, tiling=tiling)
+    time_assign_reference = time.time() - time_start
+    for patch, patch_reference in zip(patches_list, patches_list_reference):
+        assert set(patch["tiles"]) == set(patch_reference["tiles"]), "Tiles do not match the reference."
+        assert set(patch["tiles_overlap_mask"]) == set(patch_reference["tiles_overlap_mask"]), "Tile overlap masks do not match the reference."
+        for index in patch["tiles_overlap_mask"]:
+            assert patch["tiles_overlap_mask"][index].shape == patch_reference["tiles_overlap_mask"][index].shape, f"Overlap mask shape of tile {index} does not match the reference."
+        for index in patch["tiles"]:
+            for key in ("tiles_points", "tiles_colors", "tiles_normals", "tiles_angles"):
+                assert np.array_equal(patch[key][index], patch_reference[key][index]), f"{key} of tile {index} does not match the reference."
+            assert np.allclose(patch["tiles_normals_mean"][index], patch_reference["tiles_normals_mean"][index]), f"tiles_normals_mean of tile {index} does not match the reference."
+
+    patch = patches_list[0]
+    tiles = list(patch["tiles_points"].keys())
+    overlap_angles = patches_list[1]["angles"][:nr_points // 2]
+    non_overlap_angles = patches_list[1]["angles"][nr_points // 2:]
+    time_start = time.time()
+    overlapp_count, non_overlapp_count = filter_tiles(overlap_angles, non_overlap_angles, tiles, patch)
+    time_filter = time.time() - time_start
+
+    # Reference: per tile np.isin counting
+    overlapp_count_reference, non_overlapp_count_reference = 0, 0
+    for tile in tiles:
+        count = np.sum(np.isin(overlap_angles, patch["tiles_angles"][tile]))
+        if count > 0:
+            overlapp_count_reference += count
+            non_overlapp_count_reference += np.sum(np.isin(non_overlap_angles, patch["tiles_angles"][tile]))
+    assert (overlapp_count, non_overlapp_count) == (overlapp_count_reference, non_overlapp_count_reference), "filter_tiles does not match the np.isin reference."
+
+    total_points = nr_patches * nr_points
+    print(f"assign_points_to_tiles: {total_points} points in {time_assign:.3f}s, {total_points / max(time_assign, 1e-9):.0f} points/sec")
+    print(f"assign_points_to_tiles reference: {total_points} points in {time_assign_reference:.3f}s, {total_points / max(time_assign_reference, 1e-9):.0f} points/sec")
+    print(f"filter_tiles: {nr_points} angles over {len(tiles)} tiles in {time_filter:.4f}s, {nr_points / max(time_filter, 1e-9):.0f} points/sec")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the overlap tiling of ThaumatoAnakalyptor instance patches')
+    parser.add_argument('--nr_patches', type=int, help='Number of synthetic patches', default=30)
+    parser.add_argument('--nr_points', type=int, help='Number of points per synthetic patch', default=100000)
+    args = parser.parse_args()
+
+    benchmark_tiling(nr_patches=args.nr_patches, nr_points=args.nr_points)
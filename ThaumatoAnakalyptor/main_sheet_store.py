@@ -0,0 +1,333 @@
+### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
+
+import numpy as np
+import os
+import json
+import time
+import pickle
+import shutil
+import struct
+import zlib
+import argparse
+
+# Chunked main sheet (.ta) format:
+#   <name>.ta/header.json              format name and version
+#   <name>.ta/blocks.log               append-only log of per block records
+#   <name>.ta/index.npz                compacted index: latest record of every block in a prefix of the log
+#   <name>.ta/volume_blocks_scores.pkl optional auxiliary scores
+# Every record is a fixed size header followed by the patch ids (int64) and offset angles (float64) of one block.
+MAIN_SHEET_FORMAT = "ThaumatoAnakalyptor main sheet"
+MAIN_SHEET_VERSION = 1
+
+RECORD_MAGIC = b"TAMS"
+RECORD_HEADER = struct.Struct("<4sIqqqII") # magic, record type, block x, y, z, nr patches, crc32 of payload
+RECORD_BLOCK = 1
+RECORD_DELETED = 2
+
+def encode_block(volume_id, patches):
+    """
+    Encode the patches of a block into a log record.
+    """
+    patch_ids = np.array([int(patch_id) for patch_id in patches], dtype="<i8")
+    offset_angles = np.array([float(patches[patch_id]["offset_angle"]) for patch_id in patches], dtype="<f8")
+    payload = patch_ids.tobytes() + offset_angles.tobytes()
+    header = RECORD_HEADER.pack(RECORD_MAGIC, RECORD_BLOCK, int(volume_id[0]), int(volume_id[1]), int(volume_id[2]), len(patch_ids), zlib.crc32(payload))
+    return header + payload
+
+def encode_deleted_block(volume_id):
+    return RECORD_HEADER.pack(RECORD_MAGIC, RECORD_DELETED, int(volume_id[0]), int(volume_id[1]), int(volume_id[2]), 0, zlib.crc32(b""))
+
+def decode_payload(payload, nr_patches):
+    patch_ids = np.frombuffer(payload, dtype="<i8", count=nr_patches)
+    offset_angles = np.frombuffer(payload, dtype="<f8", count=nr_patches, offset=8 * nr_patches)
+    return {int(patch_id): {"offset_angle": float(offset_angle)} for patch_id, offset_angle in zip(patch_ids, offset_angles)}
+
+def is_main_sheet_store(path):
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, "header.json"))
+
+class MainSheetStore():
+    """
+    Chunked, versioned on disk storage of a main sheet.
+    Saving appends only the blocks that changed since the last save, loading can be restricted to a bounding box of blocks.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header_path = os.path.join(path, "header.json")
+        self.log_path = os.path.join(path, "blocks.log")
+        self.index_path = os.path.join(path, "index.npz")
+        self.scores_path = os.path.join(path, "volume_blocks_scores.pkl")
+        # block id -> (offset, length, crc32) of its latest record in the log
+        self.index = {}
+        self.log_size = 0
+        # Size of the log prefix covered by the index file, the rest of the log is replayed on load
+        self.indexed_log_size = 0
+
+        if is_main_sheet_store(path):
+            self.check_header()
+            self.load_index()
+        else:
+            self.create()
+
+    def create(self):
+        # An old pickled main sheet at the same path is kept next to the new store
+        if os.path.isfile(self.path):
+            os.replace(self.path, self.path + ".legacy")
+            print(f"Moved pickled main sheet {self.path} to {self.path}.legacy")
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.header_path, 'w') as f:
+            json.dump({"format": MAIN_SHEET_FORMAT, "version": MAIN_SHEET_VERSION}, f)
+        open(self.log_path, 'wb').close()
+        self.write_index()
+
+    def check_header(self):
+        with open(self.header_path, 'r') as f:
+            header = json.load(f)
+        assert header.get("format") == MAIN_SHEET_FORMAT, f"{self.path} is not a main sheet store."
+        assert header.get("version", 0) <= MAIN_SHEET_VERSION, f"Main sheet store {self.path} has version {header.get('version')}, newer than the supported version {MAIN_SHEET_VERSION}."
+
+    def load_index(self):
+        if os.path.isfile(self.index_path):
+            index = np.load(self.index_path)
+            self.log_size = int(index["log_size"])
+            self.indexed_log_size = self.log_size
+            for block_id, offset, length, crc in zip(index["block_ids"], index["offsets"], index["lengths"], index["crcs"]):
+                self.index[tuple(int(c) for c in block_id)] = (int(offset), int(length), int(crc))
+        log_size = os.path.getsize(self.log_path)
+        if log_size < self.log_size:
+            # Log replaced by a compaction that was interrupted before its index was written, the index is outdated
+            print(f"Index of {self.path} does not match the log, rebuilding it from the log")
+            self.index = {}
+            self.scan_log(0)
+            self.write_index()
+        elif log_size > self.log_size:
+            # Records appended after the last index write are replayed from the log
+            self.scan_log(self.log_size)
+
+    def scan_log(self, start=0):
+        """
+        Apply all complete records of the log from start on to the index. A truncated tail record (interrupted save) is cut off.
+        """
+        with open(self.log_path, 'rb') as f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, record_type, x, y, z, nr_patches, crc = RECORD_HEADER.unpack(header)
+                if magic != RECORD_MAGIC:
+                    break
+                payload = f.read(16 * nr_patches)
+                if len(payload) < 16 * nr_patches or zlib.crc32(payload) != crc:
+                    break
+                length = RECORD_HEADER.size + len(payload)
+                if record_type == RECORD_DELETED:
+                    self.index.pop((x, y, z), None)
+                else:
+                    self.index[(x, y, z)] = (offset, length, crc)
+                offset += length
+        if offset < os.path.getsize(self.log_path):
+            print(f"Truncating incomplete records at the end of {self.log_path}")
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(offset)
+        self.log_size = offset
+
+    def write_index_file(self, index, log_size):
+        """
+        Write the index to a temporary file and return its path.
+        """
+        block_ids = np.array(list(index.keys()), dtype=np.int64).reshape(-1, 3)
+        entries = np.array(list(index.values()), dtype=np.int64).reshape(-1, 3)
+        temp_path = self.index_path + "_temp.npz"
+        np.savez(temp_path, block_ids=block_ids, offsets=entries[:, 0], lengths=entries[:, 1], crcs=entries[:, 2], log_size=np.int64(log_size))
+        return temp_path
+
+    def write_index(self):
+        os.replace(self.write_index_file(self.index, self.log_size), self.index_path)
+        self.indexed_log_size = self.log_size
+
+    def save(self, main_sheet, volume_blocks_scores=None):
+        """
+        Append the blocks of the main sheet that changed since the last save.
+        Returns the number of bytes written and the size of a full rewrite of the main sheet.
+        """
+        records = []
+        full_size = 0
+        for volume_id in main_sheet:
+            block_id = tuple(int(c) for c in volume_id)
+            record = encode_block(block_id, main_sheet[volume_id])
+            full_size += len(record)
+            crc = RECORD_HEADER.unpack_from(record)[6]
+            if block_id in self.index and self.index[block_id][2] == crc:
+                continue
+            records.append((block_id, record, crc))
+        saved_block_ids = set(tuple(int(c) for c in volume_id) for volume_id in main_sheet)
+        deleted_block_ids = [block_id for block_id in self.index if block_id not in saved_block_ids]
+
+        bytes_written = 0
+        with open(self.log_path, 'ab') as f:
+            offset = self.log_size
+            for block_id, record, crc in records:
+                f.write(record)
+                self.index[block_id] = (offset, len(record), crc)
+                offset += len(record)
+            for block_id in deleted_block_ids:
+                record = encode_deleted_block(block_id)
+                f.write(record)
+                del self.index[block_id]
+                offset += len(record)
+            f.flush()
+            os.fsync(f.fileno())
+        bytes_written += offset - self.log_size
+        self.log_size = offset
+        # The index is rewritten once the replayed log tail would outgrow it, keeping its cost amortized
+        if self.log_size - self.indexed_log_size > RECORD_HEADER.size * len(self.index):
+            self.write_index()
+            bytes_written += os.path.getsize(self.index_path)
+
+        if volume_blocks_scores:
+            temp_path = self.scores_path + "_temp"
+            with open(temp_path, 'wb') as f:
+                pickle.dump(volume_blocks_scores, f)
+            os.replace(temp_path, self.scores_path)
+            bytes_written += os.path.getsize(self.scores_path)
+
+        # Rewrite the log once most of it is outdated records
+        if self.log_size > 2 * max(full_size, 1) and self.log_size > 1 << 20:
+            self.compact()
+
+        return bytes_written, full_size
+
+    def compact(self):
+        """
+        Rewrite the log with only the latest record of every block.
+        The compacted log and its index are both written before either replaces the old one. The old index covers the whole old log,
+        so a crash between the two replacements leaves a log shorter than the indexed size, which load_index detects.
+        """
+        self.write_index()
+        temp_log_path = self.log_path + "_temp"
+        index = {}
+        offset = 0
+        with open(self.log_path, 'rb') as f_in, open(temp_log_path, 'wb') as f_out:
+            for block_id, (offset_in, length, crc) in sorted(self.index.items(), key=lambda item: item[1][0]):
+                f_in.seek(offset_in)
+                f_out.write(f_in.read(length))
+                index[block_id] = (offset, length, crc)
+                offset += length
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        if offset == self.log_size:
+            # Nothing to compact, the log is unchanged
+            os.remove(temp_log_path)
+            return
+        temp_index_path = self.write_index_file(index, offset)
+        os.replace(temp_log_path, self.log_path)
+        os.replace(temp_index_path, self.index_path)
+        self.index = index
+        self.log_size = offset
+        self.indexed_log_size = offset
+
+    def block_ids(self, bbox=None):
+        block_ids = list(self.index.keys())
+        if bbox is not None:
+            bbox_min, bbox_max = np.asarray(bbox[0]), np.asarray(bbox[1])
+            block_ids = [block_id for block_id in block_ids if np.all(np.asarray(block_id) >= bbox_min) and np.all(np.asarray(block_id) <= bbox_max)]
+        return block_ids
+
+    def load(self, bbox=None):
+        """
+        Load the main sheet, optionally only the blocks with ids inside the bounding box (min_xyz, max_xyz).
+        """
+        main_sheet = {}
+        block_ids = sorted(self.block_ids(bbox), key=lambda block_id: self.index[block_id][0])
+        with open(self.log_path, 'rb') as f:
+            for block_id in block_ids:
+                offset, length, _ = self.index[block_id]
+                f.seek(offset)
+                record = f.read(length)
+                magic, _, x, y, z, nr_patches, crc = RECORD_HEADER.unpack_from(record)
+                payload = record[RECORD_HEADER.size:]
+                assert magic == RECORD_MAGIC and zlib.crc32(payload) == crc, f"Corrupted record for block {block_id} in {self.log_path}."
+                main_sheet[(x, y, z)] = decode_payload(payload, nr_patches)
+        return main_sheet
+
+    def load_volume_blocks_scores(self):
+        if not os.path.isfile(self.scores_path):
+            return {}
+        try:
+            with open(self.scores_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Could not load volume blocks scores {self.scores_path}: {e}")
+            return {}
+
+def load_legacy_main_sheet(path):
+    with open(path, 'rb') as f:
+        sheet_segmentation = pickle.load(f)
+    return sheet_segmentation['main_sheet'], sheet_segmentation['volume_blocks_scores']
+
+def migrate_main_sheet(path_legacy, path=None):
+    """
+    Convert a pickled main sheet (.ta) to the chunked format. Without a new path, the store replaces the pickle and the pickle is kept as <path>.legacy.
+    """
+    main_sheet, volume_blocks_scores = load_legacy_main_sheet(path_legacy)
+    if path is None:
+        path = path_legacy
+    store = MainSheetStore(path)
+    bytes_written, _ = store.save(main_sheet, volume_blocks_scores)
+    nr_patches = sum(len(main_sheet[volume_id]) for volume_id in main_sheet)
+    print(f"Migrated {len(main_sheet)} blocks with {nr_patches} patches from {path_legacy} to {path} ({bytes_written} bytes).")
+    return store
+
+def benchmark_write_amplification(path, nr_checkpoints=50, blocks_per_checkpoint=200, patches_per_block=3, seed=0):
+    """
+    Simulate a growing sheet and compare the bytes written per checkpoint by the pickled format and the chunked format.
+    """
+    rng = np.random.default_rng(seed)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    store = MainSheetStore(path)
+    path_legacy = path + ".pickle_benchmark"
+    main_sheet = {}
+    bytes_legacy, bytes_chunked = 0, 0
+    time_legacy, time_chunked = 0.0, 0.0
+    for checkpoint in range(nr_checkpoints):
+        # Grow the sheet and touch a few existing blocks
+        for _ in range(blocks_per_checkpoint):
+            volume_id = tuple(int(c) for c in rng.integers(0, 4000, 3) // 25 * 25)
+            main_sheet[volume_id] = {int(patch_id): {"offset_angle": float(rng.uniform(-3600, 3600))} for patch_id in range(patches_per_block)}
+        existing_volume_ids = list(main_sheet.keys())
+        for index in rng.integers(0, len(existing_volume_ids), blocks_per_checkpoint // 10):
+            main_sheet[existing_volume_ids[index]][0]["offset_angle"] += 360.0
+
+        time_start = time.time()
+        with open(path_legacy, 'wb') as f:
+            pickle.dump({'main_sheet': main_sheet, 'volume_blocks_scores': {}}, f)
+        time_legacy += time.time() - time_start
+        bytes_legacy += os.path.getsize(path_legacy)
+
+        time_start = time.time()
+        bytes_written, _ = store.save(main_sheet)
+        time_chunked += time.time() - time_start
+        bytes_chunked += bytes_written
+
+    assert MainSheetStore(path).load() == {volume_id: {patch_id: {"offset_angle": main_sheet[volume_id][patch_id]["offset_angle"]} for patch_id in main_sheet[volume_id]} for volume_id in main_sheet}, "Chunked main sheet does not round trip."
+    os.remove(path_legacy)
+    shutil.rmtree(path)
+
+    print(f"{nr_checkpoints} checkpoints, final sheet {len(main_sheet)} blocks")
+    print(f"pickle rewrite: {bytes_legacy / 1e6:8.2f} MB written, {time_legacy:.3f}s")
+    print(f"chunked log:    {bytes_chunked / 1e6:8.2f} MB written, {time_chunked:.3f}s")
+    print(f"write amplification reduction: {bytes_legacy / max(bytes_chunked, 1):.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Migrate pickled ThaumatoAnakalyptor main sheets (.ta) to the chunked format')
+    parser.add_argument('--migrate', type=str, help='Path to the pickled main sheet (.ta) to migrate', default=None)
+    parser.add_argument('--output', type=str, help='Path of the chunked main sheet. Default replaces the pickled main sheet, which is kept as <path>.legacy', default=None)
+    parser.add_argument('--benchmark', type=str, help='Scratch path to run the write amplification benchmark in', default=None)
+    args = parser.parse_args()
+
+    if args.migrate is not None:
+        migrate_main_sheet(args.migrate, args.output)
+    if args.benchmark is not None:
+        benchmark_write_amplification(args.benchmark)
@@ -27,10 +27,34 @@ from datasets.preprocessing.thaumato_preprocessing import STPLS3DPreprocessing
 import pandas as pd
 import numpy as np
 import concurrent.futures
+import time
+from contextlib import contextmanager
+try:
+    from hydra import initialize_config_dir, compose
+except ImportError:
+    # hydra-core < 1.2
+    from hydra.experimental import initialize_config_dir, compose
 
 global initialized
 initialized = False
 
+# Threads preprocessing the windows, kept alive between batches
+PREPROCESSING_WORKERS = 8
+# Windows have no colors, the model gets random colors as features. All windows reuse one buffer of random colors
+COLOR_BUFFER_SIZE = 1 << 20
+COLOR_BUFFER_SEED = 0
+
+MASK3D_DIR = os.path.dirname(os.path.realpath(__file__))
+# Mask3D data paths are relative to the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(MASK3D_DIR))
+DEFAULT_CONFIG_DIR = os.path.join(MASK3D_DIR, "conf")
+CONFIG_NAME = "config_base_instance_segmentation.yaml"
+DEFAULT_CHECKPOINT = os.path.join(MASK3D_DIR, "saved/train/last-epoch.ckpt")
+
+preprocessing_executor = None
+color_buffer = None
+model = None
+
 
 def get_parameters(cfg: DictConfig):
     logger = logging.getLogger(__name__)
@@ -77,13 +101,30 @@ def get_parameters(cfg: DictConfig):
     return cfg, model, loggers
 
 
-@hydra.main(
-    config_path="conf", config_name="config_base_instance_segmentation.yaml"
-)
-def init(cfg: DictConfig):
-    global initialized
-    if initialized:
-        return
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+@contextmanager
+def working_directory(path):
+    """
+    Temporarily change the working directory, the Mask3D data paths are relative to the repository root.
+    """
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+def load_config(config_dir=None, checkpoint=None):
+    """
+    Compose the Mask3D inference config from config_dir (default: conf next to this file) without hydra.main.
+    """
+    config_dir = os.path.abspath(config_dir if config_dir is not None else DEFAULT_CONFIG_DIR)
+    checkpoint = os.path.abspath(checkpoint if checkpoint is not None else DEFAULT_CHECKPOINT)
+    with initialize_config_dir(config_dir=config_dir):
+        cfg = compose(config_name=CONFIG_NAME)
+
     # Update the configuration with the specific settings
     CURR_DBSCAN = 14.0
     CURR_TOPK = 25
@@ -91,8 +132,7 @@ def init(cfg: DictConfig):
     CURR_SIZE = 54
 
     # Manually load the specific config that "stpls3d" points to.
-    os.chdir(hydra.utils.get_original_cwd())
-    stpls3d_config = OmegaConf.load("ThaumatoAnakalyptor/mask3d/conf/data/datasets/stpls3d.yaml")
+    stpls3d_config = OmegaConf.load(os.path.join(config_dir, "data/datasets/stpls3d.yaml"))
 
     OmegaConf.set_struct(cfg, False)
     cfg.general.experiment_name = f'validation_query_{CURR_QUERY}_topk_{CURR_TOPK}_dbscan_{CURR_DBSCAN}_size_{CURR_SIZE}'
@@ -109,7 +149,7 @@ def init(cfg: DictConfig):
     cfg.general.on_crops = False # Initially was True
     cfg.model.config.backbone._target_ = "models.Res16UNet18B"
     cfg.general.train_mode = False
-    cfg.general.checkpoint = "ThaumatoAnakalyptor/mask3d/saved/train/last-epoch.ckpt"
+    cfg.general.checkpoint = checkpoint
     cfg.data.crop_length = CURR_SIZE
     cfg.general.eval_inner_core = 50.0
     cfg.general.topk_per_image = CURR_TOPK
@@ -118,22 +158,73 @@ def init(cfg: DictConfig):
     cfg.data.test_mode = "test"
     cfg.general.export = True
     OmegaConf.set_struct(cfg, True)
-    # because hydra wants to change dir for some reason
-    res = get_parameters(cfg)
-    global model
-    model = res[1]
-    # model = nn.DataParallel(model)
-    model.to("cuda")
-    #print("dataset config", cfg.data.datasets)
-    model.prepare_data()
-
-    # thaumato_preprocessing.py for preprocessed npy loading to npy saving format (containing points object)
-    global preprocessing_thaumato
-    preprocessing_thaumato = STPLS3DPreprocessing(data_dir='ThaumatoAnakalyptor/mask3d/data/raw/thaumatoanakalyptor', save_dir='ThaumatoAnakalyptor/mask3d/data/processed/thaumatoanakalyptor')
-    print("preprocessing_thaumato initialized")
-    # thaumato_dataset.py for loading data in pytorch format
-    global inference_preprocessing 
-    inference_preprocessing = Mask3DInference()
+    return cfg
+
+class StubModel():
+    """
+    Deterministic stand in for Mask3D with the same inference interface, to profile everything around the network.
+    Every window is cut into instances of planar sheets, sheet_spacing apart along the first axis.
+    """
+    def __init__(self, sheet_spacing=5.0, score=0.9):
+        self.sheet_spacing = sheet_spacing
+        self.score = score
+
+    def to(self, device):
+        return self
+
+    def inference(self, batch):
+        predictions = {}
+        for i, item_pytorch in enumerate(batch):
+            # Raw coordinates of the window points, in input order
+            raw_coordinates = np.asarray(item_pytorch[6])
+            sheets = np.floor(raw_coordinates[:, 0] / self.sheet_spacing).astype(np.int64)
+            sheet_ids, sheets = np.unique(sheets, return_inverse=True)
+            pred_masks = np.zeros((len(raw_coordinates), len(sheet_ids)), dtype=np.uint8)
+            pred_masks[np.arange(len(raw_coordinates)), sheets.reshape(-1)] = 1
+            predictions[i] = {
+                "pred_masks": pred_masks,
+                "pred_scores": np.full(len(sheet_ids), self.score),
+                "pred_classes": np.ones(len(sheet_ids), dtype=np.int64),
+            }
+        return predictions
+
+def init(device=None, config_dir=None, checkpoint=None, inference_model=None):
+    """
+    Initialize the model and the preprocessing for inference, once per process.
+    device: torch device of the model, default cuda if available, else cpu.
+    config_dir: Mask3D conf directory, default conf next to this file.
+    checkpoint: Mask3D checkpoint, default saved/train/last-epoch.ckpt next to this file.
+    inference_model: object with an inference(batch) method used instead of Mask3D, for example StubModel().
+    """
+    global initialized
+    if initialized:
+        return
+    device = device if device is not None else default_device()
+
+    with working_directory(REPO_ROOT):
+        global model
+        if inference_model is None:
+            cfg = load_config(config_dir, checkpoint)
+            res = get_parameters(cfg)
+            model = res[1]
+            # model = nn.DataParallel(model)
+            model.to(device)
+            #print("dataset config", cfg.data.datasets)
+            model.prepare_data()
+        else:
+            model = inference_model.to(device)
+        print(f"{type(model).__name__} on {device}")
+
+        # thaumato_preprocessing.py for preprocessed npy loading to npy saving format (containing points object)
+        global preprocessing_thaumato
+        preprocessing_thaumato = STPLS3DPreprocessing(data_dir=os.path.join(MASK3D_DIR, 'data/raw/thaumatoanakalyptor'), save_dir=os.path.join(MASK3D_DIR, 'data/processed/thaumatoanakalyptor'))
+        print("preprocessing_thaumato initialized")
+        # thaumato_dataset.py for loading data in pytorch format
+        global inference_preprocessing 
+        inference_preprocessing = Mask3DInference()
+    global preprocessing_executor, color_buffer
+    preprocessing_executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREPROCESSING_WORKERS)
+    color_buffer = np.random.default_rng(COLOR_BUFFER_SEED).random((COLOR_BUFFER_SIZE, 3))
     print("initialized")
 
     initialized = True
@@ -149,19 +240,7 @@ def inference(points_3d):
     if not initialized:
         init()
 
-    # Convert labels into processed labels and instance ids.
-    processed_labels = np.zeros(points_3d.shape[0])
-    instance_ids = np.zeros(points_3d.shape[0])  # Changed -1 to -100 directly
-    colors = np.random.rand(*points_3d.shape)
-
-    # Assuming the points array shape is (n, 3) and normals is (n, 3),
-    # concatenate them along with labels to form the desired structure.
-    # Here, we'll only use the first three columns of normals for now.
-    points = np.hstack((points_3d, colors, processed_labels[:, None], instance_ids[:, None]))
-
-    points = preprocessing_thaumato.process_points_thaumato_inference(points, "test")
-    item_pytorch = inference_preprocessing.prepare_item(points)
-    batch = [item_pytorch]
+    batch = [preprocess_points(points_3d)]
 
     global model
     with torch.no_grad():
@@ -189,32 +268,58 @@ def batch_inference(points_3d_list):
 
     returns: List of dict, each with: "pred_masks", "pred_scores", "pred_classes"
     '''
-    
-    if not initialized:
-        init()
-
-    global model
-    batch = []
+    return next(batch_inference_stream([points_3d_list]))
 
-    # # Utilizing multithreading for preprocessing
-    # with concurrent.futures.ThreadPoolExecutor() as executor:
-    #     preprocessed_pytorch_items = list(executor.map(preprocess_points, points_3d_list))
-
-    # batch.extend(preprocessed_pytorch_items)
-
-    # Single Threaded
-    for points in points_3d_list:
-        batch.append(preprocess_points(points))
+def batch_inference_stream(points_3d_batches):
+    '''
+    points_3d_batches: Iterable of lists of np.array, each of shape (N, 3)
 
-    with torch.no_grad():
-        predictions = model.inference(batch)
+    yields: the predictions of every batch like batch_inference, in order.
+    The windows of the next batch are preprocessed by the worker threads while the model runs on the current batch.
+    '''
+    if not initialized:
+        init()
 
-    return predictions
+    batches = iter(points_3d_batches)
+    pending = submit_preprocessing(next(batches, None))
+    batch_nr = 0
+    while pending is not None:
+        time_start = time.time()
+        results = [future.result() for future in pending]
+        time_wait = time.time() - time_start
+        batch = [item_pytorch for item_pytorch, _ in results]
+        time_preprocess = sum(time_item for _, time_item in results)
+
+        # Overlap the preprocessing of the next batch with the model
+        pending = submit_preprocessing(next(batches, None))
+
+        time_start = time.time()
+        with torch.no_grad():
+            predictions = model.inference(batch)
+        time_model = time.time() - time_start
+        print(f"Batch {batch_nr} of {len(batch)} windows: preprocessing {time_preprocess:.3f}s ({time_wait:.3f}s waited for), model {time_model:.3f}s")
+        batch_nr += 1
+        yield predictions
+
+def submit_preprocessing(points_3d_list):
+    if points_3d_list is None:
+        return None
+    return [preprocessing_executor.submit(timed_preprocess_points, points_3d) for points_3d in points_3d_list]
+
+def timed_preprocess_points(points_3d):
+    time_start = time.time()
+    item_pytorch = preprocess_points(points_3d)
+    return item_pytorch, time.time() - time_start
+
+def window_colors(nr_points):
+    if nr_points > len(color_buffer):
+        return np.resize(color_buffer, (nr_points, 3))
+    return color_buffer[:nr_points]
 
 def preprocess_points(points_3d):
     processed_labels = np.zeros(points_3d.shape[0])
     instance_ids = np.zeros(points_3d.shape[0])
-    colors = np.random.rand(*points_3d.shape)
+    colors = window_colors(points_3d.shape[0])
     points = np.hstack((points_3d, colors, processed_labels[:, None], instance_ids[:, None]))
     points = preprocessing_thaumato.process_points_thaumato_inference(points, "test")
     item_pytorch = inference_preprocessing.prepare_item(points)
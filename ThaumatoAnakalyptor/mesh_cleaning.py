@@ -0,0 +1,249 @@
+### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
+
+import numpy as np
+import time
+import argparse
+
+def triangle_edge_lengths(vertices, triangles, chunk_size=1000000):
+    """
+    Lengths of the edges (v0, v1), (v1, v2), (v2, v0) of each triangle. Returns an array of shape (T, 3).
+    """
+    vertices = np.asarray(vertices)
+    triangles = np.asarray(triangles)
+    edge_lengths = np.empty((len(triangles), 3), dtype=np.float64)
+    # Chunked (T, 3, 3) gather of the triangle corners to bound the memory
+    for start in range(0, len(triangles), chunk_size):
+        corners = vertices[triangles[start:start+chunk_size]]
+        edge_lengths[start:start+chunk_size] = np.linalg.norm(corners - corners[:, [1, 2, 0]], axis=2)
+    return edge_lengths
+
+def short_edge_triangles_mask(vertices, triangles, threshold):
+    """
+    Mask of the triangles with at least one edge shorter than threshold.
+    """
+    return np.any(triangle_edge_lengths(vertices, triangles) < threshold, axis=1)
+
+def edge_keys(edges):
+    """
+    Packed uint64 ids of undirected edges: smaller vertex index in the upper, larger in the lower 32 bits.
+    """
+    edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+    return (np.minimum(edges[:, 0], edges[:, 1]).astype(np.uint64) << np.uint64(32)) | np.maximum(edges[:, 0], edges[:, 1]).astype(np.uint64)
+
+def triangle_edge_keys(triangles):
+    """
+    Packed edge ids of the edges (v0, v1), (v1, v2), (v2, v0) of each triangle. Returns an array of shape (T, 3).
+    """
+    triangles = np.asarray(triangles, dtype=np.int64)
+    return edge_keys(np.stack([triangles, triangles[:, [1, 2, 0]]], axis=2).reshape(-1, 2)).reshape(-1, 3)
+
+def non_manifold_edge_keys(triangles, allow_boundary_edges=False):
+    """
+    Packed ids of the edges shared by more than two triangles, and of boundary edges (one triangle) if allow_boundary_edges is False.
+    Same edges as open3d's get_non_manifold_edges.
+    """
+    sorted_keys = np.sort(triangle_edge_keys(triangles).reshape(-1))
+    if len(sorted_keys) == 0:
+        return sorted_keys
+    # Run lengths of equal keys
+    run_starts = np.flatnonzero(np.concatenate([[True], sorted_keys[1:] != sorted_keys[:-1]]))
+    run_counts = np.diff(np.append(run_starts, len(sorted_keys)))
+    bad_runs = run_counts > 2 if allow_boundary_edges else run_counts != 2
+    return sorted_keys[run_starts[bad_runs]]
+
+def triangles_with_edges_mask(triangles, keys):
+    """
+    Mask of the triangles containing both vertices of at least one of the edges with the packed ids keys.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    mask = np.any(np.isin(triangle_edge_keys(triangles), keys), axis=1)
+    # Degenerated edges (v, v) are contained in every triangle with the vertex v
+    degenerated = (keys >> np.uint64(32)) == (keys & np.uint64(0xFFFFFFFF))
+    if np.any(degenerated):
+        degenerated_vertices = (keys[degenerated] & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        mask |= np.any(np.isin(np.asarray(triangles, dtype=np.int64), degenerated_vertices), axis=1)
+    return mask
+
+def non_manifold_triangles_mask(triangles, allow_boundary_edges=False):
+    """
+    Mask of the triangles with a non-manifold edge.
+    """
+    return triangles_with_edges_mask(triangles, non_manifold_edge_keys(triangles, allow_boundary_edges=allow_boundary_edges))
+
+def connected_triangle_components(triangles, triangle_groups=None):
+    """
+    Component label of each triangle, triangles sharing an edge are connected. Same components as open3d's cluster_connected_triangles.
+    With triangle_groups only triangles of the same group are connected. Labels are the smallest triangle index of the component.
+    """
+    nr_triangles = len(triangles)
+    keys = triangle_edge_keys(triangles).reshape(-1)
+    edge_triangles = np.repeat(np.arange(nr_triangles, dtype=np.int64), 3)
+    if triangle_groups is None:
+        order = np.argsort(keys, kind='stable')
+        same_edge_group = keys[order][1:] == keys[order][:-1]
+    else:
+        # Sort by (edge, group), triangles of a group on an edge are consecutive even if other groups share the edge
+        edge_groups = np.asarray(triangle_groups)[edge_triangles]
+        order = np.lexsort((edge_groups, keys))
+        same_edge_group = (keys[order][1:] == keys[order][:-1]) & (edge_groups[order][1:] == edge_groups[order][:-1])
+    # Consecutive triangles on the same edge (and in the same group) are connected
+    pairs_a = edge_triangles[order[:-1][same_edge_group]]
+    pairs_b = edge_triangles[order[1:][same_edge_group]]
+
+    # Union find: hook the roots of both triangles of every pair onto the smaller root, then compress the paths by pointer jumping
+    parents = np.arange(nr_triangles, dtype=np.int64)
+    while True:
+        roots_a, roots_b = parents[pairs_a], parents[pairs_b]
+        differ = roots_a != roots_b
+        if not np.any(differ):
+            break
+        roots_a, roots_b = roots_a[differ], roots_b[differ]
+        np.minimum.at(parents, np.maximum(roots_a, roots_b), np.minimum(roots_a, roots_b))
+        while True:
+            grand_parents = parents[parents]
+            if np.array_equal(grand_parents, parents):
+                break
+            parents = grand_parents
+    return parents
+
+def vertex_triangle_adjacency(triangles, nr_vertices):
+    """
+    CSR adjacency vertex -> triangles containing the vertex.
+    """
+    triangles = np.asarray(triangles, dtype=np.int64)
+    vertex_ids = triangles.reshape(-1)
+    order = np.argsort(vertex_ids, kind='stable')
+    indptr = np.zeros(nr_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(vertex_ids, minlength=nr_vertices), out=indptr[1:])
+    return indptr, order // 3
+
+class MeshEdgeTable():
+    """
+    Persistent edge table of a triangle mesh: unique undirected edges, the edges of each triangle and the number of alive triangles per edge.
+    Boundary edges (one triangle) and the boundary degree of each vertex are updated incrementally when triangles are removed.
+    """
+    def __init__(self, triangles, nr_vertices):
+        unique_keys, triangle_edges = np.unique(triangle_edge_keys(triangles).reshape(-1), return_inverse=True)
+        self.triangle_edges = triangle_edges.reshape(-1, 3)
+        self.edges = np.stack([(unique_keys >> np.uint64(32)).astype(np.int64), (unique_keys & np.uint64(0xFFFFFFFF)).astype(np.int64)], axis=1)
+        self.edge_counts = np.bincount(self.triangle_edges.reshape(-1), minlength=len(self.edges))
+        self.alive = np.ones(len(triangles), dtype=bool)
+        # Boundary degree of the vertices, (v, v) boundary edges count twice like np.bincount(boundary_edges.ravel())
+        boundary = self.edge_counts == 1
+        self.boundary_degree = np.bincount(self.edges[boundary].reshape(-1), minlength=nr_vertices)
+
+    def boundary_edges(self):
+        return self.edges[self.edge_counts == 1]
+
+    def branching_vertices(self):
+        return np.flatnonzero(self.boundary_degree > 2)
+
+    def remove_triangles(self, triangle_mask):
+        """
+        Remove triangles and update edge counts and boundary degrees of the touched edges only.
+        """
+        removed = triangle_mask & self.alive
+        self.alive &= ~removed
+        removed_edges = self.triangle_edges[removed].reshape(-1)
+        if len(removed_edges) == 0:
+            return 0
+        touched_edges, touched_counts = np.unique(removed_edges, return_counts=True)
+        was_boundary = self.edge_counts[touched_edges] == 1
+        self.edge_counts[touched_edges] -= touched_counts
+        is_boundary = self.edge_counts[touched_edges] == 1
+        delta = is_boundary.astype(np.int64) - was_boundary.astype(np.int64)
+        changed = delta != 0
+        np.add.at(self.boundary_degree, self.edges[touched_edges[changed]].reshape(-1), np.repeat(delta[changed], 2))
+        return int(np.sum(removed))
+
+def grid_mesh(nr_rows, nr_columns, seed=0):
+    """
+    Synthetic noisy grid mesh with 2 * (nr_rows - 1) * (nr_columns - 1) triangles.
+    """
+    rng = np.random.default_rng(seed)
+    rows, columns = np.meshgrid(np.arange(nr_rows, dtype=np.float64), np.arange(nr_columns, dtype=np.float64), indexing='ij')
+    vertices = np.stack([rows.reshape(-1), columns.reshape(-1), rng.normal(0.0, 0.1, nr_rows * nr_columns)], axis=1)
+    row_indices, column_indices = np.meshgrid(np.arange(nr_rows - 1), np.arange(nr_columns - 1), indexing='ij')
+    corner = (row_indices * nr_columns + column_indices).reshape(-1)
+    triangles = np.concatenate([np.stack([corner, corner + 1, corner + nr_columns + 1], axis=1), np.stack([corner, corner + nr_columns + 1, corner + nr_columns], axis=1)])
+    return vertices, triangles
+
+def benchmark_mesh_cleaning(nr_triangles=10000000, nr_loop_triangles=100000, seed=0):
+    """
+    Benchmark the array kernels on a synthetic mesh against the per triangle loops on a sample of the triangles.
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.sqrt(nr_triangles / 2)) + 1
+    vertices, triangles = grid_mesh(side, side, seed=seed)
+    # Collapse some edges and add fins (third triangle on an edge)
+    collapse = rng.choice(len(vertices) - 1, size=1000, replace=False)
+    vertices[collapse] = vertices[collapse + 1] + 1e-4
+    fins = triangles[rng.choice(len(triangles), size=1000, replace=False)].copy()
+    fins[:, 2] = rng.integers(0, len(vertices), size=len(fins))
+    triangles = np.concatenate([triangles, fins])
+    print(f"Mesh with {len(vertices)} vertices and {len(triangles)} triangles")
+
+    threshold = 1e-2
+    time_start = time.time()
+    short_mask = short_edge_triangles_mask(vertices, triangles, threshold)
+    time_short = time.time() - time_start
+    time_start = time.time()
+    non_manifold_mask = non_manifold_triangles_mask(triangles)
+    time_non_manifold = time.time() - time_start
+
+    # Per triangle loop on a sample, extrapolated to the whole mesh
+    sample = rng.choice(len(triangles), size=min(nr_loop_triangles, len(triangles)), replace=False)
+    time_start = time.time()
+    short_loop = []
+    for tri in triangles[sample]:
+        short_loop.append(np.linalg.norm(vertices[tri[0]] - vertices[tri[1]]) < threshold or np.linalg.norm(vertices[tri[1]] - vertices[tri[2]]) < threshold or np.linalg.norm(vertices[tri[2]] - vertices[tri[0]]) < threshold)
+    time_short_loop = (time.time() - time_start) * len(triangles) / len(sample)
+    assert np.array_equal(np.array(short_loop), short_mask[sample]), "Short edge mask differs from the per triangle loop"
+
+    # Faces x non-manifold edges loop on a sample of faces and edges, extrapolated to the whole mesh
+    non_manifold_keys = non_manifold_edge_keys(triangles)
+    loop_edges = [(int(key >> np.uint64(32)), int(key & np.uint64(0xFFFFFFFF))) for key in non_manifold_keys[:50]]
+    sample_faces = triangles[sample[:1000]]
+    time_start = time.time()
+    for face in sample_faces:
+        any(((edge[0] in face) and (edge[1] in face)) for edge in loop_edges)
+    time_non_manifold_loop = (time.time() - time_start) * (len(triangles) / len(sample_faces)) * (len(non_manifold_keys) / max(len(loop_edges), 1))
+    assert np.array_equal(triangles_with_edges_mask(sample_faces, edge_keys(loop_edges)), np.array([any(((edge[0] in face) and (edge[1] in face)) for edge in loop_edges) for face in sample_faces])), "Non-manifold mask differs from the per face loop"
+
+    print(f"Short edges: {np.sum(short_mask)} triangles, arrays {time_short:.2f}s, per triangle loop ~{time_short_loop:.1f}s (extrapolated)")
+    print(f"Non-manifold: {len(non_manifold_keys)} edges, {np.sum(non_manifold_mask)} triangles, arrays {time_non_manifold:.2f}s, faces x edges loop ~{time_non_manifold_loop:.1f}s (extrapolated)")
+
+def check_connected_components(nr_cases=250, seed=0):
+    """
+    Compare connected_triangle_components with and without triangle groups against scipy's connected_components on random meshes with non-manifold edges.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    rng = np.random.default_rng(seed)
+    for case in range(nr_cases):
+        nr_vertices = int(rng.integers(4, 30))
+        triangles = np.stack([rng.choice(nr_vertices, size=3, replace=False) for _ in range(int(rng.integers(1, 40)))])
+        triangle_groups = rng.integers(0, 3, size=len(triangles)) if case % 2 == 1 else None
+        # Reference graph: all triangle pairs sharing an edge (and a group)
+        keys = triangle_edge_keys(triangles)
+        pairs = [(a, b) for a in range(len(triangles)) for b in range(a + 1, len(triangles)) if len(np.intersect1d(keys[a], keys[b])) > 0 and (triangle_groups is None or triangle_groups[a] == triangle_groups[b])]
+        pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(triangles), len(triangles)))
+        _, reference = connected_components(graph, directed=False)
+        # Label every component by its smallest triangle index
+        smallest = np.full(reference.max() + 1, len(triangles))
+        np.minimum.at(smallest, reference, np.arange(len(triangles)))
+        labels = connected_triangle_components(triangles, triangle_groups)
+        assert np.array_equal(labels, smallest[reference]), f"Components differ from scipy in case {case} (grouped: {triangle_groups is not None})"
+    print(f"Connected triangle components match scipy in {nr_cases} cases, {nr_cases // 2} of them grouped")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the mesh cleaning array kernels')
+    parser.add_argument('--nr_triangles', type=int, help='Number of triangles of the synthetic mesh', default=10000000)
+    parser.add_argument('--check_components', action='store_true', help='Check the connected triangle components against scipy instead')
+    args = parser.parse_args()
+
+    if args.check_components:
+        check_connected_components()
+    else:
+        benchmark_mesh_cleaning(nr_triangles=args.nr_triangles)
@@ -5,8 +5,9 @@ import open3d as o3d
 import numpy as np
 from collections import deque
 from math import atan2, pi, sqrt
-from .sheet_to_mesh import load_xyz_from_file, scale_points, shuffling_points_axis, umbilicus_xy_at_z
-from scipy.interpolate import interp1d
+from .sheet_to_mesh import load_xyz_from_file, scale_points, shuffling_points_axis
+from .umbilicus_interpolation import Umbilicus
+from .obj_io import read_obj_mesh, write_obj_mesh, write_mtl
 from copy import deepcopy
 import struct
 import json
@@ -102,7 +103,7 @@ def load_obj(path: str) -> o3d.geometry.TriangleMesh:
     """
     Load an .obj file and return the TriangleMesh object.
     """
-    return o3d.io.read_triangle_mesh(path)
+    return read_obj_mesh(path)
 
 def save_obj_with_uvs(path: str, mesh: o3d.geometry.TriangleMesh, uvs: list):
     """
@@ -121,7 +122,7 @@ def save_obj_with_uvs(path: str, mesh: o3d.geometry.TriangleMesh, uvs: list):
     mesh.triangle_uvs = o3d.utility.Vector2dVector(uvs)
     
     # Save the mesh to an .obj file
-    o3d.io.write_triangle_mesh(path, mesh)
+    write_obj_mesh(path, mesh)
 
 def sanity_check_vertex_normals(mesh):
     """
@@ -144,23 +145,13 @@ def save_obj(path: str, mesh: o3d.geometry.TriangleMesh):
     # make folder if not exists
     os.makedirs(os.path.dirname(path), exist_ok=True)
     # Save the mesh to an .obj file
-    o3d.io.write_triangle_mesh(path, mesh)
-    create_mtl_file(path.replace("obj", "mtl"), path.split("/")[-1].split(".")[0] + ".png")
+    mtl_path = path.replace("obj", "mtl")
+    write_obj_mesh(path, mesh, mtl_name=os.path.basename(mtl_path))
+    create_mtl_file(mtl_path, path.split("/")[-1].split(".")[0] + ".png")
 
 def create_mtl_file(mtl_path, texture_image_name):
     texture_image_name = texture_image_name.split(".")[0] + "_0." + texture_image_name.split(".")[-1]
-    content = f"""# Material file generated by ThaumatoAnakalyptor
-    newmtl default
-    Ka 1.0 1.0 1.0
-    Kd 1.0 1.0 1.0
-    Ks 0.0 0.0 0.0
-    illum 2
-    d 1.0
-    map_Kd {texture_image_name}
-    """
-
-    with open(mtl_path, 'w') as file:
-        file.write(content)
+    write_mtl(mtl_path, texture_image_name)
 
 def filter_mesh_by_edge_length(mesh, mesh_flattened, max_edge_length):
     """
@@ -280,11 +271,8 @@ class MeshFlattener:
         # scale and swap axis
         umbilicus_data = scale_points(umbilicus_data, 1.0, axis_offset=-500)
         umbilicus_data, _ = shuffling_points_axis(umbilicus_data, umbilicus_data, axis_indices)
-        # Separate the coordinates
-        x, y, z = umbilicus_data.T
-        # Create interpolation functions for x and z based on y
-        self.fx = interp1d(z, x, kind='linear', fill_value="extrapolate")
-        self.fy = interp1d(z, y, kind='linear', fill_value="extrapolate")
+        # Umbilicus lookup table parametrized by z
+        self.umbilicus = Umbilicus(umbilicus_data, axis=2)
         self.interpolate_umbilicus = lambda z: self.umbilicus_xy_at_z(z)
 
     def umbilicus_xy_at_z(self, z_new):
@@ -295,9 +283,8 @@ class MeshFlattener:
         :return: A 2D numpy array with interpolated points for each z value.
         """
 
-        # Calculate interpolated x and z values
-        x_new = self.fx(z_new)
-        y_new = self.fy(z_new)
+        # Calculate interpolated x and y values
+        x_new, y_new, z_new = self.umbilicus.position(z_new).T
 
         # Return the combined x, y, and z values as a 2D array
         return x_new, y_new, z_new
@@ -745,8 +732,9 @@ class OrthographicUVMapper:
         # scale and swap axis
         umbilicus_data = scale_points(umbilicus_data, 1.0, axis_offset=-500)
         umbilicus_data, _ = shuffling_points_axis(umbilicus_data, umbilicus_data, axis_indices)
-        # Define a wrapper function for umbilicus_xz_at_y
-        self.umbilicus_func = lambda z: umbilicus_xy_at_z(umbilicus_data, z)
+        # Define a wrapper function for the umbilicus lookup table
+        umbilicus_lut = Umbilicus(umbilicus_data, axis=2)
+        self.umbilicus_func = lambda z: umbilicus_lut.position(np.asarray(z, dtype=np.float64).reshape(-1))
 
     def mask_heightmap(self, size):
         size = int(np.ceil(size[0])), int(np.ceil(size[1]))
@@ -997,8 +985,9 @@ class DelaunyMeshManifold:
         # scale and swap axis
         umbilicus_data = scale_points(umbilicus_data, 1.0, axis_offset=-500)
         umbilicus_data, _ = shuffling_points_axis(umbilicus_data, umbilicus_data, axis_indices)
-        # Define a wrapper function for umbilicus_xz_at_y
-        self.umbilicus_func = lambda z: umbilicus_xy_at_z(umbilicus_data, z)
+        # Define a wrapper function for the umbilicus lookup table
+        umbilicus_lut = Umbilicus(umbilicus_data, axis=2)
+        self.umbilicus_func = lambda z: umbilicus_lut.position(np.asarray(z, dtype=np.float64).reshape(-1))
 
     def compute(self, path):
         points = np.asarray(self.mesh_flattened.vertices)
@@ -0,0 +1,432 @@
+### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
+
+import numpy as np
+import os
+import time
+import tempfile
+import argparse
+from multiprocessing import Pool
+import open3d as o3d
+from .tar_index import parse_ply_header
+
+# Streaming .obj/.mtl io on chunked numpy text formatting:
+#   <name>.obj               v (with optional vertex colors), vn, deduplicated vt and f v/vt/vn lines, 1 based indices
+#   <name>.obj.sidecar.ply   optional binary copy of the same mesh for fast reloads, used while the size and mtime of the .obj
+#                            match the ones recorded in its header
+# Triangle uvs are per triangle corner like Open3D's TriangleMesh.triangle_uvs.
+OBJ_SIDECAR_SUFFIX = ".sidecar.ply"
+# Rows formatted per chunk, with several workers chunks are made smaller to give every worker a few chunks per section
+OBJ_CHUNK_SIZE = 1000000
+OBJ_MIN_CHUNK_SIZE = 10000
+# Bytes of text parsed per chunk
+OBJ_READ_CHUNK_BYTES = 1 << 28
+VERTEX_FORMAT = "%.6f %.6f %.6f"
+NORMAL_FORMAT = "%.6f %.6f %.6f"
+COLOR_FORMAT = "%.6f %.6f %.6f"
+UV_FORMAT = "%.8f %.8f"
+
+def mesh_arrays(mesh):
+    """
+    Arrays (vertices, triangles, vertex normals, vertex colors, triangle uvs) of an Open3D TriangleMesh.
+    """
+    return (np.asarray(mesh.vertices), np.asarray(mesh.triangles), np.asarray(mesh.vertex_normals), np.asarray(mesh.vertex_colors), np.asarray(mesh.triangle_uvs))
+
+def arrays_to_mesh(arrays):
+    vertices, triangles, vertex_normals, vertex_colors, triangle_uvs = arrays
+    mesh = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(vertices), o3d.utility.Vector3iVector(triangles))
+    if len(vertex_normals) > 0:
+        mesh.vertex_normals = o3d.utility.Vector3dVector(vertex_normals)
+    if len(vertex_colors) > 0:
+        mesh.vertex_colors = o3d.utility.Vector3dVector(vertex_colors)
+    if len(triangle_uvs) > 0:
+        mesh.triangle_uvs = o3d.utility.Vector2dVector(triangle_uvs)
+    return mesh
+
+def format_rows(args):
+    """
+    One formatted line per row of a chunk, as bytes.
+    """
+    line_format, rows = args
+    return (((line_format + "\n") * len(rows)) % tuple(rows.ravel().tolist())).encode("ascii")
+
+def row_chunks(line_format, rows, chunk_size=OBJ_CHUNK_SIZE):
+    for start in range(0, len(rows), chunk_size):
+        yield line_format, rows[start:start + chunk_size]
+
+def deduplicate_uvs(triangle_uvs):
+    """
+    Unique uv coordinates and the 0 based index of every triangle corner into them.
+    """
+    # One complex number per uv, sorts much faster than unique rows
+    keys = np.ascontiguousarray(triangle_uvs, dtype=np.float64).view(np.complex128).reshape(-1)
+    unique_keys, uv_indices = np.unique(keys, return_inverse=True)
+    return np.stack([unique_keys.real, unique_keys.imag], axis=1), uv_indices.reshape(-1)
+
+def write_mtl(mtl_path, texture_image_name, material_name="default"):
+    content = f"# Material file generated by ThaumatoAnakalyptor\nnewmtl {material_name}\nKa 1.0 1.0 1.0\nKd 1.0 1.0 1.0\nKs 0.0 0.0 0.0\nillum 2\nd 1.0\nmap_Kd {texture_image_name}\n"
+    with open(mtl_path, 'w') as file:
+        file.write(content)
+
+def write_chunk_size(nr_rows, num_workers):
+    """
+    Rows per formatted chunk. A single worker formats OBJ_CHUNK_SIZE rows at once, several workers get about 4 chunks each of the largest section.
+    """
+    if num_workers <= 1:
+        return OBJ_CHUNK_SIZE
+    return int(np.clip(np.ceil(nr_rows / (4 * num_workers)), OBJ_MIN_CHUNK_SIZE, OBJ_CHUNK_SIZE))
+
+def write_obj(path, vertices, triangles, vertex_normals=None, vertex_colors=None, triangle_uvs=None, mtl_name=None, material_name="default", sidecar=False, chunk_size=None, num_workers=1):
+    """
+    Write a triangle mesh to an .obj file, written to a temporary file first and then renamed.
+    Chunks of rows are formatted by num_workers processes and written in order, chunk_size defaults to write_chunk_size.
+    Identical triangle corner uvs share one vt line. With sidecar, a binary .ply copy for fast reloads is written next to it.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    has_normals = vertex_normals is not None and len(vertex_normals) > 0
+    has_colors = vertex_colors is not None and len(vertex_colors) > 0
+    has_uvs = triangle_uvs is not None and len(triangle_uvs) > 0
+    if has_normals:
+        assert len(vertex_normals) == len(vertices), f"Number of normals {len(vertex_normals)} does not match the number of vertices {len(vertices)}."
+    if has_colors:
+        assert len(vertex_colors) == len(vertices), f"Number of colors {len(vertex_colors)} does not match the number of vertices {len(vertices)}."
+    if has_uvs:
+        assert len(triangle_uvs) == 3 * len(triangles), f"Number of triangle uvs {len(triangle_uvs)} does not match 3 times the number of triangles {len(triangles)}."
+
+    # make folder if not exists
+    if os.path.dirname(path) != "":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if has_uvs:
+        uvs, uv_indices = deduplicate_uvs(np.asarray(triangle_uvs, dtype=np.float64))
+    if chunk_size is None:
+        chunk_size = write_chunk_size(max(len(vertices), len(triangles)), num_workers)
+
+    def face_chunks():
+        # Faces, 1 based indices, normals share the vertex index
+        for start in range(0, len(triangles), chunk_size):
+            chunk = triangles[start:start + chunk_size] + 1
+            if has_uvs:
+                chunk_uvs = uv_indices[3 * start:3 * (start + len(chunk))].reshape(-1, 3) + 1
+                if has_normals:
+                    faces, corner_format = np.stack([chunk, chunk_uvs, chunk], axis=2), "%d/%d/%d"
+                else:
+                    faces, corner_format = np.stack([chunk, chunk_uvs], axis=2), "%d/%d"
+            elif has_normals:
+                faces, corner_format = np.stack([chunk, chunk], axis=2), "%d//%d"
+            else:
+                faces, corner_format = chunk, "%d"
+            yield "f " + " ".join([corner_format] * 3), faces.reshape(len(chunk), -1)
+
+    def obj_chunks():
+        if mtl_name is not None:
+            yield "mtllib %s", np.array([mtl_name], dtype=object)
+        if has_colors:
+            yield from row_chunks("v " + VERTEX_FORMAT + " " + COLOR_FORMAT, np.concatenate([vertices, np.asarray(vertex_colors, dtype=np.float64)], axis=1), chunk_size)
+        else:
+            yield from row_chunks("v " + VERTEX_FORMAT, vertices, chunk_size)
+        if has_normals:
+            yield from row_chunks("vn " + NORMAL_FORMAT, np.asarray(vertex_normals, dtype=np.float64), chunk_size)
+        if has_uvs:
+            yield from row_chunks("vt " + UV_FORMAT, uvs, chunk_size)
+        if mtl_name is not None:
+            yield "usemtl %s", np.array([material_name], dtype=object)
+        yield from face_chunks()
+
+    temp_path = path + "_temp"
+    with open(temp_path, 'wb') as f:
+        f.write(b"# Mesh generated by ThaumatoAnakalyptor\n")
+        if num_workers > 1:
+            with Pool(processes=num_workers) as pool:
+                for text in pool.imap(format_rows, obj_chunks()):
+                    f.write(text)
+        else:
+            for chunk in obj_chunks():
+                f.write(format_rows(chunk))
+    os.replace(temp_path, path)
+
+    if sidecar:
+        write_sidecar(path + OBJ_SIDECAR_SUFFIX, vertices, triangles, vertex_normals if has_normals else None, vertex_colors if has_colors else None, triangle_uvs if has_uvs else None, obj_path=path)
+
+def write_sidecar(path, vertices, triangles, vertex_normals=None, vertex_colors=None, triangle_uvs=None, obj_path=None):
+    """
+    Binary little endian .ply copy of a mesh, triangle uvs are stored per face as texcoord list.
+    The size and mtime of obj_path are recorded in the header, read_obj only uses the sidecar while they match.
+    """
+    vertex_normals = vertex_normals if vertex_normals is not None and len(vertex_normals) > 0 else None
+    vertex_colors = vertex_colors if vertex_colors is not None and len(vertex_colors) > 0 else None
+    triangle_uvs = triangle_uvs if triangle_uvs is not None and len(triangle_uvs) > 0 else None
+    vertex_fields = [(name, "<f8") for name in ("x", "y", "z")]
+    if vertex_normals is not None:
+        vertex_fields += [(name, "<f8") for name in ("nx", "ny", "nz")]
+    if vertex_colors is not None:
+        vertex_fields += [(name, "<f8") for name in ("red", "green", "blue")]
+    face_fields = [("nr_vertex_indices", "u1"), ("vertex_indices", "<i4", (3,))]
+    if triangle_uvs is not None:
+        face_fields += [("nr_texcoord", "u1"), ("texcoord", "<f8", (6,))]
+
+    vertex_records = np.empty(len(vertices), dtype=np.dtype(vertex_fields))
+    for i, name in enumerate(("x", "y", "z")):
+        vertex_records[name] = vertices[:, i]
+    if vertex_normals is not None:
+        for i, name in enumerate(("nx", "ny", "nz")):
+            vertex_records[name] = vertex_normals[:, i]
+    if vertex_colors is not None:
+        for i, name in enumerate(("red", "green", "blue")):
+            vertex_records[name] = vertex_colors[:, i]
+    face_records = np.empty(len(triangles), dtype=np.dtype(face_fields))
+    face_records["nr_vertex_indices"] = 3
+    face_records["vertex_indices"] = triangles
+    if triangle_uvs is not None:
+        face_records["nr_texcoord"] = 6
+        face_records["texcoord"] = np.asarray(triangle_uvs).reshape(-1, 6)
+
+    header = "ply\nformat binary_little_endian 1.0\ncomment ThaumatoAnakalyptor obj sidecar\n"
+    if obj_path is not None:
+        stat = os.stat(obj_path)
+        header += f"comment obj_stat {stat.st_size} {stat.st_mtime_ns}\n"
+    header += f"element vertex {len(vertices)}\n" + "".join(f"property double {name}\n" for name, _ in vertex_fields)
+    header += f"element face {len(triangles)}\nproperty list uchar int vertex_indices\n"
+    if triangle_uvs is not None:
+        header += "property list uchar double texcoord\n"
+    header += "end_header\n"
+
+    temp_path = path + "_temp"
+    with open(temp_path, 'wb') as f:
+        f.write(header.encode("ascii"))
+        vertex_records.tofile(f)
+        face_records.tofile(f)
+    os.replace(temp_path, path)
+
+def read_sidecar(path):
+    """
+    Mesh arrays from a .ply written by write_sidecar.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    ply_format, elements, body_offset = parse_ply_header(data)
+    assert ply_format == "binary_little_endian", f"Sidecar {path} has format {ply_format}."
+    assert [element[0] for element in elements] == ["vertex", "face"], f"Sidecar {path} has unexpected elements."
+    _, nr_vertices, vertex_properties = elements[0]
+    _, nr_triangles, face_properties = elements[1]
+    vertex_names = [name for name, _ in vertex_properties]
+    face_names = [name for name, _ in face_properties]
+    vertex_dtype = np.dtype([(name, "<" + dtype) for name, dtype in vertex_properties])
+    face_fields = [("nr_vertex_indices", "u1"), ("vertex_indices", "<i4", (3,))]
+    if "texcoord" in face_names:
+        face_fields += [("nr_texcoord", "u1"), ("texcoord", "<f8", (6,))]
+    face_dtype = np.dtype(face_fields)
+
+    vertex_records = np.frombuffer(data, dtype=vertex_dtype, count=nr_vertices, offset=body_offset)
+    face_records = np.frombuffer(data, dtype=face_dtype, count=nr_triangles, offset=body_offset + vertex_records.nbytes)
+
+    def stack(names):
+        if not all(name in vertex_names for name in names):
+            return np.zeros((0, 3), dtype=np.float64)
+        return np.stack([vertex_records[name] for name in names], axis=1).astype(np.float64)
+
+    vertices = stack(("x", "y", "z"))
+    triangles = face_records["vertex_indices"].astype(np.int32)
+    triangle_uvs = face_records["texcoord"].reshape(-1, 2).copy() if "texcoord" in face_names else np.zeros((0, 2), dtype=np.float64)
+    return vertices, triangles, stack(("nx", "ny", "nz")), stack(("red", "green", "blue")), triangle_uvs
+
+def sidecar_is_current(path):
+    """
+    True if the sidecar of the .obj at path records exactly the current size and mtime_ns of the .obj.
+    """
+    sidecar_path = path + OBJ_SIDECAR_SUFFIX
+    if not os.path.isfile(sidecar_path):
+        return False
+    with open(sidecar_path, 'rb') as f:
+        header = f.read(4096)
+    header = header[:header.find(b"end_header")].decode("ascii", errors="replace")
+    stat = os.stat(path)
+    return f"comment obj_stat {stat.st_size} {stat.st_mtime_ns}" in header.splitlines()
+
+def parse_rows(lines, prefix_length, dtype=np.float64):
+    """
+    Numbers of a non empty list of text lines as array, one row per line with the line prefix stripped.
+    """
+    values = np.fromstring(" ".join(line[prefix_length:] for line in lines), dtype=dtype, sep=" ")
+    return values.reshape(len(lines), -1)
+
+def text_chunk_ranges(path, chunk_bytes=OBJ_READ_CHUNK_BYTES):
+    """
+    Byte ranges of about chunk_bytes covering the file, starting and ending at line boundaries.
+    """
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as f:
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline()
+            if f.tell() >= size:
+                break
+            starts.append(f.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+def parse_obj_chunk(args):
+    """
+    Vertex, normal, uv and face rows of the lines in a byte range of an .obj file, None for missing rows.
+    Faces are (n, 3, k) with k indices per corner, missing indices are 0.
+    """
+    path, start, end = args
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("ascii").splitlines()
+    rows = []
+    for prefix in ("v ", "vn ", "vt "):
+        prefix_lines = [line for line in lines if line.startswith(prefix)]
+        rows.append(parse_rows(prefix_lines, len(prefix)) if len(prefix_lines) > 0 else None)
+    # v, v/vt, v//vn and v/vt/vn corners
+    face_lines = [line.replace("//", "/0/").replace("/", " ") for line in lines if line.startswith("f ")]
+    faces = None
+    if len(face_lines) > 0:
+        nr_values = len(face_lines[0].split()) - 1
+        assert nr_values % 3 == 0, f"Only triangle faces are supported, found: {face_lines[0].strip()}"
+        faces = parse_rows(face_lines, 2, dtype=np.int64)
+        assert faces.shape[1] == nr_values, "Faces with differing numbers of indices are not supported."
+        faces = faces.reshape(len(face_lines), 3, nr_values // 3)
+    return rows + [faces]
+
+def read_obj(path, use_sidecar=True, chunk_bytes=OBJ_READ_CHUNK_BYTES, num_workers=1):
+    """
+    Read a triangle mesh from an .obj file in chunks of text, parsed by num_workers processes.
+    Returns (vertices, triangles, vertex normals, vertex colors, triangle uvs) like the arrays of o3d.io.read_triangle_mesh.
+    With use_sidecar, a current binary sidecar is loaded instead of parsing the text.
+    """
+    assert os.path.isfile(path), f"File {path} not found."
+    if use_sidecar and sidecar_is_current(path):
+        return read_sidecar(path + OBJ_SIDECAR_SUFFIX)
+
+    tasks = [(path, start, end) for start, end in text_chunk_ranges(path, chunk_bytes)]
+    if num_workers > 1 and len(tasks) > 1:
+        with Pool(processes=min(num_workers, len(tasks))) as pool:
+            chunks = pool.map(parse_obj_chunk, tasks)
+    else:
+        chunks = [parse_obj_chunk(task) for task in tasks]
+    vertices, normals, uvs, faces = [[chunk[i] for chunk in chunks if chunk[i] is not None] for i in range(4)]
+
+    vertices = np.concatenate(vertices) if len(vertices) > 0 else np.zeros((0, 3))
+    normals = np.concatenate(normals) if len(normals) > 0 else np.zeros((0, 3))
+    uvs = np.concatenate(uvs) if len(uvs) > 0 else np.zeros((0, 2))
+    faces = np.concatenate(faces) if len(faces) > 0 else np.zeros((0, 3, 1), dtype=np.int64)
+    assert np.all(faces[:, :, 0] > 0), "Relative (negative) face indices are not supported."
+
+    vertex_colors = vertices[:, 3:6] if vertices.shape[1] >= 6 else np.zeros((0, 3))
+    vertices = vertices[:, :3]
+    triangles = (faces[:, :, 0] - 1).astype(np.int32)
+    triangle_uvs = np.zeros((0, 2))
+    if faces.shape[2] >= 2 and len(uvs) > 0 and np.all(faces[:, :, 1] > 0):
+        triangle_uvs = uvs[faces[:, :, 1].reshape(-1) - 1, :2]
+    vertex_normals = np.zeros((0, 3))
+    if faces.shape[2] >= 3 and len(normals) > 0 and np.all(faces[:, :, 2] > 0):
+        if len(normals) == len(vertices) and np.array_equal(faces[:, :, 2], faces[:, :, 0]):
+            vertex_normals = normals
+        else:
+            # Normals indexed separately, assigned to the vertices of the corners
+            vertex_normals = np.zeros((len(vertices), 3))
+            vertex_normals[triangles.reshape(-1)] = normals[faces[:, :, 2].reshape(-1) - 1]
+    return vertices, triangles, vertex_normals, vertex_colors, triangle_uvs
+
+def write_obj_mesh(path, mesh, mtl_name=None, sidecar=False, num_workers=1):
+    """
+    Save an Open3D TriangleMesh with normals, colors and uvs to an .obj file.
+    """
+    vertices, triangles, vertex_normals, vertex_colors, triangle_uvs = mesh_arrays(mesh)
+    write_obj(path, vertices, triangles, vertex_normals=vertex_normals, vertex_colors=vertex_colors, triangle_uvs=triangle_uvs, mtl_name=mtl_name, sidecar=sidecar, num_workers=num_workers)
+
+def read_obj_mesh(path, use_sidecar=True, num_workers=1):
+    """
+    Load an .obj file and return the TriangleMesh object.
+    """
+    return arrays_to_mesh(read_obj(path, use_sidecar=use_sidecar, num_workers=num_workers))
+
+def synthetic_mesh(nr_vertices, seed=0):
+    """
+    Grid mesh with normals and uvs of about nr_vertices vertices.
+    """
+    rng = np.random.default_rng(seed)
+    side = max(2, int(np.sqrt(nr_vertices)))
+    y, x = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    vertices = np.stack([x.ravel(), y.ravel(), rng.uniform(0, 1, side * side)], axis=1) * 10.0
+    normals = rng.normal(size=(side * side, 3))
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    corners = (y[:-1, :-1] * side + x[:-1, :-1]).ravel()
+    triangles = np.concatenate([np.stack([corners, corners + 1, corners + side], axis=1), np.stack([corners + 1, corners + side + 1, corners + side], axis=1)])
+    uvs = vertices[:, :2] / (10.0 * (side - 1))
+    triangle_uvs = uvs[triangles.reshape(-1)]
+    colors = rng.uniform(0, 1, size=(side * side, 3))
+    return vertices, triangles, normals, colors, triangle_uvs
+
+def check_round_trip(nr_vertices=10000):
+    """
+    Write synthetic meshes with every combination of attributes and check that the .obj and the sidecar read back to the same arrays.
+    """
+    vertices, triangles, normals, colors, triangle_uvs = synthetic_mesh(nr_vertices)
+    empty3, empty2 = np.zeros((0, 3)), np.zeros((0, 2))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for with_normals in (False, True):
+            for with_colors in (False, True):
+                for with_uvs in (False, True):
+                    expected = (vertices, triangles, normals if with_normals else empty3, colors if with_colors else empty3, triangle_uvs if with_uvs else empty2)
+                    path = os.path.join(temp_dir, f"mesh_{int(with_normals)}{int(with_colors)}{int(with_uvs)}.obj")
+                    num_workers = 2 if with_normals else 1
+                    write_obj(path, *expected, mtl_name="mesh.mtl", sidecar=True, chunk_size=997, num_workers=num_workers)
+                    for use_sidecar in (False, True):
+                        result = read_obj(path, use_sidecar=use_sidecar, chunk_bytes=1 << 16, num_workers=num_workers)
+                        for name, a, b in zip(("vertices", "triangles", "normals", "colors", "uvs"), expected, result):
+                            assert a.shape == b.shape, f"Shape of {name} differs: {a.shape} vs {b.shape} (sidecar: {use_sidecar})"
+                            assert np.allclose(a, b, atol=1e-6), f"{name} differ after round trip (sidecar: {use_sidecar})"
+                    # Shared uvs are written once
+                    with open(path, 'r') as f:
+                        nr_vt = sum(1 for line in f if line.startswith("vt "))
+                    assert nr_vt == (len(np.unique(triangle_uvs, axis=0)) if with_uvs else 0), f"Expected deduplicated vt lines, found {nr_vt}"
+                    # A rewritten .obj does not match the size and mtime recorded in the old sidecar
+                    write_obj(path, *expected, mtl_name="other.mtl")
+                    assert not sidecar_is_current(path), "Sidecar of a rewritten .obj is still considered current."
+    print(f"Round trip of {len(vertices)} vertices and {len(triangles)} triangles is consistent for .obj and sidecar")
+
+def benchmark_obj_io(nr_vertices=4000000, num_workers=8, with_open3d=True):
+    """
+    Write and read throughput of the .obj writer and reader, the sidecar and the Open3D path on a synthetic mesh.
+    """
+    arrays = synthetic_mesh(nr_vertices)
+    nr_triangles = len(arrays[1])
+    print(f"Benchmark mesh with {len(arrays[0])} vertices and {nr_triangles} triangles")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "mesh.obj")
+        def report(name, function, file_path):
+            time_start = time.time()
+            function()
+            time_taken = time.time() - time_start
+            size = os.path.getsize(file_path) / 1e6
+            print(f"{name:<20} {time_taken:8.2f}s {size / max(time_taken, 1e-6):8.1f} MB/s {nr_triangles / max(time_taken, 1e-6) / 1e6:6.2f} M triangles/s ({size:.1f} MB)")
+
+        report("write obj", lambda: write_obj(path, *arrays), path)
+        report(f"write obj {num_workers} proc", lambda: write_obj(path, *arrays, num_workers=num_workers), path)
+        report("write sidecar", lambda: write_sidecar(path + OBJ_SIDECAR_SUFFIX, *arrays, obj_path=path), path + OBJ_SIDECAR_SUFFIX)
+        report("read obj", lambda: read_obj(path, use_sidecar=False), path)
+        report(f"read obj {num_workers} proc", lambda: read_obj(path, use_sidecar=False, num_workers=num_workers), path)
+        report("read sidecar", lambda: read_obj(path, use_sidecar=True), path + OBJ_SIDECAR_SUFFIX)
+        if with_open3d:
+            mesh = arrays_to_mesh(arrays)
+            path_o3d = os.path.join(temp_dir, "mesh_o3d.obj")
+            report("write obj open3d", lambda: o3d.io.write_triangle_mesh(path_o3d, mesh), path_o3d)
+            report("read obj open3d", lambda: o3d.io.read_triangle_mesh(path_o3d), path_o3d)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check and benchmark the streaming .obj writer and reader, or write the binary sidecar of .obj files")
+    parser.add_argument("--check_round_trip", action="store_true", help="Check the round trip of synthetic meshes")
+    parser.add_argument("--benchmark", action="store_true", help="Compare the throughput against Open3D on a synthetic mesh")
+    parser.add_argument("--nr_vertices", type=int, help="Number of vertices of the benchmark mesh", default=4000000)
+    parser.add_argument("--num_workers", type=int, help="Number of processes formatting and parsing the text", default=8)
+    parser.add_argument("--sidecar", type=str, nargs="*", help="Write the binary sidecar of these .obj files", default=[])
+    args = parser.parse_args()
+
+    if args.check_round_trip:
+        check_round_trip()
+    if args.benchmark:
+        benchmark_obj_io(args.nr_vertices, num_workers=args.num_workers)
+    for obj_path in args.sidecar:
+        write_sidecar(obj_path + OBJ_SIDECAR_SUFFIX, *read_obj(obj_path, use_sidecar=False, num_workers=args.num_workers), obj_path=obj_path)
+        print(f"Wrote sidecar of {obj_path}")
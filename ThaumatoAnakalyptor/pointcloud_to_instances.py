@@ -2,6 +2,10 @@
 
 import numpy as np
 import os
+import time
+import glob
+import shutil
+import tempfile
 import open3d as o3d
 import tarfile
 
@@ -9,16 +13,17 @@ import tarfile
 import torch
 # show cuda devices
 print(torch.cuda.device_count())
-print(torch.cuda.current_device())
-# show name of current device
-print(torch.cuda.get_device_name(torch.cuda.current_device()))
+if torch.cuda.is_available():
+    print(torch.cuda.current_device())
+    # show name of current device
+    print(torch.cuda.get_device_name(torch.cuda.current_device()))
 
 from multiprocessing import Pool
 
 # plotting
 from tqdm import tqdm
 
-from .mask3d.inference import batch_inference, to_surfaces
+from .mask3d.inference import batch_inference_stream, to_surfaces, StubModel, init as init_mask3d
 
 import json
 import argparse
@@ -330,9 +335,8 @@ def detect_subvolume_surfaces(points_batch, normals_batch, colors_batch, names_b
     predictions_mask3d_batch = []
     # Predict the surfaces 
     print()
-    for coords_split in tqdm(coords_splits):
-        # print GPU memory usage
-        res = batch_inference(coords_split)
+    # Preprocessing of the next split overlaps the inference of the current one
+    for coords_split, res in zip(coords_splits, tqdm(batch_inference_stream(coords_splits), total=len(coords_splits))):
         if res is None:
             print("batch_inference result is None")
             res = [{"pred_classes": []}]*len(coords_split)
@@ -526,14 +530,63 @@ def subvolume_instances_multithreaded(path="/media/julian/FastSSD/scroll3_surfac
     for i in tqdm(range(num_tasks)):
         results = subvolume_computation_function((start_list[i], size, path, folder, dest, main_drive, alternative_drives, fix_umbilicus, umbilicus_points, umbilicus_points_old, score_threshold))
 
-def compute(path, folder, dest, main_drive, alternative_ply_drives, umbilicus_points_path, umbilicus_distance_threshold, fix_umbilicus, score_threshold):
+def compute(path, folder, dest, main_drive, alternative_ply_drives, umbilicus_points_path, umbilicus_distance_threshold, fix_umbilicus, score_threshold, device=None, mask3d_config=None, mask3d_checkpoint=None):
     import sys
     # Remove command-line arguments for later internal calls to Mask3D
     sys.argv = [sys.argv[0]]
+    init_mask3d(device=device, config_dir=mask3d_config, checkpoint=mask3d_checkpoint)
 
     # Multithreaded computation
     subvolume_instances_multithreaded(path=path, folder=folder, dest=dest, main_drive=main_drive, alternative_drives=alternative_ply_drives, fix_umbilicus=fix_umbilicus, umbilicus_points_path=umbilicus_points_path, start=[0, 0, 0], stop=[100, 100, 100], size = [3, 3, 3], umbilicus_distance_threshold=umbilicus_distance_threshold, score_threshold=score_threshold)
 
+def synthetic_cell(cell, grid_block_size=200, nr_points=20000, sheet_spacing=10.0, center=(300.0, 300.0), seed=0):
+    """
+    Points, normals and colors of a grid cell crossed by concentric cylindrical sheets around center (x, z), y is up.
+    """
+    rng = np.random.default_rng([seed] + list(cell))
+    points = (np.array(cell) + rng.uniform(0, 1, size=(nr_points, 3))) * grid_block_size
+    radial = points[:, [0, 2]] - np.array(center)
+    radius = np.linalg.norm(radial, axis=1)
+    direction = radial / np.maximum(radius, 1e-6)[:, None]
+    # Snap to the closest sheet with a little noise
+    sheet_radius = np.round(radius / sheet_spacing) * sheet_spacing + rng.normal(0, 0.3, nr_points)
+    points[:, [0, 2]] = np.array(center) + direction * sheet_radius[:, None]
+    normals = np.zeros_like(points)
+    normals[:, [0, 2]] = direction
+    colors = rng.uniform(0, 1, size=(nr_points, 3))
+    return points, normals, colors
+
+def benchmark_instances(nr_cells=3, points_per_cell=20000, device="cpu", score_threshold=0.1, keep_output=None):
+    """
+    Run the instance stage end to end on synthetic cells with the deterministic StubModel instead of Mask3D.
+    Measures everything except the network: ply loading, subvolume extraction, preprocessing, surface post processing and saving.
+    """
+    init_mask3d(device=device, inference_model=StubModel())
+    temp_dir = tempfile.mkdtemp() if keep_output is None else keep_output
+    folder = "point_cloud_colorized"
+    src_path = os.path.join(temp_dir, "src", folder)
+    os.makedirs(src_path, exist_ok=True)
+    size = [nr_cells - 1] * 3
+    for x in range(nr_cells):
+        for y in range(nr_cells):
+            for z in range(nr_cells):
+                points, normals, colors = synthetic_cell((x, y, z), nr_points=points_per_cell)
+                pcd = o3d.geometry.PointCloud()
+                pcd.points = o3d.utility.Vector3dVector(points)
+                pcd.normals = o3d.utility.Vector3dVector(normals)
+                pcd.colors = o3d.utility.Vector3dVector(colors)
+                o3d.io.write_point_cloud(os.path.join(src_path, f"cell_yxz_{x:03}_{y:03}_{z:03}.ply"), pcd)
+    print(f"Wrote {nr_cells ** 3} synthetic cells with {points_per_cell} points each to {src_path}")
+
+    time_start = time.time()
+    subvolume_computation_function(([0, 0, 0], size, os.path.join(temp_dir, "src"), folder, os.path.join(temp_dir, "dest"), "", [], False, None, None, score_threshold))
+    time_taken = time.time() - time_start
+    block_tars = glob.glob(os.path.join(temp_dir, "dest", folder + "_subvolume_blocks", "*.tar"))
+    print(f"Instance stage without the network: {time_taken:.2f}s for {nr_cells ** 3 * points_per_cell} points, {len(block_tars)} subvolume blocks written, {nr_cells ** 3 * points_per_cell / max(time_taken, 1e-6):.0f} points/s")
+    if keep_output is None:
+        shutil.rmtree(temp_dir)
+    return time_taken, len(block_tars)
+
 def main():
     side = "_verso" # actually recto
     path = "/media/julian/SSD2/scroll3_surface_points"
@@ -559,6 +612,10 @@ def main():
     parser.add_argument("--max_umbilicus_dist", type=float, help="Maximum distance between the umbilicus and blocks that should be computed. -1.0 for no distance restriction", default=umbilicus_distance_threshold)
     parser.add_argument("--fix_umbilicus", action='store_true', help="Flag, recompute all close to the updated umbilicus (make sure to also save the old umbilicus.txt as umbilicus_old.txt)")
     parser.add_argument("--score_threshold", type=float, help="Minimum score for a surface to be saved", default=score_threshold)
+    parser.add_argument("--device", type=str, help="Torch device of Mask3D, default cuda if available, else cpu", default=None)
+    parser.add_argument("--mask3d_config", type=str, help="Mask3D conf directory, default the one in the mask3d folder", default=None)
+    parser.add_argument("--mask3d_checkpoint", type=str, help="Mask3D checkpoint, default mask3d/saved/train/last-epoch.ckpt", default=None)
+    parser.add_argument("--benchmark", action='store_true', help="Benchmark the instance stage on synthetic cells with a stub model instead of Mask3D")
 
     # Parse the arguments
     args = parser.parse_args()
@@ -572,8 +629,12 @@ def main():
     fix_umbilicus = args.fix_umbilicus
     score_threshold = args.score_threshold
 
+    if args.benchmark:
+        benchmark_instances(device=args.device if args.device is not None else "cpu", score_threshold=score_threshold)
+        return
+
     # Compute the surface patches
-    compute(path, folder, dest, main_drive, alternative_ply_drives, umbilicus_points_path, umbilicus_distance_threshold, fix_umbilicus, score_threshold)
+    compute(path, folder, dest, main_drive, alternative_ply_drives, umbilicus_points_path, umbilicus_distance_threshold, fix_umbilicus, score_threshold, device=args.device, mask3d_config=args.mask3d_config, mask3d_checkpoint=args.mask3d_checkpoint)
 
     
 if __name__ == "__main__":
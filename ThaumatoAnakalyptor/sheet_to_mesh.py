@@ -6,13 +6,15 @@ import os
 import open3d as o3d
 import trimesh
 import threading
+import time
+import pickle
 # Global variable to store the main_sheet data
 main_sheet_data = None
 # Signal to indicate when the data is updated
 data_updated_event = threading.Event()
 
 # surface points extraction
-from multiprocessing import Pool
+from multiprocessing import Pool, shared_memory
 
 from tqdm import tqdm
 
@@ -24,6 +26,10 @@ from .surface_fitting_utilities import get_vector_mean, rotation_matrix_to_align
 
 from .instances_to_sheets import load_main_sheet, surrounding_volumes_main_sheet, build_main_sheet_patches_list, build_main_sheet_from_patches_list, build_main_sheet_volume_from_patches_list, build_patch, make_unique, alpha_angles, angle_to_180
 from .fix_mesh import find_degenerated_triangles_and_delete
+from .mesh_cleaning import short_edge_triangles_mask, non_manifold_triangles_mask, MeshEdgeTable, vertex_triangle_adjacency
+from .umbilicus_interpolation import Umbilicus, umbilicus_lookup, get_umbilicus
+from .winding_angle_shards import WindingAngleShards, report_peak_rss
+from .obj_io import read_obj_mesh, write_obj_mesh
 
 def load_xyz_from_file(filename='umbilicus.txt'):
     """
@@ -68,20 +74,8 @@ def umbilicus_xz_at_y(points_array, y_new):
     :return: A 2D numpy array with interpolated points for each 0.1 step in the y direction.
     """
 
-    # Separate the coordinates
-    x, y, z = points_array.T
-
-    # Create interpolation functions for x and z based on y
-    fx = interp1d(y, x, kind='linear', fill_value="extrapolate")
-    fz = interp1d(y, z, kind='linear', fill_value="extrapolate")
-
-    # Calculate interpolated x and z values
-    x_new = fx(y_new)
-    z_new = fz(y_new)
-
-    # Return the combined x, y, and z values as a 2D array
-    res = np.array([x_new, y_new, z_new]).T
-    return res
+    # Cached lookup table of the umbilicus points
+    return umbilicus_lookup(points_array, axis=1).position(y_new)
 
 def umbilicus_xy_at_z(points_array, z_new):
     """
@@ -92,19 +86,8 @@ def umbilicus_xy_at_z(points_array, z_new):
     :return: A 2D numpy array with interpolated points for each z value.
     """
 
-    # Separate the coordinates
-    x, y, z = points_array.T
-
-    # Create interpolation functions for x and z based on y
-    fx = interp1d(z, x, kind='linear', fill_value="extrapolate")
-    fy = interp1d(z, y, kind='linear', fill_value="extrapolate")
-
-    # Calculate interpolated x and z values
-    x_new = fx(z_new)
-    y_new = fy(z_new)
-
-    # Return the combined x, y, and z values as a 2D array
-    return np.column_stack([x_new, y_new, z_new])
+    # Cached lookup table of the umbilicus points
+    return umbilicus_lookup(points_array, axis=2).position(np.asarray(z_new, dtype=np.float64).reshape(-1))
 
 def generate_line(start_point, direction_vector, filename, length=500, step=0.1):
     """
@@ -342,7 +325,57 @@ def cast_points_to_surface(patch_position, patch_angle, surface, raster_distance
 
     return filtered_points, normals, winding_angles
 
+def unique_points_sorted_keys(points, bits=21):
+    """
+    Unique rows of points with a sort on packed uint64 keys of the quantized coordinates instead of a lexicographic row sort.
+    Points sharing a quantization cell but differing in their coordinates are kept apart, the result is exact.
+    Returns the unique points (in key order), the index of the first occurrence of each unique point and the inverse indices.
+    """
+    nr_points = points.shape[0]
+    if nr_points == 0:
+        return points.copy(), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Quantize each axis into 2^bits cells over the extent of the points and pack the cells into one key
+    min_coords = np.min(points, axis=0)
+    extent = np.max(np.max(points, axis=0) - min_coords)
+    max_cell = (1 << bits) - 1
+    scale = max_cell / extent if extent > 0 else 0.0
+    cells = np.clip(((points - min_coords) * scale).astype(np.int64), 0, max_cell).astype(np.uint64)
+    keys = (cells[:, 0] << np.uint64(2 * bits)) | (cells[:, 1] << np.uint64(bits)) | cells[:, 2]
+
+    # Stable sort, the first element of each group is the first occurrence in points
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    sorted_points = points[order]
+    new_group = np.empty(nr_points, dtype=bool)
+    new_group[0] = True
+    new_group[1:] = sorted_keys[1:] != sorted_keys[:-1]
+
+    # Quantization collisions: cells holding different points. Sort their members exactly by coordinates.
+    group_ids = np.cumsum(new_group) - 1
+    group_starts = np.flatnonzero(new_group)
+    mismatch = np.any(sorted_points != sorted_points[group_starts[group_ids]], axis=1)
+    if np.any(mismatch):
+        collision_positions = np.flatnonzero(np.isin(group_ids, np.unique(group_ids[mismatch])))
+        collision_points = sorted_points[collision_positions]
+        refine = np.lexsort((collision_points[:, 2], collision_points[:, 1], collision_points[:, 0], group_ids[collision_positions]))
+        order[collision_positions] = order[collision_positions[refine]]
+        sorted_points = points[order]
+        new_group[1:] |= np.any(sorted_points[1:] != sorted_points[:-1], axis=1)
+        group_ids = np.cumsum(new_group) - 1
+        group_starts = np.flatnonzero(new_group)
+
+    first_occurrence_indices = order[group_starts]
+    unique_inverse = np.empty(nr_points, dtype=np.int64)
+    unique_inverse[order] = group_ids
+    return points[first_occurrence_indices], first_occurrence_indices, unique_inverse
+
 def concat_patches_points(patches_points_list):
+    """
+    Concatenate the points of all patches and merge identical points.
+    Returns the unique points, normals and winding angles and the unique ranges (range_offsets, unique_inverse):
+    the indices into the unique points of patch i are unique_inverse[range_offsets[i]:range_offsets[i+1]].
+    """
     points_list = []
     normals_list = []
     winding_angles_list = []
@@ -359,33 +392,62 @@ def concat_patches_points(patches_points_list):
     all_winding_angles = np.concatenate(winding_angles_list, axis=0)
     print("unique")
     # Get unique points and their indices
-    unique_points, first_occurrence_indices, unique_indices = np.unique(all_points, axis=0, return_index=True, return_inverse=True)
+    unique_points, first_occurrence_indices, unique_inverse = unique_points_sorted_keys(all_points)
     # Get the corresponding normals and winding angles for the unique points
     unique_normals = all_normals[first_occurrence_indices]
     unique_winding_angles = all_winding_angles[first_occurrence_indices]
 
-    print("unique ranges")
     # Compute the start and end index for each points array in the combined array
-    ranges = []
-    curr_start = 0
-    for points in points_list:
-        length = len(points)
-        curr_end = curr_start + length
-        ranges.append((curr_start, curr_end))
-        curr_start = curr_end
-
-    print("index ranges")
-    # Convert the ranges to index ranges in the unique points
-    unique_ranges = [[unique_indices[u] for u in range(r[0], r[1])] for r in ranges]
+    range_offsets = np.zeros(len(points_list) + 1, dtype=np.int64)
+    range_offsets[1:] = np.cumsum([len(points) for points in points_list])
     print("done")
-    return unique_points, unique_normals, unique_winding_angles, unique_ranges
+    return unique_points, unique_normals, unique_winding_angles, (range_offsets, unique_inverse)
 
 def update_points_in_combined(combined_points_update_count, patch_points_update, patch_points_weights, combined_points, combined_points_weight, combined_ranges, idx):
-    indices_in_combined = combined_ranges[idx]
+    range_offsets, unique_inverse = combined_ranges
+    indices_in_combined = unique_inverse[range_offsets[idx]:range_offsets[idx+1]]
     combined_points_update_count[indices_in_combined] += 1
     combined_points[indices_in_combined] += patch_points_update * patch_points_weights[:, np.newaxis]
     combined_points_weight[indices_in_combined] += patch_points_weights
 
+def benchmark_concat_patches_points(nr_patches=500, nr_points=20000, nr_grid_points=2000000, seed=0):
+    """
+    Benchmark concat_patches_points against np.unique with per point index ranges on synthetic overlapping patches.
+    """
+    rng = np.random.default_rng(seed)
+    grid_points = rng.uniform(0, 2000, size=(nr_grid_points, 3))
+    # Patches draw from a shared pool of points, so neighbouring patches overlap
+    patches_points_list = []
+    for i in range(nr_patches):
+        start = int(i * (nr_grid_points - nr_points) / max(nr_patches - 1, 1))
+        indices = start + rng.choice(2 * nr_points, size=nr_points, replace=False) % (nr_grid_points - start)
+        points = grid_points[indices]
+        patches_points_list.append((points, rng.normal(size=points.shape), None, rng.uniform(-180, 180, size=len(points))))
+    all_points = np.concatenate([patch_points[0] for patch_points in patches_points_list], axis=0)
+
+    time_start = time.time()
+    unique_points_ref, unique_indices_ref = np.unique(all_points, axis=0, return_inverse=True)
+    unique_indices_ref = unique_indices_ref.reshape(-1)
+    ranges = []
+    curr_start = 0
+    for patch_points in patches_points_list:
+        ranges.append((curr_start, curr_start + len(patch_points[0])))
+        curr_start += len(patch_points[0])
+    unique_ranges_ref = [[unique_indices_ref[u] for u in range(r[0], r[1])] for r in ranges]
+    time_reference = time.time() - time_start
+
+    time_start = time.time()
+    unique_points, _, _, (range_offsets, unique_inverse) = concat_patches_points(patches_points_list)
+    time_sorted_keys = time.time() - time_start
+
+    # Same unique points and the same point for every patch entry
+    assert len(unique_points) == len(unique_points_ref), f"Unique point count mismatch: {len(unique_points)} vs {len(unique_points_ref)}"
+    for idx in range(nr_patches):
+        assert np.array_equal(unique_points[unique_inverse[range_offsets[idx]:range_offsets[idx+1]]], unique_points_ref[unique_ranges_ref[idx]]), f"Patch {idx} maps to different points."
+
+    print(f"{nr_patches} patches, {len(all_points)} points, {len(unique_points)} unique points")
+    print(f"np.unique + per point ranges: {time_reference:.2f}s, sorted keys + offsets: {time_sorted_keys:.2f}s, speedup: {time_reference / max(time_sorted_keys, 1e-6):.1f}x")
+
 def update_points_from_weight(main_sheet_points_org, main_sheet_points_count, main_sheet_points, main_sheet_normals, main_sheet_winding_angles, main_sheet_points_weight, subvolume_size):
     # Update the combined points with the weighted average of the patches
     mask_0 = main_sheet_points_weight != 0
@@ -426,9 +488,91 @@ def patch_points_weight(patch_points, volume_id, subvolume_size):
 
     return weight
 
-def process_volume(args):
-    # Unpack arguments 
-    volume_id, main_sheet_info, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals = args
+class SharedMainSheetInfo():
+    """
+    Read only view of the main sheet info (volume id -> patch nr -> offset angle) backed by shared memory arrays.
+    The sheet is flattened once in the main process, workers attach to the arrays by name instead of receiving the pickled dict.
+    """
+    def __init__(self, shared_memories, nr_patches):
+        self.shared_memories = shared_memories
+        self.nr_patches = nr_patches
+        self.volume_ids = np.ndarray((nr_patches, 3), dtype=np.int64, buffer=shared_memories[0].buf)
+        self.patch_nrs = np.ndarray((nr_patches,), dtype=np.int64, buffer=shared_memories[1].buf)
+        self.offset_angles = np.ndarray((nr_patches,), dtype=np.float64, buffer=shared_memories[2].buf)
+        self.volume_ranges = None
+
+    @classmethod
+    def create(cls, main_sheet_info):
+        entries = [(volume_id, patch_nr, main_sheet_info[volume_id][patch_nr]["offset_angle"]) for volume_id in main_sheet_info for patch_nr in main_sheet_info[volume_id]]
+        nr_patches = len(entries)
+        # Zero sized shared memory is not allowed
+        shared_memories = [shared_memory.SharedMemory(create=True, size=max(1, nr_patches * 3 * 8)), shared_memory.SharedMemory(create=True, size=max(1, nr_patches * 8)), shared_memory.SharedMemory(create=True, size=max(1, nr_patches * 8))]
+        shared_info = cls(shared_memories, nr_patches)
+        if nr_patches > 0:
+            shared_info.volume_ids[:] = np.array([entry[0] for entry in entries], dtype=np.int64).reshape(-1, 3)
+            shared_info.patch_nrs[:] = np.array([entry[1] for entry in entries], dtype=np.int64)
+            shared_info.offset_angles[:] = np.array([entry[2] for entry in entries], dtype=np.float64)
+        return shared_info
+
+    @classmethod
+    def attach(cls, names, nr_patches):
+        return cls([shared_memory.SharedMemory(name=name) for name in names], nr_patches)
+
+    def names(self):
+        return [shared_memory_.name for shared_memory_ in self.shared_memories]
+
+    def build_volume_ranges(self):
+        # Entries of a volume are contiguous, as they were flattened volume by volume
+        self.volume_ranges = {}
+        if self.nr_patches == 0:
+            return
+        new_volume = np.ones(self.nr_patches, dtype=bool)
+        new_volume[1:] = np.any(self.volume_ids[1:] != self.volume_ids[:-1], axis=1)
+        starts = np.flatnonzero(new_volume)
+        ends = np.append(starts[1:], self.nr_patches)
+        for start, end in zip(starts, ends):
+            self.volume_ranges[tuple(int(v) for v in self.volume_ids[start])] = (start, end)
+
+    def __contains__(self, volume_id):
+        if self.volume_ranges is None:
+            self.build_volume_ranges()
+        return tuple(volume_id) in self.volume_ranges
+
+    def __getitem__(self, volume_id):
+        if self.volume_ranges is None:
+            self.build_volume_ranges()
+        start, end = self.volume_ranges[tuple(volume_id)]
+        return {int(self.patch_nrs[i]): {"offset_angle": float(self.offset_angles[i])} for i in range(start, end)}
+
+    def __iter__(self):
+        if self.volume_ranges is None:
+            self.build_volume_ranges()
+        return iter(self.volume_ranges)
+
+    def __len__(self):
+        if self.volume_ranges is None:
+            self.build_volume_ranges()
+        return len(self.volume_ranges)
+
+    def close(self, unlink=False):
+        # Drop the array views before closing the buffers
+        self.volume_ids = self.patch_nrs = self.offset_angles = None
+        for shared_memory_ in self.shared_memories:
+            shared_memory_.close()
+            if unlink:
+                shared_memory_.unlink()
+
+# Per worker state of process_volume, set by init_process_volume_worker
+process_volume_state = None
+
+def init_process_volume_worker(shared_names, nr_patches, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals):
+    global process_volume_state
+    main_sheet_info = SharedMainSheetInfo.attach(shared_names, nr_patches)
+    process_volume_state = (main_sheet_info, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals)
+
+def process_volume(volume_id):
+    # Shared arguments of the worker
+    main_sheet_info, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals = process_volume_state
     
     points_dict = {}
     patches_points_list = []
@@ -471,109 +615,182 @@ def process_volume(args):
 
     return patches_points_list, patches_points_list_org, points_dict, idx_patches
 
-def build_main_sheet_points_interpolted(main_sheet_info, subvolume_size, path, winding_angle_threshold=120, winding_angle_threshold_cut=120, min_num_points=1000, umbilicus_path=None, sample_ratio=0.1, overlap_y=20, only_originals=False):
+def report_process_volume_pickling(main_sheet_info, args_list, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals):
     """
-    Build main sheet points from the main sheet info patches
+    Report the pickling time of the per volume task payloads, for the full main sheet info in every task and for the shared memory tasks.
     """
-    patches_points_list_org = []
+    time_start = time.time()
+    if only_originals:
+        # Old payload: (volume_id, {volume_id: main_sheet_info[volume_id]}, ...) per volume
+        payload_size = sum(len(pickle.dumps((volume_id, {volume_id: main_sheet_info[volume_id]}, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals))) for volume_id in args_list)
+    else:
+        # Old payload: (volume_id, main_sheet_info, ...) per volume, measured on a single task
+        payload_size = len(args_list) * len(pickle.dumps((args_list[0], main_sheet_info, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals)))
+    time_full = (time.time() - time_start) * (1 if only_originals else len(args_list))
+    time_start = time.time()
+    shared_payload_size = sum(len(pickle.dumps(args)) for args in args_list)
+    time_shared = time.time() - time_start
+    print(f"Pickling process_volume tasks: main sheet info in tasks {payload_size / 1e6:.2f} MB in {time_full:.2f}s, shared memory {shared_payload_size / 1e6:.4f} MB in {time_shared:.4f}s ({shared_payload_size / max(len(args_list), 1):.0f} bytes per task)")
+
+def build_cut_points(main_sheet_info, points_dict, path, cut_nr, subvolume_size):
+    """
+    Merge the points of all patches of a cut into one weighted main sheet pointcloud.
+    """
+    main_sheet_info_ = deepcopy(main_sheet_info)
+    # Aggregate results from all processes
+    all_patches_points_list = []
+    debug_scurface_points = []
+    debug_scurface_points_whole = []
     idx = 0
+    for v in points_dict:
+        for p in points_dict[v]:
+            points_, patch_points_, normals_, colors_, winding_angles_, _ = points_dict[v][p]
+            all_patches_points_list.append((points_, normals_, colors_, winding_angles_))
+            debug_scurface_points.append(patch_points_)
+            debug_scurface_points_whole.append(points_)
+            main_sheet_info_[v][p]["idx"] = idx
+            idx += 1
+    
+    save_surface_ply(np.concatenate(debug_scurface_points, axis=0), np.zeros_like(np.concatenate(debug_scurface_points, axis=0)), path + f"/../debug_surface_points_{cut_nr}.ply")
+    save_surface_ply(np.concatenate(debug_scurface_points_whole, axis=0), np.zeros_like(np.concatenate(debug_scurface_points_whole, axis=0)), path + f"/../debug_surface_whole_points_{cut_nr}.ply")
+    
+    main_sheet_points_org, main_sheet_normals, main_sheet_winding_angles, unique_ranges = concat_patches_points(all_patches_points_list)
+    main_sheet_points = np.zeros_like(main_sheet_points_org)
+    main_sheet_points_weight = np.zeros(len(main_sheet_points))
+    main_sheet_points_count = np.zeros(len(main_sheet_points))
+
+    for volume_id in tqdm(points_dict):
+        for patch_nr in points_dict[volume_id]:
+            # Update the main sheet points with the points of the patch
+            idx = main_sheet_info_[volume_id][patch_nr]["idx"]
+            points, patch_points, patch_normals, patch_colors, patch_winding_angles, patch_points_weights = points_dict[volume_id][patch_nr]
+            update_points_in_combined(main_sheet_points_count, patch_points, patch_points_weights, main_sheet_points, main_sheet_points_weight, unique_ranges, idx)
+    
+    return update_points_from_weight(main_sheet_points_org, main_sheet_points_count, main_sheet_points, main_sheet_normals, main_sheet_winding_angles, main_sheet_points_weight, subvolume_size)
+
+def build_sharded_cut_results(main_sheet_info, shards, cut_descriptors, path, subvolume_size, umbilicus_path, overlap_y):
+    """
+    Yields the cut results one by one, every cut only loads the winding angle shards it needs.
+    """
+    for i, (cut_normal, angle_range) in enumerate(cut_descriptors):
+        (points_dict, cut_normal), _ = extract_dict_points_winding(cut_points_source(shards, angle_range), cut_normal, angle_range, umbilicus_path, overlap_y=overlap_y)
+        cut_result = build_cut_points(main_sheet_info, points_dict, path, i, subvolume_size)
+        del points_dict
+        report_peak_rss(f"cut {i}")
+        yield (cut_result, cut_normal)
+
+def build_main_sheet_points_interpolted(main_sheet_info, subvolume_size, path, winding_angle_threshold=120, winding_angle_threshold_cut=120, min_num_points=1000, umbilicus_path=None, sample_ratio=0.1, overlap_y=20, only_originals=False, shard_path=None):
+    """
+    Build main sheet points from the main sheet info patches
+    With shard_path the per volume results are streamed into winding angle shards on disk instead of being kept in memory, the cut results are then built lazily one cut at a time.
+    """
     points_dict = {}
+    all_patches_points_list_org = []
+    shards = WindingAngleShards(shard_path) if shard_path is not None else None
 
     num_processes = 16  # Adjust based on your system's capabilities
-    args_list = []
-    for volume_id in main_sheet_info:
-        if only_originals:
-            main_info_patch_part = {volume_id: main_sheet_info[volume_id]}
-        else:
-            main_info_patch_part = main_sheet_info
-        args_list.append((volume_id, main_info_patch_part, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals))
-
-    with Pool(num_processes) as p:
-        results = list(tqdm(p.imap(process_volume, args_list), total=len(args_list)))
-        print(f"Finished processing {len(results)} volumes")
-
-    # Aggregate results from all processes
-    all_patches_points_list = []
-    all_patches_points_list_org = []
-    idx = 0
-    for patches_points_list, patches_points_list_org, points_dict_, idx_patch in results:
-        all_patches_points_list_org += patches_points_list_org
-        for v in points_dict_:
-            if v not in points_dict:
-                points_dict[v] = {}
-            for p in points_dict_[v]:
-                points_dict[v][p] = points_dict_[v][p]
-                
-    main_sheet_points_org_, _, _, _ = concat_patches_points(all_patches_points_list_org)
+    # Main sheet info is shared once through shared memory, tasks only carry the volume id. With only_originals a volume only accesses its own patches.
+    args_list = [volume_id for volume_id in main_sheet_info]
+    if len(args_list) > 0:
+        report_process_volume_pickling(main_sheet_info, args_list, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals)
+
+    shared_main_sheet_info = SharedMainSheetInfo.create(main_sheet_info)
+    try:
+        initargs = (shared_main_sheet_info.names(), shared_main_sheet_info.nr_patches, subvolume_size, path, winding_angle_threshold, sample_ratio, only_originals)
+        with Pool(num_processes, initializer=init_process_volume_worker, initargs=initargs) as p:
+            nr_results = 0
+            # Aggregate results from all processes as they arrive
+            for patches_points_list, patches_points_list_org, points_dict_, idx_patch in tqdm(p.imap(process_volume, args_list), total=len(args_list)):
+                nr_results += 1
+                if shards is not None:
+                    for points_, _, _, _ in patches_points_list_org:
+                        shards.append_org_points(points_)
+                    for v in points_dict_:
+                        for p_nr in points_dict_[v]:
+                            shards.append_patch(v, p_nr, *points_dict_[v][p_nr])
+                    continue
+                all_patches_points_list_org += patches_points_list_org
+                for v in points_dict_:
+                    if v not in points_dict:
+                        points_dict[v] = {}
+                    for p_nr in points_dict_[v]:
+                        points_dict[v][p_nr] = points_dict_[v][p_nr]
+            print(f"Finished processing {nr_results} volumes")
+    finally:
+        shared_main_sheet_info.close(unlink=True)
+        if shards is not None:
+            shards.close()
+    report_peak_rss("processing volumes")
+
+    if shards is not None:
+        main_sheet_points_org_, _, _ = unique_points_sorted_keys(shards.load_org_points())
+    else:
+        main_sheet_points_org_, _, _, _ = concat_patches_points(all_patches_points_list_org)
+        del all_patches_points_list_org
 
     print("Cutting main sheet pointcloud...")
-    points_dict_cuts = cut_main_dicts(main_sheet_info, points_dict, umbilicus_path, path, winding_angle_threshold=winding_angle_threshold_cut, subvolume_size=subvolume_size, min_num_points=min_num_points, overlap_y=overlap_y)
+    points_dict_cuts = cut_main_dicts(main_sheet_info, points_dict if shards is None else shards, umbilicus_path, path, winding_angle_threshold=winding_angle_threshold_cut, subvolume_size=subvolume_size, min_num_points=min_num_points, overlap_y=overlap_y, keep_cuts=shards is None)
     print(f"Done with cutting, points_dict_cuts has length: {len(points_dict_cuts)}")
+    report_peak_rss("cutting")
+    if shards is not None:
+        return main_sheet_points_org_, build_sharded_cut_results(main_sheet_info, shards, points_dict_cuts, path, subvolume_size, umbilicus_path, overlap_y)
+
     cut_results = []
     for i, (points_dict, cut_normal) in enumerate(points_dict_cuts):
-        main_sheet_info_ = deepcopy(main_sheet_info)
-        # Aggregate results from all processes
-        all_patches_points_list = []
-        debug_scurface_points = []
-        debug_scurface_points_whole = []
-        idx = 0
-        for v in points_dict:
-            for p in points_dict[v]:
-                points_, patch_points_, normals_, colors_, winding_angles_, _ = points_dict[v][p]
-                all_patches_points_list.append((points_, normals_, colors_, winding_angles_))
-                debug_scurface_points.append(patch_points_)
-                debug_scurface_points_whole.append(points_)
-                main_sheet_info_[v][p]["idx"] = idx
-                idx += 1
-        
-        save_surface_ply(np.concatenate(debug_scurface_points, axis=0), np.zeros_like(np.concatenate(debug_scurface_points, axis=0)), path + f"/../debug_surface_points_{i}.ply")
-        save_surface_ply(np.concatenate(debug_scurface_points_whole, axis=0), np.zeros_like(np.concatenate(debug_scurface_points_whole, axis=0)), path + f"/../debug_surface_whole_points_{i}.ply")
-        
-        main_sheet_points_org, main_sheet_normals, main_sheet_winding_angles, unique_ranges = concat_patches_points(all_patches_points_list)
-        main_sheet_points = np.zeros_like(main_sheet_points_org)
-        main_sheet_points_weight = np.zeros(len(main_sheet_points))
-        main_sheet_points_count = np.zeros(len(main_sheet_points))
-
-        for volume_id in tqdm(points_dict):
-            for patch_nr in points_dict[volume_id]:
-                # Update the main sheet points with the points of the patch
-                idx = main_sheet_info_[volume_id][patch_nr]["idx"]
-                points, patch_points, patch_normals, patch_colors, patch_winding_angles, patch_points_weights = points_dict[volume_id][patch_nr]
-                update_points_in_combined(main_sheet_points_count, patch_points, patch_points_weights, main_sheet_points, main_sheet_points_weight, unique_ranges, idx)
-        
-        main_sheet_points, main_sheet_normals, main_sheet_winding_angles = update_points_from_weight(main_sheet_points_org, main_sheet_points_count, main_sheet_points, main_sheet_normals, main_sheet_winding_angles, main_sheet_points_weight, subvolume_size)
-        cut_results.append(((main_sheet_points, main_sheet_normals, main_sheet_winding_angles), cut_normal))
+        cut_results.append((build_cut_points(main_sheet_info, points_dict, path, i, subvolume_size), cut_normal))
+    report_peak_rss("building cuts")
     
     return main_sheet_points_org_, cut_results
 
-def clean_main_sheet_points(main_sheet_points, normals, winding_angles, min_winding_distance, winding_angle_threshold=120):
+# Per worker state of clean_main_sheet_points_chunk, set by init_clean_main_sheet_points_worker
+clean_main_sheet_points_state = None
+
+def init_clean_main_sheet_points_worker(tree, main_sheet_points, winding_angles, min_winding_distance, winding_angle_threshold):
+    global clean_main_sheet_points_state
+    clean_main_sheet_points_state = (tree, main_sheet_points, winding_angles, min_winding_distance, winding_angle_threshold)
+
+def clean_main_sheet_points_chunk(chunk):
+    """
+    Batched radius query for the points start:end. Returns the indices of the points to remove due to neighbours in this chunk.
+    """
+    start, end = chunk
+    tree, main_sheet_points, winding_angles, min_winding_distance, winding_angle_threshold = clean_main_sheet_points_state
+    neighbours = tree.query_radius(main_sheet_points[start:end], r=min_winding_distance)
+    counts = np.array([len(indices) for indices in neighbours], dtype=np.int64)
+    if np.sum(counts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Pair arrays (point, neighbour)
+    pair_points = np.repeat(np.arange(start, end, dtype=np.int64), counts)
+    pair_neighbours = np.concatenate(neighbours).astype(np.int64)
+    angle_points = winding_angles[pair_points]
+    angle_neighbours = winding_angles[pair_neighbours]
+    # The point itself has an angle difference of 0 and never passes the threshold
+    violating = np.abs(angle_points - angle_neighbours) > winding_angle_threshold
+    # Remove the point with the larger winding angle
+    remove = np.where(angle_points[violating] > angle_neighbours[violating], pair_points[violating], pair_neighbours[violating])
+    return np.unique(remove)
+
+def clean_main_sheet_points(main_sheet_points, normals, winding_angles, min_winding_distance, winding_angle_threshold=120, num_processes=16, chunk_size=100000):
     """
     Clean main sheet pointcloud.
     """
     tree = KDTree(main_sheet_points)
-    to_remove = set()
-
-    for idx, point in enumerate(main_sheet_points):
-        # Query neighbors within a distance of `min_winding_distance`
-        indices = tree.query_radius([point], r=min_winding_distance)[0]
-
-        for neighbor_idx in indices:
-            # Skip the point itself
-            if neighbor_idx == idx:
-                continue
-            
-            angle_diff = abs(winding_angles[idx] - winding_angles[neighbor_idx])
-            
-            if angle_diff > winding_angle_threshold:
-                # Remove the point with the larger winding angle
-                if winding_angles[idx] > winding_angles[neighbor_idx]:
-                    to_remove.add(idx)
-                else:
-                    to_remove.add(neighbor_idx)
+    winding_angles_flat = np.asarray(winding_angles).reshape(len(main_sheet_points), -1)[:, 0]
+
+    # Batched radius queries in chunks of points, in parallel
+    chunks = [(start, min(start + chunk_size, len(main_sheet_points))) for start in range(0, len(main_sheet_points), chunk_size)]
+    initargs = (tree, main_sheet_points, winding_angles_flat, min_winding_distance, winding_angle_threshold)
+    if len(chunks) > 1 and num_processes > 1:
+        with Pool(min(num_processes, len(chunks)), initializer=init_clean_main_sheet_points_worker, initargs=initargs) as p:
+            removed_chunks = list(tqdm(p.imap_unordered(clean_main_sheet_points_chunk, chunks), total=len(chunks)))
+    else:
+        init_clean_main_sheet_points_worker(*initargs)
+        removed_chunks = [clean_main_sheet_points_chunk(chunk) for chunk in chunks]
+    to_remove = np.unique(np.concatenate(removed_chunks)) if len(removed_chunks) > 0 else np.zeros(0, dtype=np.int64)
 
     # Create masks for filtering
     mask = np.ones(len(main_sheet_points), dtype=bool)
-    mask[list(to_remove)] = False
+    mask[to_remove] = False
     
     cleaned_points = main_sheet_points[mask]
     cleaned_normals = normals[mask]
@@ -587,8 +804,8 @@ def extract_dict_points_winding(dict_points, start_piece_normal, angle_range, um
     """
     Extract the points around the umbilicus with a given angle range and side of the umbilicus from the point dict. returns: (a new dict with the filtered points, the number of points)
     """
-    # Load umbilicus points
-    umbilicus_raw_points = load_xyz_from_file(umbilicus_path)
+    # Umbilicus lookup table, loaded once per process
+    umbilicus_lut = get_umbilicus(umbilicus_path, axis=1)
     start_piece_angle = alpha_angles(np.array([start_piece_normal]))
 
     # dict that stores the output
@@ -603,7 +820,7 @@ def extract_dict_points_winding(dict_points, start_piece_normal, angle_range, um
             mask = np.logical_and((winding_angles > angle_range[0]), (winding_angles < angle_range[1]))
 
             main_sheet_points_scaled = scale_points(main_sheet_points, 200.0 / 50.0, axis_offset=0.0) # not correct coordinate system. only needed axis is true
-            umbilicus_points_main = umbilicus_xz_at_y(umbilicus_raw_points, main_sheet_points_scaled[:, 1])
+            umbilicus_points_main = umbilicus_lut.position(main_sheet_points_scaled[:, 1])
 
             # Get the side of the umbilicus
             umbilicus_normals = umbilicus_points_main - main_sheet_points_scaled
@@ -654,11 +871,10 @@ def extract_points_winding(main_sheet_points, normals, winding_angles, start_pie
     normals = normals[mask]
     winding_angles = winding_angles[mask]
 
-    # Load umbilicus points
-    umbilicus_raw_points = load_xyz_from_file(umbilicus_path)
-    # umbilicus_points = umbilicus(umbilicus_raw_points)
+    # Umbilicus lookup table, loaded once per process
+    umbilicus_lut = get_umbilicus(umbilicus_path, axis=1)
 
-    umbilicus_points_main = umbilicus_xz_at_y(umbilicus_raw_points, main_sheet_points[:, 1])
+    umbilicus_points_main = umbilicus_lut.position(main_sheet_points[:, 1])
 
     # Get the side of the umbilicus
     y_dist_umbilicus = (umbilicus_points_main - main_sheet_points)[:,2]
@@ -671,9 +887,20 @@ def extract_points_winding(main_sheet_points, normals, winding_angles, start_pie
 
     return main_sheet_points, normals, winding_angles
 
-def cut_main_dicts(main_sheet_info, points_dict, umbilicus_path, path, winding_angle_threshold=120, subvolume_size=50, min_num_points=1000, overlap_y=20):
+def cut_points_source(points_dict, angle_range):
+    """
+    Points dict for the cut with angle_range. Loads only the needed shards from WindingAngleShards.
+    """
+    if isinstance(points_dict, WindingAngleShards):
+        # extract_dict_points_winding shifts the winding angles by at most 180 degrees
+        return points_dict.load_angle_range(angle_range[0] - 180, angle_range[1] + 180)
+    return points_dict
+
+def cut_main_dicts(main_sheet_info, points_dict, umbilicus_path, path, winding_angle_threshold=120, subvolume_size=50, min_num_points=1000, overlap_y=20, keep_cuts=True):
     """
     Cuts the main points inside the dict into half rolled sheets around the umbilicus for surface fitting. returns a list of dicts containing those half rolls.
+    points_dict can also be a WindingAngleShards, every cut then only loads the shards of its angle range.
+    With keep_cuts=False only the (normal, angle range) of each cut is returned instead of its dict, to not hold all cuts in memory.
     """
     start_piece_normal = np.array([1, 0, 0]) # Normal of the start piece
     start_piece_normal_angle = alpha_angles(np.array([start_piece_normal]))[0]
@@ -701,9 +928,9 @@ def cut_main_dicts(main_sheet_info, points_dict, umbilicus_path, path, winding_a
     
     main_dict_points_cuts = []
     print(f"Making cut number {len(main_dict_points_cuts)}")
-    cut_start, nr_points_cut = extract_dict_points_winding(points_dict, start_piece_normal, angle_range, umbilicus_path, overlap_y=overlap_y)
+    cut_start, nr_points_cut = extract_dict_points_winding(cut_points_source(points_dict, angle_range), start_piece_normal, angle_range, umbilicus_path, overlap_y=overlap_y)
     if nr_points_cut > min_num_points:
-        main_dict_points_cuts.append(cut_start)
+        main_dict_points_cuts.append(cut_start if keep_cuts else (start_piece_normal.copy(), angle_range.copy()))
     else:
         print(f"Cut number {len(main_dict_points_cuts)} has less than {min_num_points} points ({nr_points_cut}), stopping")
 
@@ -714,9 +941,9 @@ def cut_main_dicts(main_sheet_info, points_dict, umbilicus_path, path, winding_a
         angle_range_negative = angle_range_negative - 180
         piece_normal_negative = piece_normal_negative * (-1)
         print(f"Making cut number {len(main_dict_points_cuts)}")
-        cut, nr_points_cut = extract_dict_points_winding(points_dict, piece_normal_negative, angle_range_negative, umbilicus_path, overlap_y=overlap_y)
+        cut, nr_points_cut = extract_dict_points_winding(cut_points_source(points_dict, angle_range_negative), piece_normal_negative, angle_range_negative, umbilicus_path, overlap_y=overlap_y)
         if nr_points_cut > min_num_points:
-            main_dict_points_cuts.append(cut)
+            main_dict_points_cuts.append(cut if keep_cuts else (piece_normal_negative.copy(), angle_range_negative.copy()))
         else:
             print(f"Cut number {len(main_dict_points_cuts)} has less than {min_num_points} points ({nr_points_cut}), stopping")
             break
@@ -731,9 +958,9 @@ def cut_main_dicts(main_sheet_info, points_dict, umbilicus_path, path, winding_a
         angle_range_positive = angle_range_positive + 180
         piece_normal_positive = piece_normal_positive * (-1)
         print(f"Making cut number {len(main_dict_points_cuts)}")
-        cut, nr_points_cut = extract_dict_points_winding(points_dict, piece_normal_positive, angle_range_positive, umbilicus_path, overlap_y=overlap_y)
+        cut, nr_points_cut = extract_dict_points_winding(cut_points_source(points_dict, angle_range_positive), piece_normal_positive, angle_range_positive, umbilicus_path, overlap_y=overlap_y)
         if nr_points_cut > min_num_points:
-            main_dict_points_cuts.append(cut)
+            main_dict_points_cuts.append(cut if keep_cuts else (piece_normal_positive.copy(), angle_range_positive.copy()))
         else:
             print(f"Cut number {len(main_dict_points_cuts)} has less than {min_num_points} points ({nr_points_cut}), stopping")
             break
@@ -1007,28 +1234,24 @@ def extract_cut_boundaries(boundary_edges, mesh, umbilicus_points, side, axis_in
     vertices = vertices[:, axis_indices]
 
     # filter edges with both vertices close enough to the umbilicus line on the indicated side
-    filtered_edges = []
-    for edge in boundary_edges:
-        edge_vertices = vertices[edge]
-        umbilicus_points_main = umbilicus_xz_at_y(umbilicus_points, edge_vertices[:, 1])
-        # Get the side of the umbilicus
-        y_dist_umbilicus = (umbilicus_points_main - edge_vertices)
-        mask_y = np.abs(y_dist_umbilicus[:,2]) < umbilicus_distance_threshold
-        mask_x = y_dist_umbilicus[:,0] * np.sign(y_dist_umbilicus[:,2]) * side < 0
-        mask = np.logical_and(mask_x, mask_y)
-        if np.sum(mask) == 2:
-            filtered_edges.append(edge)
+    boundary_edges = np.asarray(boundary_edges, dtype=np.int64).reshape(-1, 2)
+    edge_vertices = vertices[boundary_edges.reshape(-1)]
+    umbilicus_points_main = umbilicus_xz_at_y(umbilicus_points, edge_vertices[:, 1])
+    # Get the side of the umbilicus
+    y_dist_umbilicus = (umbilicus_points_main - edge_vertices)
+    mask_y = np.abs(y_dist_umbilicus[:,2]) < umbilicus_distance_threshold
+    mask_x = y_dist_umbilicus[:,0] * np.sign(y_dist_umbilicus[:,2]) * side < 0
+    mask = np.logical_and(mask_x, mask_y).reshape(-1, 2)
+    filtered_edges = boundary_edges[np.all(mask, axis=1)]
 
     print(f"Boundary of length {len(boundary_edges)} has a path of length {len(filtered_edges)} remaining close enough to the stitching side.")
 
     # Flip vertices if verteex 2 is higher than vertex 1
-    for i, edge in enumerate(filtered_edges):
-        edge_vertices = vertices[edge]
-        if edge_vertices[1, 1] > edge_vertices[0, 1]:
-            filtered_edges[i] = edge[[1, 0]]
+    flip = vertices[filtered_edges[:, 1], 1] > vertices[filtered_edges[:, 0], 1]
+    filtered_edges[flip] = filtered_edges[flip][:, ::-1]
 
     # order edges from highest z point to lowest z point with largest edge vertex z point as key
-    sorted_edges = sorted(filtered_edges, key=lambda edge: -max(vertices[edge][:, 1]))
+    sorted_edges = list(filtered_edges[np.argsort(-np.max(vertices[filtered_edges][:, :, 1], axis=1), kind='stable')])
 
     # if two edges have overlap (edge1 vertex 2 is smaller than edge2 vertex 1) remove the edge with the larger dist to the umbilicus cut between edge1 vertex 2 and edge2 vertex 1. continue from highest z to lowest z
     if len(sorted_edges) < 2:
@@ -1078,6 +1301,78 @@ def visualize_boundary(mesh, boundary_edges, path):
     )
     line_set.colors = o3d.utility.Vector3dVector(colors)
     
+def stitch_boundary_triangles(vertices0, boundary_edges0, vertices1, boundary_edges1):
+    """
+    Bridging triangles between the boundary edges of two meshes, vertex indices of mesh1 are offset by len(vertices0).
+    Both boundaries are sorted by the z of the top vertex of their edges and merged top to bottom. Each edge taken from one boundary
+    forms a triangle with the top vertex of the current edge of the other boundary, until one boundary is used up.
+    Ties in z continue on the boundary the last edge was taken from (mesh1 at the start).
+    """
+    vertices0 = np.asarray(vertices0)
+    vertices1 = np.asarray(vertices1)
+    boundary_edges0 = np.asarray(boundary_edges0, dtype=np.int64).reshape(-1, 2)
+    boundary_edges1 = np.asarray(boundary_edges1, dtype=np.int64).reshape(-1, 2) + len(vertices0)
+    all_vertices = np.vstack([vertices0, vertices1])
+
+    # Sort, such that index 0 of each edge is larger in z
+    swap0 = ~(all_vertices[boundary_edges0[:, 0], 2] > all_vertices[boundary_edges0[:, 1], 2])
+    boundary_edges0[swap0] = boundary_edges0[swap0][:, ::-1]
+    swap1 = ~(all_vertices[boundary_edges1[:, 0], 2] > all_vertices[boundary_edges1[:, 1], 2])
+    boundary_edges1[swap1] = boundary_edges1[swap1][:, ::-1]
+
+    # Sort boundary edges from top to bottom (stable, equal edges keep their order)
+    sorted_edges0 = boundary_edges0[np.argsort(-all_vertices[boundary_edges0[:, 0], 2], kind='stable')]
+    sorted_edges1 = boundary_edges1[np.argsort(-all_vertices[boundary_edges1[:, 0], 2], kind='stable')]
+    keys0 = -all_vertices[sorted_edges0[:, 0], 2]
+    keys1 = -all_vertices[sorted_edges1[:, 0], 2]
+    nr_edges0, nr_edges1 = len(sorted_edges0), len(sorted_edges1)
+    if nr_edges0 == 0 or nr_edges1 == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+
+    # Groups of equal z over both boundaries, in merge order
+    group_values, group_inverse = np.unique(np.concatenate([keys0, keys1]), return_inverse=True)
+    group_inverse = group_inverse.reshape(-1)
+    group_has0 = np.zeros(len(group_values), dtype=bool)
+    group_has0[group_inverse[:nr_edges0]] = True
+    group_has1 = np.zeros(len(group_values), dtype=bool)
+    group_has1[group_inverse[nr_edges0:]] = True
+    # Boundary the last edge of each group is taken from: the group's only boundary, or for groups on both boundaries the one not taken first.
+    # The first boundary of a group is the last boundary of the previous group (mesh1 before the first group).
+    mixed = group_has0 & group_has1
+    single_last = np.where(group_has1, 1, 0)
+    group_indices = np.arange(len(group_values))
+    last_single = np.maximum.accumulate(np.where(mixed, -1, group_indices))
+    nr_mixed = np.cumsum(mixed)
+    state_before = np.where(last_single >= 0, single_last[np.maximum(last_single, 0)], 1)
+    toggles = nr_mixed - np.where(last_single >= 0, nr_mixed[np.maximum(last_single, 0)], 0)
+    last_boundary = (state_before + toggles) % 2
+    first_boundary = np.empty_like(last_boundary)
+    first_boundary[0] = 1
+    first_boundary[1:] = last_boundary[:-1]
+
+    # Merge order: by group, within a group the first boundary before the other, within a boundary in sorted order
+    edge_boundary = np.concatenate([np.zeros(nr_edges0, dtype=np.int64), np.ones(nr_edges1, dtype=np.int64)])
+    tie_order = (edge_boundary != first_boundary[group_inverse]).astype(np.int64)
+    merge_order = np.lexsort((np.arange(nr_edges0 + nr_edges1), tie_order, group_inverse))
+    merged_boundary = edge_boundary[merge_order]
+
+    # Stop after the first boundary is used up
+    taken0 = np.cumsum(merged_boundary == 0)
+    taken1 = np.cumsum(merged_boundary == 1)
+    nr_steps = min(np.searchsorted(taken0, nr_edges0), np.searchsorted(taken1, nr_edges1)) + 1
+    merge_order = merge_order[:nr_steps]
+    merged_boundary = merged_boundary[:nr_steps]
+    # Current edge of the other boundary: its number of edges taken before this step
+    other_position = np.where(merged_boundary == 0, taken1[:nr_steps], taken0[:nr_steps])
+
+    all_sorted_edges = np.vstack([sorted_edges0, sorted_edges1])
+    taken_edges = all_sorted_edges[merge_order]
+    other_top = np.where(merged_boundary == 0, sorted_edges1[np.minimum(other_position, nr_edges1 - 1), 0], sorted_edges0[np.minimum(other_position, nr_edges0 - 1), 0])
+
+    # Orientation: edges of mesh0 bridge as [v, u1, u2], edges of mesh1 as [v, u2, u1]
+    new_triangles = np.where((merged_boundary == 0)[:, None], np.stack([other_top, taken_edges[:, 0], taken_edges[:, 1]], axis=1), np.stack([other_top, taken_edges[:, 1], taken_edges[:, 0]], axis=1))
+    return new_triangles
+
 def stitch_meshes(mesh0_tuple, mesh1_tuple, len_meshes):
     """
     Stitch two meshes together based on boundary edges.
@@ -1103,39 +1398,14 @@ def stitch_meshes(mesh0_tuple, mesh1_tuple, len_meshes):
     if len(boundary_edges1) == 0:
         return mesh0, boundary_tuple0
 
-    # Sort, such that index 0 of each edge is larger in z
-    boundary_edges0 = np.array([edge if vertices0[edge[0]][2] > vertices0[edge[1]][2] else [edge[1], edge[0]] for edge in boundary_edges0])
-    boundary_edges1 = np.array([edge if vertices1[edge[0]][2] > vertices1[edge[1]][2] else [edge[1], edge[0]] for edge in boundary_edges1])
-
-    # Sort boundary edges based on the y-coordinate of their topmost vertex
-    sorted_edges0 = np.array(sorted(boundary_edges0, key=lambda edge: max(vertices0[edge, 2]), reverse=True))
-    sorted_edges1 = np.array(sorted(boundary_edges1, key=lambda edge: max(vertices1[edge, 2]), reverse=True))
-
     # Merging the meshes
     all_vertices = np.vstack([vertices0, vertices1])
     all_triangles = np.vstack([np.asarray(mesh0.triangles), np.asarray(mesh1.triangles) + len(vertices0)])
-    sorted_edges1 = sorted_edges1 + len(vertices0)
     return_boundary = (np.array(boundary_tuple0[0]), np.array(boundary_tuple1[1]) + len(vertices0))
 
-    new_triangles = []
-    sorted_edges0 = list(sorted_edges0)
-    sorted_edges1 = list(sorted_edges1)
-
-    stitch_direction = -1
     # Stitching the meshes
-    while sorted_edges0 and sorted_edges1:
-        if all_vertices[sorted_edges0[0][0], 2] > all_vertices[sorted_edges1[0][0], 2]:
-            sorted_edges0, sorted_edges1 = sorted_edges1, sorted_edges0
-            stitch_direction *= -1
-        
-        v1, v2 = sorted_edges0[0]
-        u1, u2 = sorted_edges1[0]
-        triangle = [v1, u1, u2] if stitch_direction == 1 else [v1, u2, u1]
-        new_triangles.append(triangle)
-        
-        # Remove the processed edge from sorted_edges1
-        sorted_edges1.pop(0)
-    
+    new_triangles = stitch_boundary_triangles(vertices0, boundary_edges0, vertices1, boundary_edges1)
+
     # Convert vertices and triangles to a single mesh
     all_triangles = np.vstack([all_triangles, new_triangles])
     
@@ -1145,22 +1415,50 @@ def stitch_meshes(mesh0_tuple, mesh1_tuple, len_meshes):
     
     return stitched_mesh, return_boundary
 
+def half_cylinder_mesh(theta_start, theta_end, nr_theta, nr_z, radius=100.0, height=1000.0):
+    """
+    Synthetic half cylinder mesh around the z axis. Returns the mesh and its boundary edges at theta_start and theta_end.
+    """
+    thetas, zs = np.meshgrid(np.linspace(theta_start, theta_end, nr_theta), np.linspace(0.0, height, nr_z))
+    vertices = np.stack([radius * np.cos(thetas).reshape(-1), radius * np.sin(thetas).reshape(-1), zs.reshape(-1)], axis=1)
+    z_indices, theta_indices = np.meshgrid(np.arange(nr_z - 1), np.arange(nr_theta - 1), indexing='ij')
+    corner = (z_indices * nr_theta + theta_indices).reshape(-1)
+    triangles = np.concatenate([np.stack([corner, corner + 1, corner + nr_theta + 1], axis=1), np.stack([corner, corner + nr_theta + 1, corner + nr_theta], axis=1)])
+    boundary_start = np.stack([np.arange(nr_z - 1) * nr_theta, np.arange(1, nr_z) * nr_theta], axis=1)
+    boundary_end = boundary_start + nr_theta - 1
+
+    mesh = o3d.geometry.TriangleMesh()
+    mesh.vertices = o3d.utility.Vector3dVector(vertices)
+    mesh.triangles = o3d.utility.Vector3iVector(triangles)
+    return mesh, (boundary_start, boundary_end)
+
+def benchmark_stitch_meshes(nr_z0=20000, nr_z1=15001, nr_theta=8):
+    """
+    Stitch two synthetic half cylinder meshes and check the bridging triangles: every boundary edge but the last one of the longer boundary
+    is bridged and the stitched mesh is consistently oriented (no directed edge used twice).
+    """
+    mesh0_tuple = half_cylinder_mesh(0.0, np.pi, nr_theta, nr_z0)
+    mesh1_tuple = half_cylinder_mesh(np.pi + 0.01, 2.0 * np.pi, nr_theta, nr_z1)
+    nr_triangles = len(mesh0_tuple[0].triangles) + len(mesh1_tuple[0].triangles)
+
+    time_start = time.time()
+    stitched_mesh, _ = stitch_meshes(mesh0_tuple, mesh1_tuple, 2)
+    time_stitch = time.time() - time_start
+
+    triangles = np.asarray(stitched_mesh.triangles)
+    nr_bridging = len(triangles) - nr_triangles
+    assert nr_bridging == (nr_z0 - 1) + (nr_z1 - 1) - 1, f"Expected {(nr_z0 - 1) + (nr_z1 - 1) - 1} bridging triangles, got {nr_bridging}"
+    directed_edges = np.concatenate([triangles[:, [0, 1]], triangles[:, [1, 2]], triangles[:, [2, 0]]])
+    assert len(np.unique(directed_edges, axis=0)) == len(directed_edges), "Stitched mesh is not consistently oriented"
+    print(f"Stitched boundaries of {nr_z0 - 1} and {nr_z1 - 1} edges with {nr_bridging} triangles in {time_stitch:.3f}s")
+
 def remove_triangles_with_short_edges(mesh, threshold=1e-2):
     # Get vertices and triangles
     vertices = np.asarray(mesh.vertices)
     triangles = np.asarray(mesh.triangles)
     
-    # A function to compute the distance between two points given their indices
-    def edge_length(i, j):
-        return np.linalg.norm(vertices[i] - vertices[j])
-    
     # Find triangles with edges below the threshold
-    triangles_to_remove = []
-    for idx, tri in enumerate(triangles):
-        if edge_length(tri[0], tri[1]) < threshold or \
-           edge_length(tri[1], tri[2]) < threshold or \
-           edge_length(tri[2], tri[0]) < threshold:
-            triangles_to_remove.append(idx)
+    triangles_to_remove = np.flatnonzero(short_edge_triangles_mask(vertices, triangles, threshold))
     print(f"Removing {len(triangles_to_remove)} triangles with short edges")
     # Remove identified triangles
     mesh.remove_triangles_by_index(triangles_to_remove)
@@ -1439,14 +1737,8 @@ def remove_non_manifold_faces(mesh):
     Parameters:
     - mesh
     """
-    # Identify non manifold edges
-    edges = mesh.get_non_manifold_edges(allow_boundary_edges=False)
-
-    # Remove faces with non manifold edges
-    faces_to_remove = []
-    for i, face in enumerate(mesh.triangles):
-        if any(((edge[0] in face) and (edge[1] in face)) for edge in edges):
-            faces_to_remove.append(i)
+    # Remove faces with non manifold edges (boundary edges included)
+    faces_to_remove = np.flatnonzero(non_manifold_triangles_mask(np.asarray(mesh.triangles), allow_boundary_edges=False))
 
     print(f"Removing {len(faces_to_remove)} non-manifold faces")
 
@@ -1458,54 +1750,67 @@ def remove_non_manifold_faces(mesh):
 
     return mesh
 
-def get_longest_boundary(boundary_edges):
-    print(f"Number of boundary edges: {len(boundary_edges)}")
-    # Step 1: Construct the graph
-    graph = {}
-    for edge in boundary_edges:
-        if edge[0] not in graph:
-            graph[edge[0]] = []
-        if edge[1] not in graph:
-            graph[edge[1]] = []
-        graph[edge[0]].append(edge[1])
-        graph[edge[1]].append(edge[0])
-
-    # Helper function to retrieve a boundary path
-    def get_boundary_path(start_vertex):
-        path = [start_vertex]
+def boundary_loops(boundary_edges):
+    """
+    Extract the boundary loops (and open boundary paths) of boundary edges, each traversed once in O(length).
+    Uses a CSR adjacency over the boundary vertices and a visited bitmap. Open paths are started at their endpoints.
+    Returns the list of loops as arrays of vertex indices and an array of their lengths.
+    """
+    boundary_edges = np.asarray(boundary_edges, dtype=np.int64).reshape(-1, 2)
+    if len(boundary_edges) == 0:
+        return [], np.zeros(0, dtype=np.int64)
+    # Compact ids of the boundary vertices
+    boundary_vertices, compact_edges = np.unique(boundary_edges, return_inverse=True)
+    compact_edges = compact_edges.reshape(-1, 2)
+    nr_vertices = len(boundary_vertices)
+
+    # CSR adjacency, neighbours in edge order
+    sources = np.concatenate([compact_edges[:, 0], compact_edges[:, 1]])
+    targets = np.concatenate([compact_edges[:, 1], compact_edges[:, 0]])
+    order = np.argsort(sources, kind='stable')
+    neighbours = targets[order]
+    degrees = np.bincount(sources, minlength=nr_vertices)
+    indptr = np.zeros(nr_vertices + 1, dtype=np.int64)
+    np.cumsum(degrees, out=indptr[1:])
+    neighbours_list = neighbours.tolist()
+    indptr_list = indptr.tolist()
+
+    visited = np.zeros(nr_vertices, dtype=bool)
+    loops = []
+    # Endpoints of open paths first, then the remaining (closed) loops
+    start_vertices = np.concatenate([np.flatnonzero(degrees == 1), np.flatnonzero(degrees != 1)])
+    for start_vertex in start_vertices.tolist():
+        if visited[start_vertex]:
+            continue
+        loop = [start_vertex]
+        visited[start_vertex] = True
         current_vertex = start_vertex
         while True:
-            # There should be 1 or 2 neighbors for each boundary vertex
-            # If there's only one, it's an endpoint. Otherwise, we choose the one not already in the path
-            next_vertex = None
-            for neighbor in graph[current_vertex]:
-                if neighbor not in path:
-                    next_vertex = neighbor
+            # Next vertex is the first unvisited neighbour
+            next_vertex = -1
+            for i in range(indptr_list[current_vertex], indptr_list[current_vertex+1]):
+                neighbour = neighbours_list[i]
+                if not visited[neighbour]:
+                    next_vertex = neighbour
                     break
-            
-            if next_vertex is None:
+            if next_vertex < 0:
                 break
-            path.append(next_vertex)
+            visited[next_vertex] = True
+            loop.append(next_vertex)
             current_vertex = next_vertex
+        loops.append(boundary_vertices[np.array(loop, dtype=np.int64)])
+
+    lengths = np.array([len(loop) for loop in loops], dtype=np.int64)
+    return loops, lengths
 
-        return path
-
-    # Step 2: Retrieve all boundary paths
-    paths = []
-    visited = set()
-    for vertex in graph.keys():
-        if vertex not in visited:
-            path = get_boundary_path(vertex)
-            paths.append(path)
-            visited.update(path)
-
-    # Step 3: Identify the longest boundary path
-    longest_path = max(paths, key=lambda path: len(path))
-    # Step 4: Back to edges
-    longest_path_edges = []
-    for i in range(len(longest_path)):
-        longest_path_edges.append(np.array([longest_path[i], longest_path[(i+1)%len(longest_path)]]))
-    return longest_path_edges
+def get_longest_boundary(boundary_edges):
+    print(f"Number of boundary edges: {len(boundary_edges)}")
+    loops, lengths = boundary_loops(boundary_edges)
+    # Identify the longest boundary path
+    longest_path = loops[int(np.argmax(lengths))]
+    print(f"Found {len(loops)} boundary loops, longest has {len(longest_path)} vertices")
+    # Back to edges
+    return np.stack([longest_path, np.roll(longest_path, -1)], axis=1)
 
 def get_boundary_edges(mesh):
     triangles = np.asarray(mesh.triangles)
@@ -1530,35 +1835,32 @@ def remove_branching_boundary_vertices(mesh):
     Parameters:
     - mesh 
     """
-    
+    triangles = np.asarray(mesh.triangles)
+    edge_table = MeshEdgeTable(triangles, len(mesh.vertices))
+    vertex_triangles_indptr, vertex_triangles = vertex_triangle_adjacency(triangles, len(mesh.vertices))
+
+    round_nr = 0
     while True:
-        triangles = np.asarray(mesh.triangles)
-        boundary_edges = get_boundary_edges(mesh)
-        
         # Identify boundary vertices with more than two boundary edges
-        vertex_count = np.bincount(boundary_edges.ravel())
-        branching_vertices = np.where(vertex_count > 2)[0]
-        
-        print(f"Building list of faces to remove for {len(branching_vertices)} branching vertices")
-
-        # Use a mask to identify triangles with branching vertices
-        mask = np.isin(triangles, branching_vertices).any(axis=1)
+        branching_vertices = edge_table.branching_vertices()
+        if len(branching_vertices) == 0:
+            break
 
-        # Find the indices of the triangles to remove
-        faces_to_remove = np.where(mask)[0]
+        # Alive triangles with branching vertices
+        candidate_triangles = np.concatenate([vertex_triangles[vertex_triangles_indptr[v]:vertex_triangles_indptr[v+1]] for v in branching_vertices])
+        mask = np.zeros(len(triangles), dtype=bool)
+        mask[candidate_triangles] = True
+        nr_removed = edge_table.remove_triangles(mask)
+        print(f"Round {round_nr}: removing {nr_removed} faces with branching vertices. Number of branching vertices: {len(branching_vertices)}.")
+        round_nr += 1
 
-        print(f"Removing {len(faces_to_remove)} faces with branching vertices. Number of branching vertices: {len(branching_vertices)}. Current number of vertices: {len(mesh.vertices)}")
-        
-        # Remove the identified faces
-        mesh.remove_triangles_by_index(faces_to_remove)
-        
-        # Clean up the mesh to remove isolated vertices
-        mesh = mesh.remove_unreferenced_vertices()
+    # Remove the identified faces
+    mesh.remove_triangles_by_mask(~edge_table.alive)
 
-        print(f"Number of vertices after removing faces and vertices: {len(mesh.vertices)}")
+    # Clean up the mesh to remove isolated vertices
+    mesh = mesh.remove_unreferenced_vertices()
 
-        if len(branching_vertices) == 0:
-            break
+    print(f"Number of vertices after removing faces and vertices: {len(mesh.vertices)}")
 
     return mesh
 
@@ -1580,57 +1882,66 @@ def subsample_mesh(mesh):
     print(f"Number of triangles is {len(mesh.triangles)} and number of vertices is {len(mesh.vertices)}")
     return mesh
 
-def repair_mesh(mesh, voxel_size):
-    print(f"Computing vertex normals")
-    mesh.compute_vertex_normals()
-    mesh.compute_triangle_normals()
-    mesh.orient_triangles()
+def run_repair_pass(report, name, function, mesh):
+    """
+    Run one repair pass on the mesh and record its time and the resulting mesh size.
+    """
+    time_start = time.time()
+    result = function(mesh)
+    # In place Open3D passes return None or the mesh itself
+    mesh = mesh if result is None or not isinstance(result, type(mesh)) else result
+    report.append((name, time.time() - time_start, len(mesh.vertices), len(mesh.triangles)))
+    return mesh
 
-    print(f"Cleaning mesh")
-    print(f"Number of vertices after merging: {len(mesh.vertices)}")
-    mesh = mesh.remove_duplicated_vertices()
-    print(f"Number of vertices after removing duplicates: {len(mesh.vertices)}")
-    mesh = mesh.remove_duplicated_triangles()
-    print(f"Number of vertices after removing duplicate triangles: {len(mesh.vertices)}")
-    mesh = mesh.remove_non_manifold_edges()
-    print(f"Number of vertices after removing non-manifold edges: {len(mesh.vertices)}")
-    print(f"Number of vertices after removing degenerate triangles: {len(mesh.vertices)}")
-    mesh = mesh.remove_unreferenced_vertices()
-    print(f"Number of vertices after cleaning: {len(mesh.vertices)}")
-    mesh = mesh.filter_smooth_taubin(number_of_iterations=1)
-    mesh = mesh.compute_vertex_normals()
-    mesh = mesh.compute_triangle_normals()
-    mesh = mesh.normalize_normals()
-    mesh.orient_triangles()
+def print_repair_report(report):
+    print(f"{'pass':>36} {'time [s]':>10} {'vertices':>12} {'triangles':>12}")
+    for name, time_, nr_vertices, nr_triangles in report:
+        print(f"{name:>36} {time_:10.3f} {nr_vertices:12d} {nr_triangles:12d}")
+    print(f"{'total':>36} {sum(entry[1] for entry in report):10.3f}")
 
-    mesh = mesh.merge_close_vertices(voxel_size/2)
-    mesh = mesh.remove_duplicated_vertices()
-    mesh = mesh.remove_duplicated_triangles()
-    mesh = mesh.remove_non_manifold_edges()
-    mesh = mesh.remove_unreferenced_vertices()
-    mesh = mesh.remove_non_manifold_edges()
+def remove_self_intersecting_triangles(mesh):
     indices = mesh.get_self_intersecting_triangles()
     indices = list(np.asarray(indices).flatten())
     mesh.remove_triangles_by_index(indices)
-    mesh = mesh.remove_unreferenced_vertices()
-    print(f"Number of vertices after smoothing: {len(mesh.vertices)}")
+    return mesh
 
+def repair_mesh(mesh, voxel_size):
+    """
+    Repair the mesh with a sequence of cleanup passes, reports time and mesh size after each pass.
+    Passes repeated back to back on an unchanged mesh (non-manifold edge removal, normal computation) run once.
+    """
+    report = []
+    mesh = run_repair_pass(report, "compute vertex normals", lambda m: m.compute_vertex_normals(), mesh)
+    mesh = run_repair_pass(report, "compute triangle normals", lambda m: m.compute_triangle_normals(), mesh)
+    mesh = run_repair_pass(report, "orient triangles", lambda m: m.orient_triangles(), mesh)
+
+    mesh = run_repair_pass(report, "remove duplicated vertices", lambda m: m.remove_duplicated_vertices(), mesh)
+    mesh = run_repair_pass(report, "remove duplicated triangles", lambda m: m.remove_duplicated_triangles(), mesh)
+    mesh = run_repair_pass(report, "remove non-manifold edges", lambda m: m.remove_non_manifold_edges(), mesh)
+    mesh = run_repair_pass(report, "remove unreferenced vertices", lambda m: m.remove_unreferenced_vertices(), mesh)
+    mesh = run_repair_pass(report, "taubin smoothing", lambda m: m.filter_smooth_taubin(number_of_iterations=1), mesh)
+    mesh = run_repair_pass(report, "compute vertex normals", lambda m: m.compute_vertex_normals(), mesh)
+    mesh = run_repair_pass(report, "compute triangle normals", lambda m: m.compute_triangle_normals(), mesh)
+    mesh = run_repair_pass(report, "normalize normals", lambda m: m.normalize_normals(), mesh)
+    mesh = run_repair_pass(report, "orient triangles", lambda m: m.orient_triangles(), mesh)
+
+    mesh = run_repair_pass(report, "merge close vertices", lambda m: m.merge_close_vertices(voxel_size/2), mesh)
+    mesh = run_repair_pass(report, "remove duplicated vertices", lambda m: m.remove_duplicated_vertices(), mesh)
+    mesh = run_repair_pass(report, "remove duplicated triangles", lambda m: m.remove_duplicated_triangles(), mesh)
+    mesh = run_repair_pass(report, "remove non-manifold edges", lambda m: m.remove_non_manifold_edges(), mesh)
+    mesh = run_repair_pass(report, "remove unreferenced vertices", lambda m: m.remove_unreferenced_vertices(), mesh)
+    mesh = run_repair_pass(report, "remove self intersecting triangles", remove_self_intersecting_triangles, mesh)
+    mesh = run_repair_pass(report, "remove unreferenced vertices", lambda m: m.remove_unreferenced_vertices(), mesh)
     print(f"Mesh is manifold: {mesh.is_vertex_manifold()}")
-    print(f"Number of vertices after hole filling: {len(mesh.vertices)}")
-
-    mesh = remove_branching_boundary_vertices(mesh)
 
-    print(f"Number of vertices after branching boundary removal: {len(mesh.vertices)}")
+    mesh = run_repair_pass(report, "remove branching boundary vertices", remove_branching_boundary_vertices, mesh)
     print(f"Mesh is manifold: {mesh.is_vertex_manifold()}")
 
-    mesh = mesh.compute_vertex_normals()
-    mesh = mesh.compute_triangle_normals()
-    mesh = mesh.normalize_normals()
-
-    mesh.compute_vertex_normals()
-    mesh.compute_triangle_normals()
-    mesh.normalize_normals()
+    mesh = run_repair_pass(report, "compute vertex normals", lambda m: m.compute_vertex_normals(), mesh)
+    mesh = run_repair_pass(report, "compute triangle normals", lambda m: m.compute_triangle_normals(), mesh)
+    mesh = run_repair_pass(report, "normalize normals", lambda m: m.normalize_normals(), mesh)
 
+    print_repair_report(report)
     return mesh
 
 def points_to_mesh(points, normals, radii=[0.1, 0.2, 0.3, 0.4, 0.5], umbilicus_func=None):
@@ -1699,12 +2010,15 @@ def shuffling_points_axis(points, normals, axis_indices):
     # Return points and normals
     return points, normals
 
-def save_mesh(mesh, path):
+def save_mesh(mesh, path, sidecar=False):
     """
-    Save mesh to path in binary format.
+    Save mesh to path in binary format. .obj meshes go through the streaming writer, with sidecar also as binary .ply for fast reloads.
     """
     area_factor_cm = ((0.00324 * 2) ** 2) / 100.0
     print(f"Surface Area is {mesh.get_surface_area() * area_factor_cm:.3f} cm^2")
+    if path.endswith(".obj"):
+        write_obj_mesh(path, mesh, sidecar=sidecar)
+        return
     # Save mesh to path in binary format
     o3d.io.write_triangle_mesh(path, mesh, write_ascii=False)
 
@@ -1713,6 +2027,8 @@ def load_mesh(path):
     Load mesh from path.
     """
     # Load mesh from path
+    if path.endswith(".obj"):
+        return read_obj_mesh(path)
     mesh = o3d.io.read_triangle_mesh(path)
     # Return mesh
     return mesh
@@ -1791,56 +2107,89 @@ def debug_pointcloud_sheet_colored(main_sheet, subvolume_size, path, axis_indice
     normals = np.zeros_like(points) + np.array([0, 1, 0])
     save_surface_ply(points, normals, filename, colors=colors)
 
-def triangle_area(v0, v1, v2):
-    """Compute the area of a triangle given its vertices."""
-    return 0.5 * np.linalg.norm(np.cross(v1 - v0, v2 - v0))
+def triangle_areas(vertices, triangles):
+    """Compute the areas of all triangles."""
+    corners = vertices[triangles]
+    return 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
 
-def longest_triangle_side(v0, v1, v2):
-    """Compute the length of the longest side of a triangle given its vertices."""
-    return max(np.linalg.norm(v1 - v0), np.linalg.norm(v2 - v1), np.linalg.norm(v0 - v2))
-
-def subdivide_triangle(vertices, tri, area_threshold):
-    """Recursively subdivide a triangle if its area is above the threshold."""
-    v0 = vertices[tri[0]]
-    v1 = vertices[tri[1]]
-    v2 = vertices[tri[2]]
-    area = triangle_area(v0, v1, v2)
+def bisect_triangles_longest_edge(vertices, triangles, area_threshold, max_rounds=100):
+    """
+    Iterative longest edge bisection until no triangle has an area above the threshold.
+    Each round marks the longest edge of every oversized triangle and closes the marking, such that every triangle with a marked edge
+    also has its longest edge marked. Every marked edge is split once at its midpoint (shared by both adjacent triangles, the mesh stays watertight)
+    and all triangles are split in bulk: first along their longest edge, then the halves along their other marked edges. Orientation is preserved.
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    for round_nr in range(max_rounds):
+        oversized = triangle_areas(vertices, triangles) > area_threshold
+        if not np.any(oversized):
+            break
 
-    if area > area_threshold:
-        m0 = (v0 + v1 + v2) / 3
-        vertices.extend([m0])
-        
-        children = [
-            [tri[0], tri[1], len(vertices)-1],
-            [tri[1], tri[2], len(vertices)-1],
-            [tri[2], tri[0], len(vertices)-1]
+        # Rotate the triangles so that (a, b) is the longest edge
+        corners = vertices[triangles]
+        edge_lengths = np.linalg.norm(corners[:, [1, 2, 0]] - corners, axis=2)
+        longest = np.argmax(edge_lengths, axis=1)
+        rotation = (longest[:, None] + np.arange(3)[None, :]) % 3
+        triangles = np.take_along_axis(triangles, rotation, axis=1)
+
+        # Unique edges (a, b), (b, c), (c, a) of all triangles
+        edges = np.stack([triangles, triangles[:, [1, 2, 0]]], axis=2).reshape(-1, 2)
+        keys = (np.minimum(edges[:, 0], edges[:, 1]).astype(np.uint64) << np.uint64(32)) | np.maximum(edges[:, 0], edges[:, 1]).astype(np.uint64)
+        unique_keys, edge_ids = np.unique(keys, return_inverse=True)
+        edge_ids = edge_ids.reshape(-1, 3)
+
+        # Mark the longest edges of oversized triangles and close the marking
+        marked = np.zeros(len(unique_keys), dtype=bool)
+        marked[edge_ids[oversized, 0]] = True
+        while True:
+            needs_longest = np.any(marked[edge_ids], axis=1) & ~marked[edge_ids[:, 0]]
+            if not np.any(needs_longest):
+                break
+            marked[edge_ids[needs_longest, 0]] = True
+
+        # One midpoint vertex per marked edge
+        marked_keys = unique_keys[marked]
+        midpoint_index = np.full(len(unique_keys), -1, dtype=np.int64)
+        midpoint_index[marked] = len(vertices) + np.arange(len(marked_keys))
+        edge_start = (marked_keys >> np.uint64(32)).astype(np.int64)
+        edge_end = (marked_keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        vertices = np.concatenate([vertices, 0.5 * (vertices[edge_start] + vertices[edge_end])])
+
+        a, b, c = triangles[:, 0], triangles[:, 1], triangles[:, 2]
+        m, n, p = midpoint_index[edge_ids[:, 0]], midpoint_index[edge_ids[:, 1]], midpoint_index[edge_ids[:, 2]]
+        split = m >= 0
+        split_bc = split & (n >= 0)
+        split_ca = split & (p >= 0)
+
+        new_triangles = [
+            triangles[~split],
+            # Half (a, m, c), split along (c, a) if marked
+            np.stack([a, m, c], axis=1)[split & ~split_ca],
+            np.stack([c, p, m], axis=1)[split_ca],
+            np.stack([p, a, m], axis=1)[split_ca],
+            # Half (m, b, c), split along (b, c) if marked
+            np.stack([m, b, c], axis=1)[split & ~split_bc],
+            np.stack([m, b, n], axis=1)[split_bc],
+            np.stack([m, n, c], axis=1)[split_bc],
         ]
-
-        # Recursively subdivide child triangles
-        result = []
-        for child in children:
-            result.extend(subdivide_triangle(vertices, child, area_threshold))
-        return result
-    else:
-        return [tri]
+        triangles = np.concatenate(new_triangles)
+        print(f"Remeshing round {round_nr}: {np.sum(oversized)} oversized triangles, split {len(marked_keys)} edges, {len(triangles)} triangles")
+    return vertices, triangles
 
 def isotropic_remeshing(mesh, area_threshold=700.0):
-    vertices = list(np.asarray(mesh.vertices))
+    vertices = np.asarray(mesh.vertices)
     triangles = np.asarray(mesh.triangles)
-    new_triangles = []
-
-    for tri in tqdm(triangles):
-        new_triangles.extend(subdivide_triangle(vertices, tri, area_threshold))
+    vertices, new_triangles = bisect_triangles_longest_edge(vertices, triangles, area_threshold)
 
     print(f"Extended from {len(triangles)} to {len(new_triangles)} triangles")
     # Construct the new mesh with subdivided triangles
     mesh = o3d.geometry.TriangleMesh()
-    mesh.vertices = o3d.utility.Vector3dVector(np.array(vertices))
+    mesh.vertices = o3d.utility.Vector3dVector(vertices)
     mesh.triangles = o3d.utility.Vector3iVector(new_triangles)
     print(f"Number of vertices: {len(mesh.vertices)}, number of triangles: {len(mesh.triangles)}")
     mesh = mesh.remove_duplicated_vertices()
     print(f"Number of vertices after merging: {len(mesh.vertices)}, number of triangles: {len(mesh.triangles)}")
-    mesh = mesh.remove_duplicated_vertices()
     mesh = mesh.remove_duplicated_triangles()
     mesh = mesh.compute_vertex_normals()
     mesh = mesh.compute_triangle_normals()
@@ -1878,15 +2227,24 @@ def main():
     parser.add_argument('--path_ta', type=str, help='Papyrus sheet under path_base (with custom .ta ending)', default=path_ta)
     parser.add_argument('--umbilicus_path', type=str, help='Path to umbilicus file', default=umbilicus_path)
     parser.add_argument('--include_boarder', action="store_true", help="Include boarder windings in final mesh generation")
+    parser.add_argument('--shard_path', type=str, help="Directory for out of core winding angle shards of the main sheet points. Keeps the points in memory if not set", default=None)
+    parser.add_argument('--benchmark', type=str, choices=["concat", "stitch"], help="Run a benchmark on synthetic data instead of meshing", default=None)
 
     
     # Take arguments back over
     args = parser.parse_args()
+    if args.benchmark == "concat":
+        benchmark_concat_patches_points()
+        return
+    if args.benchmark == "stitch":
+        benchmark_stitch_meshes()
+        return
     path_base = args.path_base
     path_ta = args.path_ta
     path_ta = path_base + path_ta
     side = args.side
     include_boarder = args.include_boarder
+    shard_path = args.shard_path
     pointcloud_folder_name = f"point_cloud_colorized_{side}_subvolume_blocks"
     path = path_base + pointcloud_folder_name
     path_load = os.path.dirname(os.path.dirname(path_base)) + "/" + pointcloud_folder_name
@@ -1919,16 +2277,18 @@ def main():
     # scale and swap axis
     umbilicus_data = scale_points(umbilicus_data, 1.0, axis_offset=-500)
     umbilicus_data, _ = shuffling_points_axis(umbilicus_data, umbilicus_data, axis_indices)
-    # Define a wrapper function for umbilicus_xz_at_y
-    umbilicus_func = lambda z: umbilicus_xy_at_z(umbilicus_data, z)
+    # Define a wrapper function for the umbilicus lookup table
+    umbilicus_lut = Umbilicus(umbilicus_data, axis=2)
+    umbilicus_func = lambda z: umbilicus_lut.position(np.asarray(z, dtype=np.float64).reshape(-1))
     # load main sheet info
     print("Loading main sheet info")
     if not continue_meshing:
         main_sheet_info, volume_blocks_scores = load_main_sheet(path=path_load, path_ta=path_ta, sample_ratio_score=None, sample_ratio=sample_ratio, add_display_points=False) # Only load the main sheet information. (patch angle, normal and score)
+        report_peak_rss("loading main sheet")
 
         # build main sheet pointcloud
         print("Building main sheet pointcloud")
-        main_sheet_points_org, cut_results = build_main_sheet_points_interpolted(main_sheet_info, subvolume_size=subvolume_size, path=path_load, winding_angle_threshold=winding_angle_threshold, winding_angle_threshold_cut=winding_angle_threshold_cut, min_num_points=min_num_points, umbilicus_path=umbilicus_path, sample_ratio=sample_ratio, overlap_y=overlap_y, only_originals=only_originals)
+        main_sheet_points_org, cut_results = build_main_sheet_points_interpolted(main_sheet_info, subvolume_size=subvolume_size, path=path_load, winding_angle_threshold=winding_angle_threshold, winding_angle_threshold_cut=winding_angle_threshold_cut, min_num_points=min_num_points, umbilicus_path=umbilicus_path, sample_ratio=sample_ratio, overlap_y=overlap_y, only_originals=only_originals, shard_path=shard_path)
 
         main_sheet_points_org = scale_points(main_sheet_points_org, scale, axis_offset=-500)
 
@@ -1964,7 +2324,8 @@ def main():
             mesh_range = np.clip(mesh_range, 0, np.array([x_range[1], y_range[1], z_range[1]]))
             mesh = trim_to_scroll(mesh, mesh_range[:,0], mesh_range[:,1], mesh_range[:,2])
 
-            save_mesh(mesh, path + f"_cut_{cut_nr}.obj")
+            # Reloaded when continuing the meshing
+            save_mesh(mesh, path + f"_cut_{cut_nr}.obj", sidecar=True)
             meshes.append((mesh, cut_normal))
     else:
         print("Continue meshing")
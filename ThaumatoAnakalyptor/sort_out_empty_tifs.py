@@ -1,62 +1,227 @@
 ### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
 
 import os
+import csv
+import time
 import tifffile
 import numpy as np
 import shutil
 import tqdm
-import numpy as np
+import argparse
+from multiprocessing import Pool, cpu_count
+
+# Per cell statistics index of a grid cell folder:
+#   <grid folder>/cell_stats.npz   filenames, size and mtime of the scanned files, mean, foreground fraction and histogram per cell,
+#                                  and the empty mean threshold chosen in the last sort_tif_by_mean run
+#   <grid folder>/cell_stats.csv   same statistics without the histograms, for inspection
+CELL_STATS_VERSION = 1
+CELL_STATS_FILENAME = "cell_stats.npz"
+# Histogram over the uint16 value range
+HISTOGRAM_BINS = 64
+HISTOGRAM_RANGE = (0, 65536)
+
+# filled mean value: 33774.121804304
+# empirical empty threshold value: 25259.996749536
+EMPTY_MEAN_THRESHOLD = 26000 # Empty tif volumes have less bright spots -> lower mean value, empirical threshold
+FOREGROUND_THRESHOLD = 33000
+
+# Per process cache of loaded empty cell sets
+_empty_cells = {}
+
+def scan_cell(args):
+    """
+    Statistics of a grid cell .tif from every page_stride-th z page. Returns (filename, mean, foreground fraction, histogram, number of pages read).
+    """
+    file_path, page_stride, foreground_threshold = args
+    histogram = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    with tifffile.TiffFile(file_path) as tif:
+        if len(tif.pages) > 1:
+            pages = [tif.pages[i].asarray() for i in range(0, len(tif.pages), page_stride)]
+        else:
+            # Volume stored in a single page, strided after decoding
+            volume = tif.asarray()
+            pages = list(volume[::page_stride]) if volume.ndim == 3 else [volume]
+    nr_values = 0
+    total = 0.0
+    nr_foreground = 0
+    for page in pages:
+        histogram += np.histogram(page, bins=HISTOGRAM_BINS, range=HISTOGRAM_RANGE)[0]
+        nr_values += page.size
+        total += float(np.sum(page, dtype=np.float64))
+        nr_foreground += int(np.count_nonzero(page > foreground_threshold))
+    mean_value = total / max(nr_values, 1)
+    foreground_fraction = nr_foreground / max(nr_values, 1)
+    return os.path.basename(file_path), mean_value, foreground_fraction, histogram, len(pages)
 
-def sort_tif_by_mean(src_folder, dest_folder, threshold):
+class CellStatsIndex():
     """
-    Moves .tif files from the src_folder to dest_folder if their mean value is 
-    smaller than the given threshold.
-    
+    Persistent per cell statistics of the grid cells in a folder. Cells are only rescanned if their file changed.
+    """
+    def __init__(self, folder, index_path=None):
+        self.folder = folder
+        self.index_path = index_path if index_path is not None else os.path.join(folder, CELL_STATS_FILENAME)
+        # filename -> (size, mtime_ns, mean, foreground fraction, histogram)
+        self.cells = {}
+        self.page_stride = None
+        # Mean threshold below which cells are empty, as chosen by the user. None if no threshold was chosen yet
+        self.empty_threshold = None
+        if os.path.isfile(self.index_path):
+            self.load()
+
+    def load(self):
+        data = np.load(self.index_path, allow_pickle=False)
+        if int(data["version"]) != CELL_STATS_VERSION:
+            print(f"Cell stats index {self.index_path} has an outdated version, rescanning all cells.")
+            return
+        self.page_stride = int(data["page_stride"])
+        if "empty_threshold" in data.files and not np.isnan(data["empty_threshold"]):
+            self.empty_threshold = float(data["empty_threshold"])
+        for filename, size, mtime, mean_value, foreground_fraction, histogram in zip(data["filenames"], data["sizes"], data["mtimes"], data["means"], data["foreground_fractions"], data["histograms"]):
+            self.cells[str(filename)] = (int(size), int(mtime), float(mean_value), float(foreground_fraction), histogram)
+
+    def save(self):
+        filenames = sorted(self.cells)
+        # Write to a temporary file first, then rename to not leave a corrupted index behind
+        temp_path = self.index_path + "_temp.npz"
+        np.savez(temp_path,
+                 version=CELL_STATS_VERSION,
+                 page_stride=self.page_stride if self.page_stride is not None else 1,
+                 empty_threshold=np.float64(self.empty_threshold if self.empty_threshold is not None else np.nan),
+                 filenames=np.array(filenames, dtype=str),
+                 sizes=np.array([self.cells[f][0] for f in filenames], dtype=np.int64),
+                 mtimes=np.array([self.cells[f][1] for f in filenames], dtype=np.int64),
+                 means=np.array([self.cells[f][2] for f in filenames], dtype=np.float64),
+                 foreground_fractions=np.array([self.cells[f][3] for f in filenames], dtype=np.float64),
+                 histograms=np.array([self.cells[f][4] for f in filenames], dtype=np.int64).reshape(-1, HISTOGRAM_BINS))
+        os.replace(temp_path, self.index_path)
+        csv_path = os.path.splitext(self.index_path)[0] + ".csv"
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["filename", "mean", "foreground_fraction"])
+            for filename in filenames:
+                writer.writerow([filename, f"{self.cells[filename][2]:.3f}", f"{self.cells[filename][3]:.6f}"])
+
+    def is_current(self, filename):
+        if filename not in self.cells or not os.path.isfile(os.path.join(self.folder, filename)):
+            return False
+        stat = os.stat(os.path.join(self.folder, filename))
+        return self.cells[filename][0] == stat.st_size and self.cells[filename][1] == stat.st_mtime_ns
+
+    def scan(self, page_stride=8, foreground_threshold=FOREGROUND_THRESHOLD, num_workers=None):
+        """
+        Scan all new or changed .tif cells of the folder in parallel and save the index.
+        """
+        if self.page_stride is not None and self.page_stride != page_stride:
+            print(f"Page stride changed from {self.page_stride} to {page_stride}, rescanning all cells.")
+            self.cells = {}
+        self.page_stride = page_stride
+        filenames = sorted(f for f in os.listdir(self.folder) if f.endswith('.tif'))
+        # Forget cells that were removed from the folder
+        self.cells = {f: self.cells[f] for f in filenames if f in self.cells}
+        to_scan = [f for f in filenames if not self.is_current(f)]
+        print(f"Scanning {len(to_scan)} of {len(filenames)} cells, every {page_stride}th page.")
+
+        num_workers = num_workers if num_workers is not None else cpu_count()
+        time_start = time.time()
+        nr_pages = 0
+        tasks = [(os.path.join(self.folder, f), page_stride, foreground_threshold) for f in to_scan]
+        with Pool(processes=num_workers) as pool:
+            for filename, mean_value, foreground_fraction, histogram, nr_pages_read in tqdm.tqdm(pool.imap_unordered(scan_cell, tasks), total=len(tasks)):
+                stat = os.stat(os.path.join(self.folder, filename))
+                self.cells[filename] = (stat.st_size, stat.st_mtime_ns, mean_value, foreground_fraction, histogram)
+                nr_pages += nr_pages_read
+        time_scan = time.time() - time_start
+        if len(to_scan) > 0:
+            print(f"Scanned {len(to_scan)} cells ({nr_pages} pages) in {time_scan:.2f}s, {len(to_scan) / max(time_scan, 1e-6):.1f} cells/s")
+        self.save()
+
+    def empty_cells(self, threshold=None):
+        """
+        Cells with a mean value below threshold, default the stored empty threshold. No cells are empty if no threshold was chosen.
+        """
+        threshold = threshold if threshold is not None else self.empty_threshold
+        if threshold is None:
+            return []
+        return sorted(filename for filename in self.cells if self.cells[filename][2] < threshold)
+
+def load_empty_cells(folder, index_path=None, verbose=False):
+    """
+    Set of the empty cell filenames of a grid folder from its stats index, without decoding the cell files. Cached per process.
+    Uses the threshold stored by sort_tif_by_mean. Cells whose size or mtime changed since the scan are not returned and are read normally.
+    Returns an empty set if the folder has no index or no threshold was chosen.
+    """
+    index_path = index_path if index_path is not None else os.path.join(folder, CELL_STATS_FILENAME)
+    key = os.path.abspath(index_path)
+    if key not in _empty_cells:
+        if os.path.isfile(index_path):
+            cell_stats = CellStatsIndex(folder, index_path=index_path)
+            empty_cells = cell_stats.empty_cells()
+            stale_cells = set(filename for filename in cell_stats.cells if not cell_stats.is_current(filename))
+            _empty_cells[key] = set(filename for filename in empty_cells if filename not in stale_cells)
+            if verbose:
+                print(f"{len(stale_cells)} of {len(cell_stats.cells)} entries of {index_path} are stale, {len(empty_cells) - len(_empty_cells[key])} of {len(empty_cells)} empty cells are not skipped.")
+        else:
+            _empty_cells[key] = set()
+    return _empty_cells[key]
+
+def sort_tif_by_mean(src_folder, dest_folder, threshold, page_stride=8, dry_run=True, num_workers=None):
+    """
+    Scans the .tif cells of src_folder into the cell stats index and reports the cells with a mean value smaller than the threshold.
+    Without dry_run, moves them to dest_folder. The threshold is stored in the index for load_empty_cells.
+
     :param src_folder: Source directory path.
     :param dest_folder: Destination directory path.
     :param threshold: Mean value threshold.
     """
-    
+    cell_stats = CellStatsIndex(src_folder)
+    cell_stats.empty_threshold = threshold
+    cell_stats.scan(page_stride=page_stride, num_workers=num_workers)
+    empty_cells = cell_stats.empty_cells(threshold)
+
+    means = np.array([cell_stats.cells[f][2] for f in cell_stats.cells])
+    print(f"{len(empty_cells)} of {len(cell_stats.cells)} cells have a mean value below {threshold}.")
+    if len(means) > 0:
+        counts, edges = np.histogram(means, bins=10)
+        print("Distribution of the cell mean values:")
+        for count, edge_start, edge_end in zip(counts, edges[:-1], edges[1:]):
+            print(f"  {edge_start:9.1f} - {edge_end:9.1f}: {count}")
+
+    if dry_run:
+        report_path = os.path.join(src_folder, "empty_cells_report.csv")
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(["filename", "mean", "foreground_fraction"])
+            for filename in empty_cells:
+                writer.writerow([filename, f"{cell_stats.cells[filename][2]:.3f}", f"{cell_stats.cells[filename][3]:.6f}"])
+        print(f"Dry run, wrote the cells that would be moved to {report_path}")
+        return empty_cells
+
     # Ensure destination folder exists
     if not os.path.exists(dest_folder):
         os.makedirs(dest_folder)
-
-    files = os.listdir(src_folder)
-    # Shuffle
-    np.random.shuffle(files)
-
-    # Loop through all files in the source folder
-    for filename in tqdm.tqdm(files):
-        if filename.endswith('.tif'):
-            file_path = os.path.join(src_folder, filename)
-            
-            with tifffile.TiffFile(file_path) as tif:
-                volume = tif.asarray()
-            
-                # Compute mean of the volume
-                mean_value = np.mean(volume)
-                
-                # If the mean is below the threshold, move the file
-                if mean_value < threshold:
-                    print(f"Moving {filename} with mean value {mean_value} to {dest_folder}")
-                    shutil.move(file_path, os.path.join(dest_folder, filename))
-                    print("Done.")
+    for filename in tqdm.tqdm(empty_cells):
+        shutil.move(os.path.join(src_folder, filename), os.path.join(dest_folder, filename))
+    print(f"Moved {len(empty_cells)} cells to {dest_folder}")
+    # Moved cells are dropped from the index on the next scan
+    cell_stats.cells = {f: cell_stats.cells[f] for f in cell_stats.cells if f not in set(empty_cells)}
+    cell_stats.save()
+    return empty_cells
 
 def compute_mean_of_tif_volume(tif_path):
     """
     Compute and print the mean value of a .tif volume.
-    
+
     :param tif_path: Path to the .tif file.
     """
     with tifffile.TiffFile(tif_path) as tif:
         volume = tif.asarray()
-        
+
         # Ensure the array is 3D (assuming single channel data)
         if len(volume.shape) != 3:
             raise ValueError("The provided TIF does not seem to be a 3D volume.")
-        
+
         mean_value = np.mean(volume)
-        
+
         print(f"Mean value of the .tif volume: {mean_value}")
 
 '''# Example usage
@@ -71,10 +236,18 @@ compute_mean_of_tif_volume(tif_path)
 tif_path = "../scroll1_grids/cell_yxz_003_008_015.tif"
 compute_mean_of_tif_volume(tif_path)'''
 
-# filled mean value: 33774.121804304
-# empirical empty threshold value: 25259.996749536
+if __name__ == '__main__':
+    src = "scroll3_grids"
+    dst = "scroll3_grids_empty"
+    thresh = EMPTY_MEAN_THRESHOLD
+
+    parser = argparse.ArgumentParser(description="Scan grid cells into a per cell stats index (cell_stats.npz/.csv) and report or move the empty cells")
+    parser.add_argument("--src", type=str, help="Folder with the grid cells", default=src)
+    parser.add_argument("--dst", type=str, help="Folder to move the empty cells to", default=dst)
+    parser.add_argument("--threshold", type=float, help="Cells with a mean value below the threshold are empty", default=thresh)
+    parser.add_argument("--page_stride", type=int, help="Read every n-th z page of a cell for the statistics", default=8)
+    parser.add_argument("--num_workers", type=int, help="Number of scanning processes", default=None)
+    parser.add_argument("--move", action="store_true", help="Move the empty cells to dst instead of only reporting them (dry run)")
+    args = parser.parse_args()
 
-src = "scroll3_grids"
-dst = "scroll3_grids_empty"
-thresh = 26000  # Empty tif volumes have less bright spots -> lower mean value, empirical threshold
-sort_tif_by_mean(src, dst, thresh)
\ No newline at end of file
+    sort_tif_by_mean(args.src, args.dst, args.threshold, page_stride=args.page_stride, dry_run=not args.move, num_workers=args.num_workers)
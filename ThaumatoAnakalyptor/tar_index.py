@@ -0,0 +1,291 @@
+### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
+
+import numpy as np
+import os
+import io
+import json
+import glob
+import time
+import tarfile
+import tempfile
+import argparse
+import open3d as o3d
+from tqdm import tqdm
+
+# Version of the on disk index format, bump when the layout changes
+TAR_INDEX_VERSION = 1
+
+# Per process cache of loaded tar indices
+_tar_indices = {}
+
+PLY_DTYPES = {
+    "char": "i1", "int8": "i1",
+    "uchar": "u1", "uint8": "u1",
+    "short": "i2", "int16": "i2",
+    "ushort": "u2", "uint16": "u2",
+    "int": "i4", "int32": "i4",
+    "uint": "u4", "uint32": "u4",
+    "float": "f4", "float32": "f4",
+    "double": "f8", "float64": "f8",
+}
+
+def parse_ply_header(data):
+    """
+    Parse the header of a .ply file held in memory.
+    Returns the format, the list of elements (name, count, properties) and the byte offset of the body.
+    """
+    header_end = data.find(b"end_header")
+    assert header_end >= 0, "No end_header found in ply data."
+    body_offset = data.index(b"\n", header_end) + 1
+    header_lines = data[:header_end].decode("ascii").splitlines()
+    assert header_lines[0].strip() == "ply", "Data is not a ply file."
+
+    ply_format = None
+    elements = []
+    for line in header_lines[1:]:
+        tokens = line.split()
+        if len(tokens) == 0 or tokens[0] in ("comment", "obj_info"):
+            continue
+        if tokens[0] == "format":
+            ply_format = tokens[1]
+        elif tokens[0] == "element":
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == "property":
+            if tokens[1] == "list":
+                elements[-1][2].append((tokens[4], None))
+            else:
+                elements[-1][2].append((tokens[2], PLY_DTYPES[tokens[1]]))
+    assert ply_format is not None, "No format found in ply header."
+    return ply_format, elements, body_offset
+
+def parse_ply_bytes(data):
+    """
+    Parse point cloud data from a .ply file held in memory.
+    Returns points, normals and colors like o3d.io.read_point_cloud. Colors are mapped to [0, 1] by 255 like Open3D does.
+    """
+    ply_format, elements, body_offset = parse_ply_header(data)
+    assert elements[0][0] == "vertex", f"Only ply files starting with a vertex element are supported, found {elements[0][0]}."
+    _, nr_vertices, properties = elements[0]
+    assert all(dtype is not None for _, dtype in properties), "List properties are not supported for vertices."
+
+    if ply_format == "ascii":
+        vertices = np.loadtxt(io.BytesIO(data[body_offset:]), max_rows=nr_vertices, ndmin=2)
+        columns = {name: vertices[:, i] for i, (name, _) in enumerate(properties)}
+    else:
+        byte_order = "<" if ply_format == "binary_little_endian" else ">"
+        dtype = np.dtype([(name, byte_order + dtype) for name, dtype in properties])
+        vertices = np.frombuffer(data, dtype=dtype, count=nr_vertices, offset=body_offset)
+        columns = {name: vertices[name] for name, _ in properties}
+
+    def stack(names, scale=1.0):
+        if not all(name in columns for name in names):
+            return np.zeros((0, 3), dtype=np.float64)
+        array = np.empty((nr_vertices, len(names)), dtype=np.float64)
+        for i, name in enumerate(names):
+            array[:, i] = columns[name]
+        if scale != 1.0:
+            array *= scale
+        return array
+
+    points = stack(("x", "y", "z"))
+    normals = stack(("nx", "ny", "nz"))
+    colors = stack(("red", "green", "blue"), scale=1.0 / 255.0)
+
+    return points, normals, colors
+
+class TarIndex():
+    """
+    Index of the members of a tar archive (member name -> data offset and size).
+    Members are read directly from the archive bytes, no extraction needed.
+    """
+    def __init__(self, tar_filename, members, tar_size, tar_mtime):
+        self.tar_filename = tar_filename
+        self.members = members
+        self.tar_size = tar_size
+        self.tar_mtime = tar_mtime
+
+    @staticmethod
+    def index_filename(tar_filename):
+        return tar_filename + ".index.json"
+
+    @classmethod
+    def build(cls, tar_filename):
+        stat = os.stat(tar_filename)
+        members = {}
+        with tarfile.open(tar_filename, 'r') as archive:
+            for member in archive:
+                if member.isfile():
+                    members[member.name] = (member.offset_data, member.size)
+        return cls(tar_filename, members, stat.st_size, stat.st_mtime_ns)
+
+    @classmethod
+    def load(cls, tar_filename, cache_on_disk=True):
+        """
+        Load the index of a tar from its cached index file, (re)build and cache it if missing or outdated.
+        """
+        stat = os.stat(tar_filename)
+        index_filename = cls.index_filename(tar_filename)
+        if os.path.isfile(index_filename):
+            try:
+                with open(index_filename, 'r') as f:
+                    cached = json.load(f)
+                if cached["version"] == TAR_INDEX_VERSION and cached["tar_size"] == stat.st_size and cached["tar_mtime"] == stat.st_mtime_ns:
+                    members = {name: tuple(entry) for name, entry in cached["members"].items()}
+                    return cls(tar_filename, members, stat.st_size, stat.st_mtime_ns)
+            except (ValueError, KeyError, OSError):
+                pass
+
+        tar_index = cls.build(tar_filename)
+        if cache_on_disk:
+            tar_index.save()
+        return tar_index
+
+    def save(self):
+        # Write to a temporary file first, then rename to not leave corrupted indices behind
+        index_filename = self.index_filename(self.tar_filename)
+        temp_filename = index_filename + "_temp"
+        try:
+            with open(temp_filename, 'w') as f:
+                json.dump({"version": TAR_INDEX_VERSION, "tar_size": self.tar_size, "tar_mtime": self.tar_mtime, "members": self.members}, f)
+            os.replace(temp_filename, index_filename)
+        except OSError as e:
+            # Read only drives: index stays in memory only
+            print(f"Could not cache tar index {index_filename}: {e}")
+
+    def names(self):
+        return list(self.members.keys())
+
+    def __contains__(self, name):
+        return name in self.members
+
+    def read_bytes(self, name):
+        offset, size = self.members[name]
+        with open(self.tar_filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size)
+        assert len(data) == size, f"Could not read member {name} from {self.tar_filename}."
+        return data
+
+    def read_many(self, names):
+        """
+        Read several members in one pass over the archive, ordered by their offset.
+        """
+        results = {}
+        with open(self.tar_filename, 'rb') as f:
+            for name in sorted(names, key=lambda name: self.members[name][0]):
+                offset, size = self.members[name]
+                f.seek(offset)
+                results[name] = f.read(size)
+        return results
+
+    def read_json(self, name):
+        return json.loads(self.read_bytes(name))
+
+    def read_ply(self, name):
+        return parse_ply_bytes(self.read_bytes(name))
+
+def get_tar_index(tar_filename, cache_on_disk=True):
+    """
+    Return the index of a tar. Cached per process, invalidated if the tar changes on disk.
+    """
+    tar_filename = os.path.abspath(tar_filename)
+    stat = os.stat(tar_filename)
+    tar_index = _tar_indices.get(tar_filename)
+    if tar_index is None or tar_index.tar_size != stat.st_size or tar_index.tar_mtime != stat.st_mtime_ns:
+        tar_index = TarIndex.load(tar_filename, cache_on_disk=cache_on_disk)
+        _tar_indices[tar_filename] = tar_index
+    return tar_index
+
+def parse_metadata(metadata):
+    # Convert lists back to numpy arrays where needed
+    coeff = np.array(metadata['coeff']) if 'coeff' in metadata and metadata['coeff'] is not None else None
+    n = int(metadata['n']) if 'n' in metadata and metadata['n'] is not None else None
+    score = metadata.get('score')
+    distance = metadata.get('distance')
+    return score, distance, coeff, n
+
+def load_ply_from_tar(tar_filename, ply_filename_inside_tar):
+    """
+    Load point cloud data and its metadata of a .ply member of a tarball.
+    Same return values as instances_to_sheets.load_ply.
+    """
+    tar_index = get_tar_index(tar_filename)
+    base_filename_without_extension = os.path.splitext(ply_filename_inside_tar)[0]
+    metadata_filename_inside_tar = f"metadata_{base_filename_without_extension}.json"
+    members = tar_index.read_many([ply_filename_inside_tar, metadata_filename_inside_tar])
+
+    points, normals, colors = parse_ply_bytes(members[ply_filename_inside_tar])
+    score, distance, coeff, n = parse_metadata(json.loads(members[metadata_filename_inside_tar]))
+
+    return points, normals, colors, score, distance, coeff, n
+
+def load_tar_block(tar_filename):
+    """
+    Load all .ply members of a tarball with their metadata in one pass.
+    Returns a dict of member name -> (points, normals, colors, score, distance, coeff, n).
+    """
+    tar_index = get_tar_index(tar_filename)
+    names = tar_index.names()
+    ply_names = [name for name in names if name.endswith(".ply")]
+    metadata_names = [f"metadata_{os.path.splitext(name)[0]}.json" for name in ply_names]
+    members = tar_index.read_many(ply_names + [name for name in metadata_names if name in tar_index])
+
+    block = {}
+    for ply_name, metadata_name in zip(ply_names, metadata_names):
+        points, normals, colors = parse_ply_bytes(members[ply_name])
+        metadata = json.loads(members[metadata_name]) if metadata_name in members else {}
+        block[ply_name] = (points, normals, colors, *parse_metadata(metadata))
+    return block
+
+def benchmark_tar_index(directory, max_tars=None):
+    """
+    Compare loading all .ply members of the block tars in a directory through
+    tempdir extraction + Open3D against the tar index + in memory ply parser.
+    """
+    tar_files = sorted(glob.glob(os.path.join(directory, "*.tar")))
+    if max_tars is not None:
+        tar_files = tar_files[:max_tars]
+    assert len(tar_files) > 0, f"No .tar files found in {directory}."
+    nr_bytes = sum(os.path.getsize(tar_file) for tar_file in tar_files)
+
+    # Extraction to a temporary directory and Open3D reading
+    nr_members = 0
+    time_start = time.time()
+    for tar_file in tqdm(tar_files, desc="extract"):
+        with tarfile.open(tar_file, 'r') as archive, tempfile.TemporaryDirectory() as temp_dir:
+            archive.extractall(path=temp_dir)
+            for ply_file in glob.glob(os.path.join(temp_dir, "*.ply")):
+                pcd = o3d.io.read_point_cloud(ply_file)
+                np.asarray(pcd.points), np.asarray(pcd.normals), np.asarray(pcd.colors)
+                nr_members += 1
+    time_extract = time.time() - time_start
+
+    # Index build (first access) and in memory parsing
+    _tar_indices.clear()
+    for tar_file in tar_files:
+        index_filename = TarIndex.index_filename(os.path.abspath(tar_file))
+        if os.path.isfile(index_filename):
+            os.remove(index_filename)
+    time_start = time.time()
+    for tar_file in tqdm(tar_files, desc="index build"):
+        load_tar_block(tar_file)
+    time_index_cold = time.time() - time_start
+
+    # Cached index
+    _tar_indices.clear()
+    time_start = time.time()
+    for tar_file in tqdm(tar_files, desc="index cached"):
+        load_tar_block(tar_file)
+    time_index_cached = time.time() - time_start
+
+    print(f"{len(tar_files)} tars, {nr_members} ply members, {nr_bytes / 1e6:.1f} MB")
+    for name, time_ in (("extract + open3d", time_extract), ("tar index (build)", time_index_cold), ("tar index (cached)", time_index_cached)):
+        print(f"{name:>20}: {time_:8.2f}s, {nr_members / max(time_, 1e-6):10.1f} members/s, {nr_bytes / 1e6 / max(time_, 1e-6):8.1f} MB/s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the tar member index against tar extraction for instance patch archives')
+    parser.add_argument('--path', type=str, help='Directory containing the block .tar files', required=True)
+    parser.add_argument('--max_tars', type=int, help='Maximum number of tars to benchmark', default=None)
+    args = parser.parse_args()
+
+    benchmark_tar_index(args.path, max_tars=args.max_tars)
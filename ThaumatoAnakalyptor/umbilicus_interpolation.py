@@ -0,0 +1,156 @@
+### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
+
+import numpy as np
+import os
+import time
+import hashlib
+import argparse
+from scipy.interpolate import interp1d
+
+# Per process caches of loaded umbilicus files and built umbilicus lookup tables
+_umbilicus_files = {}
+_umbilicus_lookups = {}
+
+class Umbilicus():
+    """
+    Piecewise linear umbilicus curve parametrized by one axis (y for the scroll coordinates of the pointclouds, z for the mesh coordinates).
+    A dense lookup table over the range of the umbilicus maps each cell of the axis to its curve segment, queries are array indexing only.
+    Values outside the range are extrapolated linearly like interp1d(..., fill_value="extrapolate").
+    """
+    def __init__(self, points_array, axis=1, cells_per_knot=4):
+        points_array = np.asarray(points_array, dtype=np.float64).reshape(-1, 3)
+        assert len(points_array) >= 2, "Umbilicus needs at least two points."
+        self.axis = axis
+        self.other_axes = [i for i in range(3) if i != axis]
+
+        # Knots sorted along the parametrizing axis
+        order = np.argsort(points_array[:, axis], kind='stable')
+        self.knots = points_array[order, axis]
+        self.knot_points = points_array[order]
+        # Per segment slope of the curve
+        self.slopes = (self.knot_points[1:] - self.knot_points[:-1]) / (self.knots[1:] - self.knots[:-1])[:, None]
+
+        # Lookup table: first segment of each cell
+        nr_cells = int(np.clip(cells_per_knot * len(self.knots), 1024, 1 << 22))
+        self.lut_start = self.knots[0]
+        extent = self.knots[-1] - self.knots[0]
+        self.lut_step = extent / nr_cells if extent > 0 else 1.0
+        cell_starts = self.lut_start + np.arange(nr_cells + 1) * self.lut_step
+        self.lut_segments = np.clip(np.searchsorted(self.knots, cell_starts, side='right') - 1, 0, len(self.knots) - 2)
+        # Number of knots inside a cell, the segment of a query is at most that many segments after the cell's first segment
+        self.max_knots_per_cell = int(np.max(np.clip(np.searchsorted(self.knots, cell_starts + self.lut_step, side='right') - 1, 0, len(self.knots) - 2) - self.lut_segments))
+
+    def segments(self, values):
+        cells = np.clip(((values - self.lut_start) / self.lut_step).astype(np.int64), 0, len(self.lut_segments) - 1)
+        segments = self.lut_segments[cells]
+        for _ in range(self.max_knots_per_cell):
+            segments += (segments < len(self.knots) - 2) & (values >= self.knots[np.minimum(segments + 1, len(self.knots) - 1)])
+        return segments
+
+    def position(self, values):
+        """
+        Umbilicus points at the given values of the parametrizing axis. Returns an array of shape values.shape + (3,).
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values_flat = values.reshape(-1)
+        segments = self.segments(values_flat)
+        positions = self.knot_points[segments] + self.slopes[segments] * (values_flat - self.knots[segments])[:, None]
+        # Exact query values on the parametrizing axis
+        positions[:, self.axis] = values_flat
+        return positions.reshape(values.shape + (3,))
+
+    def offsets(self, points):
+        """
+        Vectors from the umbilicus to the points, at the height of each point.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        return points - self.position(points[..., self.axis])
+
+    def radius(self, points):
+        """
+        Distance of the points to the umbilicus at their height.
+        """
+        offsets = self.offsets(points)
+        return np.linalg.norm(offsets[..., self.other_axes], axis=-1)
+
+    def angle(self, points):
+        """
+        Angle in degrees (-180, 180] of the points around the umbilicus, in the plane perpendicular to the parametrizing axis.
+        """
+        offsets = self.offsets(points)
+        return np.degrees(np.arctan2(offsets[..., self.other_axes[1]], offsets[..., self.other_axes[0]]))
+
+def load_umbilicus_points(umbilicus_path):
+    """
+    Load the comma separated umbilicus points of a file. Cached per process, reloaded if the file changes.
+    """
+    umbilicus_path = os.path.abspath(umbilicus_path)
+    mtime = os.stat(umbilicus_path).st_mtime_ns
+    cached = _umbilicus_files.get(umbilicus_path)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, np.loadtxt(umbilicus_path, delimiter=','))
+        _umbilicus_files[umbilicus_path] = cached
+    return cached[1]
+
+def umbilicus_lookup(points_array, axis=1):
+    """
+    Umbilicus lookup table of the points, cached per process by the content of the points.
+    """
+    points_array = np.ascontiguousarray(points_array, dtype=np.float64)
+    key = (hashlib.sha1(points_array.tobytes()).hexdigest(), points_array.shape, axis)
+    umbilicus = _umbilicus_lookups.get(key)
+    if umbilicus is None:
+        umbilicus = Umbilicus(points_array, axis=axis)
+        _umbilicus_lookups[key] = umbilicus
+    return umbilicus
+
+def get_umbilicus(umbilicus_path, axis=1):
+    """
+    Umbilicus lookup table of an umbilicus file.
+    """
+    return umbilicus_lookup(load_umbilicus_points(umbilicus_path), axis=axis)
+
+def benchmark_umbilicus(umbilicus_path=None, nr_calls=2000, nr_queries=100000, seed=0):
+    """
+    Benchmark umbilicus queries through a fresh interp1d per call against the cached lookup table.
+    """
+    rng = np.random.default_rng(seed)
+    if umbilicus_path is not None:
+        umbilicus_points = load_umbilicus_points(umbilicus_path)
+    else:
+        # Synthetic wobbly umbilicus along y
+        y = np.arange(0, 14000, 50, dtype=np.float64)
+        umbilicus_points = np.stack([4000 + 200 * np.sin(y / 1500) + rng.normal(0, 5, len(y)), y, 4000 + 200 * np.cos(y / 1700) + rng.normal(0, 5, len(y))], axis=1)
+    y_min, y_max = np.min(umbilicus_points[:, 1]), np.max(umbilicus_points[:, 1])
+    print(f"{len(umbilicus_points)} umbilicus points")
+
+    # Single point queries (patch centroids) and large batches (pointclouds, mesh vertices)
+    for nr_queries_ in sorted(set([1, nr_queries])):
+        queries = [rng.uniform(y_min - 500, y_max + 500, size=nr_queries_) for _ in range(nr_calls)]
+
+        time_start = time.time()
+        results_interp1d = []
+        for y_new in queries:
+            x, y, z = umbilicus_points.T
+            fx = interp1d(y, x, kind='linear', fill_value="extrapolate")
+            fz = interp1d(y, z, kind='linear', fill_value="extrapolate")
+            results_interp1d.append(np.array([fx(y_new), y_new, fz(y_new)]).T)
+        time_interp1d = time.time() - time_start
+
+        _umbilicus_lookups.clear()
+        time_start = time.time()
+        results_lookup = [umbilicus_lookup(umbilicus_points, axis=1).position(y_new) for y_new in queries]
+        time_lookup = time.time() - time_start
+
+        max_difference = max(np.max(np.abs(result_interp1d - result_lookup)) for result_interp1d, result_lookup in zip(results_interp1d, results_lookup))
+        assert max_difference < 1e-6 * max(1.0, np.max(np.abs(umbilicus_points))), f"Lookup table deviates from interp1d by {max_difference}"
+        print(f"{nr_calls} calls with {nr_queries_} queries each, max difference {max_difference:.2e}: interp1d per call {time_interp1d:.3f}s, lookup table {time_lookup:.3f}s, speedup {time_interp1d / max(time_lookup, 1e-6):.1f}x")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the umbilicus lookup table against interp1d')
+    parser.add_argument('--umbilicus_path', type=str, help='Path to umbilicus file, synthetic umbilicus if not given', default=None)
+    parser.add_argument('--nr_calls', type=int, help='Number of query calls', default=2000)
+    parser.add_argument('--nr_queries', type=int, help='Number of queries per call', default=100000)
+    args = parser.parse_args()
+
+    benchmark_umbilicus(args.umbilicus_path, nr_calls=args.nr_calls, nr_queries=args.nr_queries)
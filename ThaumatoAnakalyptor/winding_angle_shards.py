@@ -0,0 +1,164 @@
+### Julian Schilliger - ThaumatoAnakalyptor - Vesuvius Challenge 2023
+
+import numpy as np
+import os
+import json
+import resource
+
+# Winding angle sharded point accumulation:
+#   <directory>/manifest.json        bucket angle, record layout, patch keys and number of records per shard
+#   <directory>/bucket_<b>.bin       records of the points with winding angle in [b * bucket_angle, (b + 1) * bucket_angle)
+#   <directory>/org_points.bin       original (unfiltered) patch points, float64 x, y, z
+# Records of one patch are written consecutively with increasing sequence numbers, sorting by sequence restores the accumulation order.
+WINDING_ANGLE_SHARDS_VERSION = 1
+
+RECORD_DTYPE = np.dtype([
+    ("sequence", "<i8"),
+    ("patch", "<i8"),
+    ("main_sheet_point", "<f8", (3,)),
+    ("point", "<f8", (3,)),
+    ("normal", "<f8", (3,)),
+    ("color", "<f8", (3,)),
+    ("winding_angle", "<f8"),
+    ("weight", "<f8"),
+])
+
+def peak_rss_gb():
+    """
+    Peak resident set size of this process and of its largest finished child process in GB.
+    """
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1e6
+
+def report_peak_rss(stage):
+    peak_rss, peak_rss_children = peak_rss_gb()
+    print(f"Peak RSS after {stage}: {peak_rss:.2f} GB (workers: {peak_rss_children:.2f} GB)")
+
+class WindingAngleShards():
+    """
+    Out of core accumulation of the per patch points of the main sheet, bucketed by half windings of their winding angle.
+    Reading an angle range only loads the shards overlapping it.
+    """
+    def __init__(self, directory, bucket_angle=180.0):
+        self.directory = directory
+        self.bucket_angle = float(bucket_angle)
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.org_points_path = os.path.join(directory, "org_points.bin")
+        # patch index -> (volume_id, patch_nr)
+        self.patch_keys = []
+        # bucket -> number of records
+        self.bucket_counts = {}
+        self.nr_org_points = 0
+        self.nr_records = 0
+        self.files = {}
+        self.org_points_file = None
+
+        # Shards of an earlier run are outdated, only the files of this store are removed
+        if os.path.isdir(directory):
+            store_files = [f for f in os.listdir(directory) if self.is_store_file(f)]
+            other_files = [f for f in os.listdir(directory) if not self.is_store_file(f)]
+            assert os.path.isfile(self.manifest_path) or len(other_files) == 0, f"Shard directory {directory} is not empty and holds no winding angle shards, refusing to use it."
+            for f in store_files:
+                os.remove(os.path.join(directory, f))
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def is_store_file(filename):
+        return filename in ("manifest.json", "manifest.json_temp", "org_points.bin") or (filename.startswith("bucket_") and filename.endswith(".bin"))
+
+    def bucket_path(self, bucket):
+        return os.path.join(self.directory, f"bucket_{bucket}.bin")
+
+    def bucket_of(self, winding_angles):
+        return np.floor(np.asarray(winding_angles) / self.bucket_angle).astype(np.int64)
+
+    def append_patch(self, volume_id, patch_nr, main_sheet_points, points, normals, colors, winding_angles, weights):
+        """
+        Append the points of a patch to the shards of their winding angles.
+        """
+        patch_index = len(self.patch_keys)
+        self.patch_keys.append((tuple(int(v) for v in volume_id), int(patch_nr)))
+        nr_points = len(winding_angles)
+        if nr_points == 0:
+            return
+
+        records = np.empty(nr_points, dtype=RECORD_DTYPE)
+        records["sequence"] = np.arange(self.nr_records, self.nr_records + nr_points)
+        records["patch"] = patch_index
+        records["main_sheet_point"] = main_sheet_points
+        records["point"] = points
+        records["normal"] = normals
+        records["color"] = colors
+        records["winding_angle"] = winding_angles
+        records["weight"] = weights
+        self.nr_records += nr_points
+
+        buckets = self.bucket_of(winding_angles)
+        order = np.argsort(buckets, kind='stable')
+        unique_buckets, starts = np.unique(buckets[order], return_index=True)
+        ends = np.append(starts[1:], nr_points)
+        for bucket, start, end in zip(unique_buckets, starts, ends):
+            bucket = int(bucket)
+            if bucket not in self.files:
+                self.files[bucket] = open(self.bucket_path(bucket), 'ab')
+            records[order[start:end]].tofile(self.files[bucket])
+            self.bucket_counts[bucket] = self.bucket_counts.get(bucket, 0) + int(end - start)
+
+    def append_org_points(self, points):
+        if self.org_points_file is None:
+            self.org_points_file = open(self.org_points_path, 'ab')
+        np.ascontiguousarray(points, dtype="<f8").tofile(self.org_points_file)
+        self.nr_org_points += len(points)
+
+    def close(self):
+        """
+        Flush the shards and write the manifest.
+        """
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        if self.org_points_file is not None:
+            self.org_points_file.close()
+            self.org_points_file = None
+        manifest = {
+            "version": WINDING_ANGLE_SHARDS_VERSION,
+            "bucket_angle": self.bucket_angle,
+            "record_dtype": RECORD_DTYPE.descr,
+            "patch_keys": self.patch_keys,
+            "bucket_counts": {str(bucket): count for bucket, count in self.bucket_counts.items()},
+            "nr_org_points": self.nr_org_points,
+        }
+        with open(self.manifest_path + "_temp", 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_path + "_temp", self.manifest_path)
+        print(f"Wrote {self.nr_records} points of {len(self.patch_keys)} patches into {len(self.bucket_counts)} winding angle shards, {self.nr_records * RECORD_DTYPE.itemsize / 1e9:.2f} GB")
+
+    def buckets_in_range(self, angle_start, angle_end):
+        first, last = self.bucket_of([angle_start, angle_end])
+        return [bucket for bucket in sorted(self.bucket_counts) if first <= bucket <= last]
+
+    def load_angle_range(self, angle_start, angle_end):
+        """
+        Points dict {volume_id: {patch_nr: (main_sheet_points, points, normals, colors, winding_angles, weights)}} of all shards overlapping [angle_start, angle_end].
+        Patches and points are in accumulation order, patches without points in the range are left out.
+        """
+        buckets = self.buckets_in_range(angle_start, angle_end)
+        if len(buckets) == 0:
+            return {}
+        records = np.concatenate([np.fromfile(self.bucket_path(bucket), dtype=RECORD_DTYPE) for bucket in buckets])
+        records = records[np.argsort(records["sequence"])]
+
+        # Records of a patch are consecutive after sorting by sequence
+        patch_starts = np.flatnonzero(np.concatenate([[True], records["patch"][1:] != records["patch"][:-1]]))
+        patch_ends = np.append(patch_starts[1:], len(records))
+        points_dict = {}
+        for start, end in zip(patch_starts, patch_ends):
+            volume_id, patch_nr = self.patch_keys[records["patch"][start]]
+            patch_records = records[start:end]
+            if volume_id not in points_dict:
+                points_dict[volume_id] = {}
+            points_dict[volume_id][patch_nr] = (patch_records["main_sheet_point"], patch_records["point"], patch_records["normal"], patch_records["color"], patch_records["winding_angle"], patch_records["weight"])
+        return points_dict
+
+    def load_org_points(self):
+        return np.fromfile(self.org_points_path, dtype="<f8").reshape(-1, 3) if self.nr_org_points > 0 else np.zeros((0, 3), dtype=np.float64)